@@ -0,0 +1,268 @@
+from persistence import redis_connection_queue, backfill_queue
+from hn_api import get_max_id_HN, ingest_range, SET_MAX_SCRIPT
+from polling import CHUNK_SIZE
+from rate_limit import reserve
+from metrics import job
+from os import getenv
+from uuid import uuid4
+import time
+import sys
+
+"""
+Ingest the history of Hacker News in parallel shards, next to the live polling.
+
+`python backfill.py start` splits the IDs from 1 to the current max item in BACKFILL_SHARDS ranges
+and raises max:ID:hn to the max item in the same transaction: the live polling only enqueues
+the IDs above it, so the backfill and the polling never overlap.
+
+Each shard is a chain of backfill_shard jobs on the backfill queue: a job ingests chunks of CHUNK_SIZE IDs
+for BACKFILL_JOB_DURATION seconds, saving its cursor after each chunk, then enqueues the next job
+of the shard. So the shards run concurrently on the backfill workers (WORKERS_BACKFILL),
+and the workers take the jobs of the queues of higher priority between two jobs.
+The backfill has its own rate limit (RATE_LIMIT_BACKFILL), a share of the limit of Hacker News,
+so the live polling keeps the rest of the quota.
+
+The progress is in the queue database, so a backfill can be resumed after a crash or a restart:
+- backfill: the first and the last ID, and the number of shards.
+- backfill:shard:<n>: the range of the shard, its cursor, the IDs done, the stories written,
+  the time spent (for the rate and the ETA), the time of its last chunk and the token of its current chain of jobs.
+`python backfill.py resume` starts a new chain for each unfinished shard. The previous chains stop
+at their next chunk, since their token isn't the one of the shard anymore.
+
+Usage:
+    python backfill.py                       # Print the progress, the rate and the ETA of each shard.
+    python backfill.py start [first] [last]  # Start a backfill of the IDs from first to last (by default 1 to the max item).
+    python backfill.py resume                # Restart the unfinished shards.
+    python backfill.py reset                 # Forget the backfill, e.g. to start another one.
+"""
+
+# The state of the backfill.
+BACKFILL_KEY = "backfill"
+# The number of shards the IDs are split into.
+BACKFILL_SHARDS = int(getenv("BACKFILL_SHARDS", "16"))
+# The time in seconds a job ingests chunks before handing over to the next job of the shard.
+BACKFILL_JOB_DURATION = int(getenv("BACKFILL_JOB_DURATION", "240"))
+# The timeout of a job. The last chunk of a job can start just before BACKFILL_JOB_DURATION.
+BACKFILL_JOB_TIMEOUT = BACKFILL_JOB_DURATION + 300
+# A shard updated less than this many seconds ago is counted in the total rate.
+ACTIVE_SHARD_AGE = 600
+
+
+def shard_key(shard: int) -> str:
+    return "backfill:shard:{}".format(shard)
+
+
+def parse_shard(shard: int, fields: dict[bytes, bytes]) -> dict:
+    """
+    Parse the hash of a shard.
+
+    Returns:
+        dict: The fields of the shard, as integers except the token, and its number.
+    """
+    parsed = {}
+    for name, value in fields.items():
+        name = name.decode("utf-8")
+        parsed[name] = value.decode("utf-8") if name == "token" else int(float(value))
+    parsed["shard"] = shard
+    return parsed
+
+
+def get_shards() -> list[dict]:
+    """
+    Get the progress of the shards of the backfill.
+
+    Returns:
+        list[dict]: The fields of each shard (see parse_shard). Empty if there is no backfill.
+    """
+    count = redis_connection_queue.hget(BACKFILL_KEY, "shards")
+    if count is None:
+        return []
+
+    pipe = redis_connection_queue.pipeline(transaction=False)
+    for shard in range(int(count)):
+        pipe.hgetall(shard_key(shard))
+    return [parse_shard(shard, fields) for shard, fields in enumerate(pipe.execute())]
+
+
+def get_rate(fields: dict) -> float:
+    """
+    Get the number of IDs ingested per second by a shard, over the time it ran.
+    """
+    return fields["done"] / fields["elapsed"] if fields["elapsed"] > 0 else 0
+
+
+def get_eta(remaining: int, rate: float) -> str:
+    """
+    Format the time left to ingest remaining IDs at a rate.
+    """
+    if remaining == 0:
+        return "done"
+    if rate <= 0:
+        return "unknown"
+    seconds = remaining / rate
+    if seconds < 3600:
+        return "{:.0f} min".format(seconds / 60)
+    return "{:.1f} h".format(seconds / 3600)
+
+
+def format_shard(fields: dict) -> str:
+    """
+    Describe the progress of a shard: the IDs done, the rate and the ETA.
+    """
+    total = fields["end"] - fields["start"]
+    remaining = fields["end"] - fields["next"]
+    rate = get_rate(fields)
+    return "Shard {:>3} ({} - {}): {} / {} IDs ({:.1f}%), {} stories, {:.0f} items/s, ETA {}".format(
+        fields["shard"], fields["start"], fields["end"] - 1, total - remaining, total,
+        100 * (total - remaining) / total if total > 0 else 100, fields["stories"], rate,
+        get_eta(remaining, rate))
+
+
+def start_backfill(first: int = 1, last: int = None, shards: int = BACKFILL_SHARDS) -> list[dict]:
+    """
+    Split the IDs from first to last in shards and start them.
+
+    The live polling is moved after last in the same transaction, so it doesn't enqueue these IDs again.
+    It never goes back: if it's already further, the IDs between last and max:ID:hn are left to it.
+
+    Args:
+        first (int): The first ID of the backfill.
+        last (int): The last ID of the backfill. By default, the max item of Hacker News.
+        shards (int): The number of shards.
+
+    Returns:
+        list[dict]: The shards created.
+    """
+    if redis_connection_queue.exists(BACKFILL_KEY):
+        raise Exception(
+            "A backfill already exists. Resume it, or reset it first.")
+    if last is None:
+        last = get_max_id_HN()
+
+    size = -(-(last - first + 1) // shards)
+    ranges = [(start, min(start + size, last + 1))
+              for start in range(first, last + 1, size)]
+
+    pipe = redis_connection_queue.pipeline()
+    pipe.hset(BACKFILL_KEY, mapping={"first": first, "last": last,
+              "shards": len(ranges), "created": int(time.time())})
+    for shard, (start, end) in enumerate(ranges):
+        pipe.hset(shard_key(shard), mapping={"start": start, "end": end, "next": start,
+                                             "done": 0, "stories": 0, "elapsed": 0, "updated": 0})
+    pipe.eval(SET_MAX_SCRIPT, 1, "max:ID:hn", last)
+    pipe.execute()
+
+    print("Backfill of the IDs {} - {} in {} shards. The live polling starts after {}.".format(
+        first, last, len(ranges), last))
+    return resume_backfill()
+
+
+def resume_backfill() -> list[dict]:
+    """
+    Start a new chain of jobs for each unfinished shard.
+
+    Returns:
+        list[dict]: The shards started.
+    """
+    shards = [fields for fields in get_shards()
+              if fields["next"] < fields["end"]]
+    for fields in shards:
+        token = uuid4().hex
+        redis_connection_queue.hset(
+            shard_key(fields["shard"]), "token", token)
+        backfill_queue.enqueue(backfill_shard, fields["shard"], token,
+                               job_timeout=BACKFILL_JOB_TIMEOUT, result_ttl=10)
+
+    print("Started {} shards.".format(len(shards)))
+    return shards
+
+
+def reset_backfill():
+    """
+    Delete the state of the backfill. The jobs still queued stop when they start.
+    """
+    count = redis_connection_queue.hget(BACKFILL_KEY, "shards")
+    shards = int(count) if count is not None else 0
+    redis_connection_queue.delete(
+        BACKFILL_KEY, *[shard_key(shard) for shard in range(shards)])
+
+
+@job("backfill_shard")
+def backfill_shard(shard: int, token: str):
+    """
+    Ingest the next chunks of a shard for BACKFILL_JOB_DURATION seconds, then enqueue the next job.
+
+    Args:
+        shard (int): The number of the shard.
+        token (str): The token of the chain of jobs. The job stops if the shard was restarted since.
+    """
+    key = shard_key(shard)
+    job_start = time.time()
+    while time.time() - job_start < BACKFILL_JOB_DURATION:
+        current_token, start, end = redis_connection_queue.hmget(
+            key, "token", "next", "end")
+        if current_token is None or current_token.decode("utf-8") != token:
+            print("Shard {} was restarted or reset. Stopping.".format(shard))
+            return
+
+        start, end = int(start), int(end)
+        if start >= end:
+            print("Shard {} is done.".format(shard))
+            return
+
+        chunk_end = min(start + CHUNK_SIZE, end)
+        before = time.time()
+        # We wait for the share of the rate limit of the backfill, on top of the limit of Hacker News.
+        delay = reserve("backfill", chunk_end - start)
+        if delay > 0:
+            time.sleep(delay)
+        stories = ingest_range(start, chunk_end)
+
+        # The cursor only moves once the chunk is written: after a crash, the chunk is ingested again.
+        pipe = redis_connection_queue.pipeline()
+        pipe.hset(key, "next", chunk_end)
+        pipe.hincrby(key, "done", chunk_end - start)
+        pipe.hincrby(key, "stories", stories)
+        pipe.hincrbyfloat(key, "elapsed", time.time() - before)
+        pipe.hset(key, "updated", int(time.time()))
+        pipe.hgetall(key)
+        print(format_shard(parse_shard(shard, pipe.execute()[-1])))
+        if chunk_end >= end:
+            print("Shard {} is done.".format(shard))
+            return
+
+    backfill_queue.enqueue(backfill_shard, shard, token,
+                           job_timeout=BACKFILL_JOB_TIMEOUT, result_ttl=10)
+
+
+def print_status():
+    shards = get_shards()
+    if len(shards) == 0:
+        print("No backfill. Run `python backfill.py start`.")
+        return
+
+    now = time.time()
+    for fields in shards:
+        print(format_shard(fields))
+
+    # The shards running at the same time add up: the total rate is the one of the active shards.
+    remaining = sum(fields["end"] - fields["next"] for fields in shards)
+    total = sum(fields["end"] - fields["start"] for fields in shards)
+    rate = sum(get_rate(fields) for fields in shards
+               if fields["next"] < fields["end"] and now - fields["updated"] < ACTIVE_SHARD_AGE)
+    print("Total: {} / {} IDs ({:.1f}%), {:.0f} items/s, ETA {}".format(
+        total - remaining, total, 100 * (total - remaining) / total if total > 0 else 100,
+        rate, get_eta(remaining, rate)))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "start":
+        first = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+        last = int(sys.argv[3]) if len(sys.argv) > 3 else None
+        start_backfill(first, last)
+    elif len(sys.argv) > 1 and sys.argv[1] == "resume":
+        resume_backfill()
+    elif len(sys.argv) > 1 and sys.argv[1] == "reset":
+        reset_backfill()
+    else:
+        print_status()
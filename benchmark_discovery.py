@@ -0,0 +1,87 @@
+from persistence import rPost, redis_connection_queue, StoryWriter, URL_INDEX_KEY
+from benchmark_export import seed
+from polling_embedding import find_posts_for_embedding, query_posts_for_embedding, WORKERS
+from indexes import rebuild_indexes
+from scan import scan_posts
+import time
+import sys
+
+"""
+Compare the discovery of the posts to embed with the indexes to the scan of all the posts.
+
+The synthetic stories of benchmark_export.py are written without the indexes,
+then indexed with a rebuild. The benchmark checks both discoveries find the same posts,
+and so does a scan reading only the stories of the bitmap idx:stories (see scan.py).
+
+WARNING: The posts are written to the database of REDIS_URL_POST, and max:ID:hn
+to the database of REDIS_URL_QUEUE. Use an empty Redis instance, not the production one.
+
+The URLs that can't be canonicalized (e.g. an invalid port) are indexed as they are:
+the benchmark checks a write of such stories doesn't fail.
+
+Usage:
+    python benchmark_discovery.py [number of posts] [workers]
+"""
+
+
+# URLs on which urlparse raises a ValueError.
+MALFORMED_URLS = ["http://example.com:99999/", "https://a.com:abc/", "http://[::1"]
+
+
+def check_malformed_urls(first_id: int) -> bool:
+    """
+    Write stories with malformed URLs and check they're indexed by their raw URL.
+
+    Args:
+        first_id (int): The ID of the first story, above the synthetic stories.
+
+    Returns:
+        bool: True if all the stories are in the index of the URLs.
+    """
+    with StoryWriter() as writer:
+        for i, url in enumerate(MALFORMED_URLS):
+            writer.add(str(first_id + i), {"by": "user", "title": "Malformed URL", "url": url,
+                                           "score": 1, "time": 1600000000, "comments": 0})
+    return all(rPost.hget(URL_INDEX_KEY, url) == str(first_id + i).encode("utf-8")
+               for i, url in enumerate(MALFORMED_URLS))
+
+
+def measure(name: str, discover) -> set[int]:
+    """
+    Run a discovery and print its duration.
+
+    Returns:
+        set[int]: The IDs of the posts found.
+    """
+    before = time.time()
+    ids = set()
+    for batch in discover():
+        ids.update(batch)
+    print("{:>8}: {:8.1f} ms, {} posts to embed".format(
+        name, (time.time() - before) * 1000, len(ids)))
+    return ids
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else WORKERS
+
+    rPost.flushdb()
+    redis_connection_queue.delete("max:ID:hn")
+    before = time.time()
+    seed(count)
+    print("Seeded {} posts in {:.1f} s.".format(count, time.time() - before))
+
+    scanned = measure("scan", lambda: scan_posts(
+        ("score", "url"), find_posts_for_embedding, workers))
+
+    before = time.time()
+    rebuild_indexes(workers)
+    print(" rebuild: {:8.1f} ms".format((time.time() - before) * 1000))
+
+    indexed = measure("index", query_posts_for_embedding)
+    bitmap = measure("bitmap", lambda: scan_posts(
+        ("score", "url"), find_posts_for_embedding, workers, indexed=True))
+    print("Same posts: {}".format(scanned == indexed == bitmap))
+    print("Malformed URLs indexed: {}".format(
+        check_malformed_urls(int(redis_connection_queue.get("max:ID:hn")) + 1)))
@@ -0,0 +1,86 @@
+from persistence import rPost, redis_connection_queue, storage
+from storage import HashLayout
+from embedding_format import encode_embedding, DIMENSIONS
+from data_export import create_database, export_duckdb, BATCH_SIZE, WORKERS
+from resource import getrusage, RUSAGE_SELF, RUSAGE_CHILDREN
+from os import getenv
+import numpy as np
+import time
+import sys
+
+"""
+Measure the time and the memory of the export on a synthetic dataset.
+
+WARNING: The posts are written to the database of REDIS_URL_POST, and max:ID:hn
+to the database of REDIS_URL_QUEUE. Use an empty Redis instance, not the production one.
+
+Usage:
+    python benchmark_export.py [number of posts] [batch size] [workers]
+"""
+
+# The fraction of the posts with an embedding.
+EMBEDDING_RATIO = float(getenv("BENCHMARK_EMBEDDING_RATIO", "0.1"))
+# Like on Hacker News, most IDs are not stories: only one ID out of ID_STEP is a post.
+ID_STEP = 10
+# The number of posts written to Redis in a single pipeline.
+SEED_BATCH_SIZE = 10000
+
+
+def seed(count: int, layout: HashLayout = storage, embedding_ratio: float = EMBEDDING_RATIO):
+    """
+    Write count synthetic stories to Redis.
+
+    Args:
+        count (int): The number of stories.
+        layout (HashLayout): The storage layout to write with. By default, the one of STORAGE_LAYOUT.
+        embedding_ratio (float): The fraction of the stories with an embedding.
+    """
+    rng = np.random.default_rng(0)
+    # We encode a few vectors and reuse them. Only the size matters here.
+    vectors = [encode_embedding(rng.normal(0, 0.02, DIMENSIONS))
+               for _ in range(100)]
+
+    for start in range(0, count, SEED_BATCH_SIZE):
+        pipe = rPost.pipeline(transaction=False)
+        for i in range(start + 1, min(start + SEED_BATCH_SIZE, count) + 1):
+            id = i * ID_STEP
+            mapping = {
+                "by": "user{}".format(id % 1000),
+                "title": "Synthetic story number {}".format(id),
+                "url": "https://example.com/{}".format(id),
+                "score": id % 500,
+                "time": 1600000000 + id,
+                "comments": id % 100,
+            }
+            layout.write_story(pipe, id, mapping)
+            if rng.random() < embedding_ratio:
+                layout.write_embeddings(pipe, id, vectors[id % len(vectors)])
+        pipe.execute()
+
+    redis_connection_queue.set("max:ID:hn", count * ID_STEP)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else BATCH_SIZE
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else WORKERS
+
+    before = time.time()
+    seed(count)
+    print("Seeded {} posts in {:.1f} s.".format(count, time.time() - before))
+
+    # ru_maxrss is the peak since the start of the process. We measure the increase.
+    rss_before = getrusage(RUSAGE_SELF).ru_maxrss
+    con = create_database("benchmark_export.duckdb")
+
+    before = time.time()
+    exported = export_duckdb(con, batch_size, workers, parts_folder=None)
+    elapsed = time.time() - before
+    con.close()
+
+    # ru_maxrss is in KB on Linux.
+    rss_after = getrusage(RUSAGE_SELF).ru_maxrss
+    print("Exported {} posts in {:.1f} s ({:.0f} posts/s) with batches of {} IDs and {} workers.".format(
+        exported, elapsed, exported / elapsed if elapsed > 0 else 0, batch_size, workers))
+    print("Peak memory: {:.0f} MB (+{:.0f} MB during the export), {:.0f} MB for the largest worker.".format(
+        rss_after / 1024, (rss_after - rss_before) / 1024, getrusage(RUSAGE_CHILDREN).ru_maxrss / 1024))
@@ -0,0 +1,46 @@
+from stub_servers import StubServer, StubConfig
+from concurrent.futures import ThreadPoolExecutor
+import http_client
+import requests
+import time
+import sys
+
+"""
+Compare the throughput of requests with and without the pooled session of http_client.
+
+The stub of the Hacker News API (see stub_servers.py) answers an item, a small JSON body,
+so the benchmark measures the cost of the connections, not of the network.
+
+Usage:
+    python benchmark_http.py [number of requests] [number of threads]
+"""
+
+
+def measure(name: str, get, url: str, count: int, threads: int):
+    """
+    Send count requests from threads threads and print the requests per second.
+    """
+    before = time.time()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for response in executor.map(lambda _: get(url), range(count)):
+            response.json()
+    elapsed = time.time() - before
+    print("{:>8}: {:.0f} requests/s".format(name, count / elapsed))
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+
+    stubs = StubServer(StubConfig(max_id=1, story_ratio=1))
+    stubs.start()
+    url = stubs.url("/v0/item/1.json")
+
+    # The proxies are disabled to measure the local server only.
+    no_proxies = {"http": None, "https": None}
+    measure("unpooled", lambda url: requests.get(url, proxies=no_proxies),
+            url, count, threads)
+    measure("pooled", lambda url: http_client.get(url, proxies=no_proxies),
+            url, count, threads)
+
+    stubs.stop()
@@ -0,0 +1,83 @@
+from stub_servers import StubServer, StubConfig
+from embeddings import get_text_pdf, get_text_truncated_tokenized, MAX_TOKENS
+from fitz import open as open_pdf
+import http_client
+import tracemalloc
+import random
+import time
+import sys
+
+"""
+Compare the extraction of the whole PDF to the streamed extraction of get_text_pdf.
+
+A large PDF is generated, like a long arXiv paper, and served by the stub server (see stub_servers.py).
+The benchmark checks the truncated texts are the same, and measures the time
+and the peak memory allocated by Python (the PDF downloaded in memory).
+
+Usage:
+    python benchmark_pdf.py [number of pages]
+"""
+
+WORDS = ["model", "attention", "layer", "training", "the", "of", "we", "results",
+         "dataset", "loss", "gradient", "network", "performance", "figure", "table"]
+# The number of lines of text per page.
+LINES = 50
+
+
+def generate_pdf(pages: int) -> bytes:
+    """
+    Generate a PDF of pages pages filled with random words.
+    """
+    rng = random.Random(0)
+    with open_pdf() as pdf:
+        for _ in range(pages):
+            page = pdf.new_page()
+            text = "\n".join(" ".join(rng.choice(WORDS) for _ in range(12))
+                             for _ in range(LINES))
+            page.insert_text((40, 40), text, fontsize=9)
+        return pdf.tobytes()
+
+
+def get_text_pdf_whole(url: str) -> str:
+    """
+    Download the whole PDF in memory and extract the text of every page.
+    """
+    response = http_client.get(url)
+    with open_pdf(stream=response.content, filetype="pdf") as pdf:
+        return "".join(page.get_text() for page in pdf)
+
+
+def measure(name: str, get_text, url: str) -> str:
+    """
+    Extract the text of the PDF and print the time and the peak memory.
+    """
+    tracemalloc.start()
+    before = time.time()
+    text = get_text_truncated_tokenized(get_text(url), MAX_TOKENS)
+    elapsed = time.time() - before
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("{:>8}: {:7.1f} ms, {:6.1f} MB peak".format(
+        name, elapsed * 1000, peak / 1024 / 1024))
+    return text
+
+
+if __name__ == "__main__":
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+
+    content = generate_pdf(pages)
+    print("Generated a PDF of {} pages ({:.1f} MB).".format(
+        pages, len(content) / 1024 / 1024))
+
+    stubs = StubServer(StubConfig())
+    stubs.start()
+    url = stubs.add_file("/paper.pdf", content, "application/pdf")
+
+    # The proxies are disabled to measure the local server only.
+    http_client.proxies.update({"http": None, "https": None})
+
+    whole = measure("whole", get_text_pdf_whole, url)
+    streamed = measure("streamed", get_text_pdf, url)
+    print("Same truncated text: {}".format(whole == streamed))
+
+    stubs.stop()
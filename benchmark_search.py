@@ -0,0 +1,71 @@
+from search import VectorIndex, write_index, normalize, NPROBE
+from embedding_format import DIMENSIONS
+import numpy as np
+import time
+import sys
+
+"""
+Compare the approximate search (IVF) to the exact search on synthetic embeddings.
+
+The vectors are drawn around random topics, like posts about the same subjects.
+The index is written to the folder benchmark_search_index.
+
+Usage:
+    python benchmark_search.py [number of vectors] [number of queries]
+"""
+
+# The number of topics the vectors are drawn around.
+TOPICS = 5000
+# The spread of the vectors around their topic.
+NOISE = 0.02
+# The number of results per query.
+K = 10
+FOLDER = "benchmark_search_index"
+
+
+def measure(search, queries: np.ndarray) -> tuple[list[np.ndarray], float]:
+    """
+    Run the queries and measure the mean latency in ms.
+    """
+    before = time.time()
+    results = [search(query) for query in queries]
+    return results, (time.time() - before) / len(queries) * 1000
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    queries_count = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    rng = np.random.default_rng(0)
+    topics = normalize(rng.normal(size=(TOPICS, DIMENSIONS))
+                       ).astype(np.float32)
+    vectors = np.empty((count, DIMENSIONS), dtype=np.float32)
+    for start in range(0, count, 10000):
+        end = min(start + 10000, count)
+        vectors[start:end] = normalize(topics[rng.integers(TOPICS, size=end - start)]
+                                       + rng.normal(0, NOISE, (end - start, DIMENSIONS)))
+    queries = normalize(topics[rng.integers(TOPICS, size=queries_count)]
+                        + rng.normal(0, NOISE, (queries_count, DIMENSIONS))).astype(np.float32)
+
+    before = time.time()
+    write_index(FOLDER, np.arange(count, dtype=np.int64), vectors)
+    print("Built the index of {} vectors in {:.1f} s.".format(
+        count, time.time() - before))
+    del vectors
+
+    index = VectorIndex.load(FOLDER)
+    exact, exact_latency = measure(
+        lambda query: index.search_exact(query, K)[0], queries)
+    print("exact:      {:7.2f} ms/query".format(exact_latency))
+
+    if index.centroids is None:
+        print("The index is too small to be approximate.")
+        sys.exit(0)
+
+    for nprobe in sorted({1, 4, NPROBE, 64}):
+        approximate, latency = measure(
+            lambda query: index.search_built(query, K, nprobe)[0], queries)
+        recall = np.mean([len(np.intersect1d(a, e)) / K
+                          for a, e in zip(approximate, exact)])
+        print("nprobe {:3}: {:7.2f} ms/query, recall@{} {:.3f}".format(
+            nprobe, latency, K, recall))
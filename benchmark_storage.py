@@ -0,0 +1,68 @@
+from persistence import rPost, redis_connection_queue
+from benchmark_export import seed, ID_STEP
+from storage import LAYOUTS, get_layout, BUCKET_SIZE
+import redis
+import sys
+
+"""
+Compare the memory used by the stories in each storage layout (see storage.py).
+
+The synthetic stories of benchmark_export.py are written in each layout, without embeddings
+by default since they take the same space in both. The memory is the used_memory of INFO.
+
+The bucket layout is only compact if Redis keeps the buckets in a listpack:
+the benchmark prints the maximum number of entries and size of a value of a listpack,
+and the encoding of a bucket.
+
+WARNING: The database of REDIS_URL_POST is flushed. Use an empty Redis instance, not the production one.
+
+Usage:
+    python benchmark_storage.py [number of stories] [fraction with embeddings]
+"""
+
+
+def used_memory() -> int:
+    return rPost.info("memory")["used_memory"]
+
+
+def print_listpack_config():
+    """
+    Print the configuration of the hashes encoded as listpacks, and the encoding of a bucket.
+    """
+    try:
+        config = rPost.config_get("hash-max-*")
+    except redis.ResponseError:
+        # CONFIG is disabled on some managed instances.
+        print("CONFIG GET is not allowed: check hash-max-listpack-entries is at least {} "
+              "and hash-max-listpack-value at least 512.".format(BUCKET_SIZE))
+        return
+
+    entries = config.get("hash-max-listpack-entries", config.get("hash-max-ziplist-entries"))
+    value = config.get("hash-max-listpack-value", config.get("hash-max-ziplist-value"))
+    print("hash-max-listpack-entries: {}, hash-max-listpack-value: {}".format(entries, value))
+    if entries is not None and int(entries) < BUCKET_SIZE:
+        print("Run CONFIG SET hash-max-listpack-entries {} for the buckets of the first IDs, "
+              "mostly stories, to be compact.".format(BUCKET_SIZE))
+    if value is not None and int(value) < 512:
+        print("Run CONFIG SET hash-max-listpack-value 512 for the bucket layout to be compact.")
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    embedding_ratio = float(sys.argv[2]) if len(sys.argv) > 2 else 0
+
+    print_listpack_config()
+    for name in LAYOUTS:
+        layout = get_layout(name, rPost)
+        rPost.flushdb()
+        before = used_memory()
+        seed(count, layout, embedding_ratio)
+        used = used_memory() - before
+        print("{:>8}: {:8.1f} MB, {:6.1f} bytes per story, {} keys".format(
+            name, used / 1024 ** 2, used / count, rPost.dbsize()))
+        if name == "bucket":
+            key, _ = layout.bucket(ID_STEP)
+            print("Encoding of {}: {}".format(key, rPost.object("encoding", key)))
+
+    rPost.flushdb()
+    redis_connection_queue.delete("max:ID:hn")
@@ -0,0 +1,340 @@
+from stub_servers import StubServer, StubConfig
+from resource import getrusage, RUSAGE_SELF, RUSAGE_CHILDREN
+from tempfile import TemporaryDirectory
+from os.path import join
+from json import dumps
+import subprocess
+import platform
+import argparse
+import tomllib
+import shutil
+import socket
+import time
+import os
+
+"""
+Measure the throughput of the scraper end to end, without Firebase, Diffbot or Azure OpenAI.
+
+The external APIs are replaced by the local stubs of stub_servers.py, with configurable
+latencies, error rates and payload sizes. Redis is a throwaway redis-server started on a free port,
+or the instance of --redis-url. The jobs run in an RQ SimpleWorker in this process.
+
+The scenarios:
+- ingest: pollNewStory enqueues the new IDs in chunks, and the worker runs add_story_range_redis.
+- ingest_single: one add_story_redis job per ID.
+- ingest_stream: pollNewStory polls a stream of new IDs, as the scheduler does, without and with
+  the pre-filter of the non-stories. It reports the jobs, the requests and the CPU time of the worker of each.
+- embed: poll_post_for_embedding enqueues the stories to embed, the worker runs add_embeddings_redis
+  and embedding_batcher.py embeds the texts.
+- export: data_export.py exports synthetic posts to DuckDB.
+
+The results are printed as JSON, and written to --output, to compare releases.
+
+WARNING: Redis is flushed before each scenario. Never use --redis-url with the production instance.
+
+Usage:
+    python benchmark_suite.py [--scenarios ingest,embed] [--items 20000] [--output results.json]
+"""
+
+SCENARIOS = ["ingest", "ingest_single", "ingest_stream", "embed", "export"]
+# The maximum time in seconds to wait for redis-server to start.
+REDIS_START_TIMEOUT = 10
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the scraper with local stubs of the external APIs.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help="The scenarios to run, separated by commas.")
+    parser.add_argument("--items", type=int, default=20000,
+                        help="The number of HN IDs ingested, and of posts exported.")
+    parser.add_argument("--single-items", type=int, default=2000,
+                        help="The number of HN IDs ingested one job per ID.")
+    parser.add_argument("--stream-polls", type=int, default=200,
+                        help="The number of polls of the ingest_stream scenario.")
+    parser.add_argument("--stream-step", type=int, default=20,
+                        help="The number of new HN IDs between two polls of the ingest_stream scenario.")
+    parser.add_argument("--embed-items", type=int, default=500,
+                        help="The number of stories to embed.")
+    parser.add_argument("--story-ratio", type=float, default=0.1,
+                        help="The fraction of the HN items that are stories.")
+    parser.add_argument("--text-size", type=int, default=20000,
+                        help="The number of characters of the articles.")
+    parser.add_argument("--hn-latency-ms", type=float, default=0)
+    parser.add_argument("--diffbot-latency-ms", type=float, default=0)
+    parser.add_argument("--embedding-latency-ms", type=float, default=0)
+    parser.add_argument("--hn-error-rate", type=float, default=0)
+    parser.add_argument("--diffbot-error-rate", type=float, default=0)
+    parser.add_argument("--embedding-error-rate", type=float, default=0)
+    parser.add_argument("--redis-url",
+                        help="An empty Redis instance to use instead of starting redis-server.")
+    parser.add_argument("--output", help="The file to write the results to.")
+    return parser.parse_args()
+
+
+def start_redis() -> tuple[subprocess.Popen, str]:
+    """
+    Start a redis-server without persistence on a free port.
+
+    Returns:
+        tuple[subprocess.Popen, str]: The process and the URL of the server.
+    """
+    if shutil.which("redis-server") is None:
+        raise Exception(
+            "redis-server is not installed. Install it or use --redis-url.")
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    process = subprocess.Popen(["redis-server", "--port", str(port), "--save", "", "--appendonly", "no"],
+                               stdout=subprocess.DEVNULL)
+    deadline = time.time() + REDIS_START_TIMEOUT
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, "redis://127.0.0.1:{}".format(port)
+        except OSError:
+            time.sleep(0.1)
+
+    process.kill()
+    raise Exception("redis-server did not start.")
+
+
+def get_version() -> str:
+    with open("pyproject.toml", "rb") as file:
+        return tomllib.load(file)["tool"]["poetry"]["version"]
+
+
+def peak_memory() -> dict:
+    # ru_maxrss is in KB on Linux.
+    return {"max_rss_mb": round(getrusage(RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "max_rss_children_mb": round(getrusage(RUSAGE_CHILDREN).ru_maxrss / 1024, 1)}
+
+
+def flush():
+    from persistence import rPost, redis_connection_queue
+    rPost.flushdb()
+    redis_connection_queue.flushdb()
+
+
+def work():
+    """
+    Run the jobs of the queue until it's empty.
+
+    Returns:
+        int: The number of jobs that failed.
+    """
+    from persistence import queues, redis_connection_queue, QUEUE_NAMES
+    from rq import SimpleWorker
+
+    SimpleWorker([queues[name] for name in QUEUE_NAMES], connection=redis_connection_queue).work(
+        burst=True, logging_level="WARNING")
+    return sum(queue.failed_job_registry.count for queue in queues.values())
+
+
+def count_stories(max_id: int) -> int:
+    from scan import read_posts
+    ids, _ = read_posts(range(1, max_id + 1), ("score",))
+    return len(ids)
+
+
+def bench_ingest(stubs: StubServer, args: argparse.Namespace) -> dict:
+    from polling import pollNewStory
+
+    stubs.config.max_id = args.items
+    before = time.time()
+    pollNewStory()
+    failed = work()
+    elapsed = time.time() - before
+
+    return {"ids": args.items, "stories": count_stories(args.items), "failed_jobs": failed,
+            "seconds": round(elapsed, 3), "ids_per_second": round(args.items / elapsed, 1)}
+
+
+def bench_ingest_single(stubs: StubServer, args: argparse.Namespace) -> dict:
+    from persistence import ingest_queue
+    from hn_api import add_story_redis
+    from rq import Queue
+
+    stubs.config.max_id = args.single_items
+    before = time.time()
+    ingest_queue.enqueue_many([Queue.prepare_data(add_story_redis, (str(id),), result_ttl=10)
+                              for id in range(1, args.single_items + 1)])
+    failed = work()
+    elapsed = time.time() - before
+
+    return {"ids": args.single_items, "stories": count_stories(args.single_items), "failed_jobs": failed,
+            "seconds": round(elapsed, 3), "ids_per_second": round(args.single_items / elapsed, 1)}
+
+
+def bench_ingest_stream(stubs: StubServer, args: argparse.Namespace) -> dict:
+    import polling
+    from persistence import ingest_queue, redis_connection_queue
+
+    # The stream starts after the IDs of a first newstories list.
+    start = 10000
+    results = {}
+    prefilter = polling.INGEST_PREFILTER
+    try:
+        for name, enabled in (("all_ids", False), ("prefilter", True)):
+            flush()
+            polling.INGEST_PREFILTER = enabled
+            stubs.config.max_id = start
+            redis_connection_queue.set("max:ID:hn", start)
+            requests_before = stubs.requests["hn"]
+            jobs = 0
+            # Only the time of the thread of the worker: the stubs run in other threads of this process.
+            cpu = 0
+            before = time.time()
+            for _ in range(args.stream_polls):
+                stubs.config.max_id += args.stream_step
+                polling.pollNewStory()
+                jobs += ingest_queue.count
+                cpu_before = time.thread_time()
+                work()
+                cpu += time.thread_time() - cpu_before
+            elapsed = time.time() - before
+
+            results[name] = {"jobs": jobs, "hn_requests": stubs.requests["hn"] - requests_before,
+                             "stories": count_stories(stubs.config.max_id),
+                             "worker_cpu_seconds": round(cpu, 3), "seconds": round(elapsed, 3)}
+    finally:
+        polling.INGEST_PREFILTER = prefilter
+
+    ids = args.stream_polls * args.stream_step
+    all_ids, filtered = results["all_ids"], results["prefilter"]
+    results.update({
+        "ids": ids,
+        # Compared to one add_story_redis job per ID, and to the chunks of all the IDs.
+        "jobs_eliminated_per_id": round(1 - filtered["jobs"] / ids, 3),
+        "jobs_eliminated_chunks": round(1 - filtered["jobs"] / all_ids["jobs"], 3) if all_ids["jobs"] > 0 else 0,
+        "hn_requests_saved": round(1 - filtered["hn_requests"] / all_ids["hn_requests"], 3),
+        "worker_cpu_saved": round(1 - filtered["worker_cpu_seconds"] / all_ids["worker_cpu_seconds"], 3),
+    })
+    return results
+
+
+def bench_embed(stubs: StubServer, args: argparse.Namespace) -> dict:
+    from persistence import rPost, redis_connection_queue, storage
+    from polling_embedding import poll_post_for_embedding
+    from embeddings import EMBEDDING_BATCHING
+    from embedding_batcher import run
+    from stub_servers import is_story
+
+    # We write the stories directly: only the embeddings are measured.
+    stubs.config.max_id = args.embed_items * 10
+    ids = [id for id in range(1, stubs.config.max_id + 1)
+           if is_story(id, stubs.config.story_ratio)][:args.embed_items]
+    pipe = rPost.pipeline(transaction=False)
+    for id in ids:
+        item = stubs.item(id)
+        # Every story is above the threshold of polling_embedding.py.
+        storage.write_story(pipe, id, {"by": item["by"], "title": item["title"],
+                                       "url": item["url"], "score": 100 + item["score"],
+                                       "time": item["time"], "comments": item["descendants"]})
+    pipe.execute()
+    redis_connection_queue.set("max:ID:hn", stubs.config.max_id)
+
+    requests_before = dict(stubs.requests)
+    before = time.time()
+    poll_post_for_embedding()
+    failed = work()
+    if EMBEDDING_BATCHING:
+        run(burst=True)
+    elapsed = time.time() - before
+
+    pipe = rPost.pipeline(transaction=False)
+    for id in ids:
+        storage.queue_has_embeddings(pipe, id)
+    embedded = sum(pipe.execute())
+    return {"stories": len(ids), "embedded": embedded, "failed_jobs": failed, "batching": EMBEDDING_BATCHING,
+            "diffbot_requests": stubs.requests["diffbot"] - requests_before.get("diffbot", 0),
+            "embedding_requests": stubs.requests["embeddings"] - requests_before.get("embeddings", 0),
+            "seconds": round(elapsed, 3), "stories_per_second": round(embedded / elapsed, 1)}
+
+
+def bench_export(stubs: StubServer, args: argparse.Namespace) -> dict:
+    from benchmark_export import seed
+    from data_export import create_database, export_duckdb, BATCH_SIZE, WORKERS
+
+    seed(args.items)
+    with TemporaryDirectory() as folder:
+        con = create_database(join(folder, "benchmark.duckdb"))
+        before = time.time()
+        exported = export_duckdb(con, BATCH_SIZE, WORKERS, parts_folder=None)
+        elapsed = time.time() - before
+        con.close()
+
+    return {"posts": exported, "seconds": round(elapsed, 3),
+            "posts_per_second": round(exported / elapsed, 1)}
+
+
+BENCHMARKS = {
+    "ingest": bench_ingest,
+    "ingest_single": bench_ingest_single,
+    "ingest_stream": bench_ingest_stream,
+    "embed": bench_embed,
+    "export": bench_export,
+}
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    scenarios = [name for name in args.scenarios.split(",") if name != ""]
+    for name in scenarios:
+        if name not in BENCHMARKS:
+            raise Exception("Unknown scenario {}.".format(name))
+
+    config = StubConfig(story_ratio=args.story_ratio, text_size=args.text_size,
+                        hn_latency=args.hn_latency_ms / 1000, diffbot_latency=args.diffbot_latency_ms / 1000,
+                        embedding_latency=args.embedding_latency_ms / 1000, hn_error_rate=args.hn_error_rate,
+                        diffbot_error_rate=args.diffbot_error_rate, embedding_error_rate=args.embedding_error_rate)
+    stubs = StubServer(config)
+    stubs.start()
+
+    redis_process = None
+    redis_url = args.redis_url
+    if redis_url is None:
+        redis_process, redis_url = start_redis()
+
+    # The modules of the scraper read their configuration when imported, so we import them after.
+    os.environ.update({
+        "REDIS_URL_QUEUE": redis_url.rstrip("/") + "/0",
+        "REDIS_URL_POST": redis_url.rstrip("/") + "/1",
+        "HN_API_URL": stubs.url("/v0"),
+        "DIFFBOT_API_URL": stubs.url("/v3/article"),
+        "DIFFBOT_API_KEY": "benchmark",
+        "AZURE_AI_ENDPOINT": stubs.url(),
+        "AZURE_AI_API_KEY": "benchmark",
+        "AZURE_AI_VERSION": "2023-05-15",
+        "AZURE_DEPLOYMENT_ID": "benchmark",
+        "METRICS_PORT": "",
+    })
+    os.environ.pop("PROXY_URL_USA", None)
+
+    results = {}
+    try:
+        for name in scenarios:
+            print("Running {}.".format(name))
+            flush()
+            results[name] = BENCHMARKS[name](stubs, args)
+            results[name].update(peak_memory())
+    finally:
+        stubs.stop()
+        if redis_process is not None:
+            redis_process.terminate()
+            redis_process.wait()
+
+    report = {
+        "version": get_version(),
+        "python": platform.python_version(),
+        "time": int(time.time()),
+        "config": vars(args),
+        "requests": dict(stubs.requests),
+        "results": results,
+    }
+    print(dumps(report, indent=2))
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            file.write(dumps(report, indent=2))
@@ -0,0 +1,76 @@
+from embeddings import enc, get_text_truncated_tokenized, get_texts_truncated_tokenized, MAX_TOKENS
+import random
+import time
+import sys
+
+"""
+Compare the truncation of texts by tokenizing a prefix to the tokenization of the whole text.
+
+The texts are large, like the text of a PDF or a transcript, and mix words, numbers,
+punctuation, newlines and runs of spaces. The benchmark checks the truncated texts are the same.
+
+Usage:
+    python benchmark_truncate.py [number of texts] [number of characters per text]
+"""
+
+WORDS = ["the", "model", "Attention", "is", "all", "you", "need", "2023", "3.14159", "(see", "Fig.",
+         "1)", "don't", "naïve", "数据", "—", "x_i", "https://arxiv.org/abs/1706.03762", "\n", "\n\n",
+         "  ", "\t", "...", "'s"]
+
+
+def get_text_truncated_whole(text: str, max_tokens: int) -> str:
+    """
+    Truncate a text by tokenizing the whole text.
+    """
+    return enc.decode(enc.encode(text)[:max_tokens]).replace("\n", " ")
+
+
+def generate_text(rng: random.Random, length: int) -> str:
+    """
+    Generate a text of about length characters.
+    """
+    words = []
+    size = 0
+    while size < length:
+        word = rng.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)
+
+
+def measure(name: str, truncate, texts: list[str]) -> list[str]:
+    """
+    Truncate the texts and print the time per text.
+    """
+    before = time.time()
+    results = truncate(texts)
+    elapsed = time.time() - before
+    print("{:>8}: {:8.2f} ms/text".format(
+        name, elapsed / len(texts) * 1000))
+    return results
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+
+    rng = random.Random(0)
+    texts = [generate_text(rng, length) for _ in range(count)]
+    # Short texts and texts without spaces are tokenized whole.
+    texts += [generate_text(rng, 100), "数据" * 10000, ""]
+
+    whole = measure("whole", lambda texts: [get_text_truncated_whole(
+        text, MAX_TOKENS) for text in texts], texts)
+    prefix = measure("prefix", lambda texts: [get_text_truncated_tokenized(
+        text, MAX_TOKENS) for text in texts], texts)
+    batched = measure("batched", lambda texts: get_texts_truncated_tokenized(
+        texts, MAX_TOKENS), texts)
+
+    print("Same truncated texts: {}".format(whole == prefix == batched))
+
+    # Every text is also truncated at the other lengths.
+    for max_tokens in [1, 7, 100, 2000]:
+        expected = [get_text_truncated_whole(text, max_tokens) for text in texts]
+        if expected != [get_text_truncated_tokenized(text, max_tokens) for text in texts] or \
+                expected != get_texts_truncated_tokenized(texts, max_tokens):
+            print("Different truncated texts for {} tokens.".format(max_tokens))
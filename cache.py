@@ -0,0 +1,129 @@
+from persistence import rPost
+from embedding_format import encode_embedding, decode_embedding
+from urls import canonicalize_url
+from hashlib import sha256
+from zlib import compress, decompress
+from os import getenv
+import time
+
+"""
+Caches of the text extracted from URLs and of the embeddings computed from texts.
+
+Hacker News often has several submissions of the same URL, and a post can be embedded
+again. The text cache is keyed by the canonical URL, so http/https, www, tracking parameters
+or arxiv abs/pdf links share the same entry. The embedding cache is keyed by a hash
+of the truncated text, so the same content never hits the embeddings API twice.
+
+Each cache is bounded in size: a sorted set keeps the last access time of each entry,
+and the least recently used entries are evicted when there are too many.
+The entries also expire after a TTL.
+
+The hits and misses are counted in the hash cache:stats.
+"""
+
+TEXT_CACHE_PREFIX = "cache:text:"
+EMBEDDING_CACHE_PREFIX = "cache:embedding:"
+STATS_KEY = "cache:stats"
+
+# The time in seconds an extracted text is kept (one week).
+TEXT_CACHE_TTL = int(getenv("TEXT_CACHE_TTL", str(7 * 24 * 3600)))
+# The maximum number of texts kept.
+TEXT_CACHE_MAX_ENTRIES = int(getenv("TEXT_CACHE_MAX_ENTRIES", "100000"))
+# The time in seconds an embedding is kept (30 days).
+EMBEDDING_CACHE_TTL = int(getenv("EMBEDDING_CACHE_TTL", str(30 * 24 * 3600)))
+# The maximum number of embeddings kept.
+EMBEDDING_CACHE_MAX_ENTRIES = int(
+    getenv("EMBEDDING_CACHE_MAX_ENTRIES", "100000"))
+
+def get_cache(prefix: str, key: str) -> bytes | None:
+    """
+    Get an entry of a cache and mark it as recently used.
+    """
+    pipe = rPost.pipeline(transaction=False)
+    pipe.get(prefix + key)
+    pipe.zadd(prefix + "lru", {key: time.time()}, xx=True)
+    value = pipe.execute()[0]
+
+    rPost.hincrby(STATS_KEY, "{}{}".format(
+        prefix[len("cache:"):], "hit" if value is not None else "miss"))
+    return value
+
+
+def set_cache(prefix: str, key: str, value: bytes, ttl: int, max_entries: int):
+    """
+    Add an entry to a cache and evict the least recently used entries above max_entries.
+    """
+    pipe = rPost.pipeline(transaction=False)
+    pipe.set(prefix + key, value, ex=ttl)
+    pipe.zadd(prefix + "lru", {key: time.time()})
+    pipe.zcard(prefix + "lru")
+    count = pipe.execute()[-1]
+
+    if count > max_entries:
+        evicted = rPost.zpopmin(prefix + "lru", count - max_entries)
+        if len(evicted) > 0:
+            rPost.delete(*[prefix + key.decode("utf-8")
+                         for key, _ in evicted])
+
+
+def hash_key(value: str) -> str:
+    return sha256(value.encode("utf-8")).hexdigest()
+
+
+def text_key(url: str) -> str:
+    """
+    Get the key of the text of a URL: the hash of its canonical URL.
+    """
+    try:
+        url = canonicalize_url(url)
+    except ValueError:
+        # An invalid port or host: we use the raw URL, as index_story does, rather than failing the extraction.
+        pass
+    return hash_key(url)
+
+
+def get_cached_text(url: str) -> str | None:
+    """
+    Get the text extracted from a URL, or None if it's not in the cache.
+    """
+    value = get_cache(TEXT_CACHE_PREFIX, text_key(url))
+    return decompress(value).decode("utf-8") if value is not None else None
+
+
+def set_cached_text(url: str, text: str):
+    """
+    Save the text extracted from a URL.
+    """
+    set_cache(TEXT_CACHE_PREFIX, text_key(url),
+              compress(text.encode("utf-8")), TEXT_CACHE_TTL, TEXT_CACHE_MAX_ENTRIES)
+
+
+def get_cached_embeddings(model: str, text: str) -> list[float] | None:
+    """
+    Get the embeddings of a truncated text, or None if they're not in the cache.
+    """
+    value = get_cache(EMBEDDING_CACHE_PREFIX, hash_key(model + "\n" + text))
+    return decode_embedding(value).tolist() if value is not None else None
+
+
+def set_cached_embeddings(model: str, text: str, embeddings: list[float]):
+    """
+    Save the embeddings of a truncated text.
+    """
+    set_cache(EMBEDDING_CACHE_PREFIX, hash_key(model + "\n" + text),
+              encode_embedding(embeddings), EMBEDDING_CACHE_TTL, EMBEDDING_CACHE_MAX_ENTRIES)
+
+
+def get_cache_stats() -> dict[str, int]:
+    """
+    Get the number of hits and misses of the caches.
+
+    Returns:
+        dict[str, int]: The counters: text:hit, text:miss, embedding:hit and embedding:miss.
+    """
+    return {key.decode("utf-8"): int(value) for key, value in rPost.hgetall(STATS_KEY).items()}
+
+
+if __name__ == "__main__":
+    for key, value in sorted(get_cache_stats().items()):
+        print("{}: {}".format(key, value))
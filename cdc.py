@@ -0,0 +1,153 @@
+from persistence import rPost, refresh_queue, storage, log_change, index_story
+from hn_api import fetch_posts_hn, get_updates_HN, parse_story
+from storage import STORY_FIELDS, to_bytes
+from metrics import job, CDC_CHANGES
+from rate_limit import is_open
+from rq import Queue
+from os import getenv
+import time
+import sys
+
+"""
+Change data capture: keep the stories up-to-date from the updates feed of Hacker News.
+
+Every CDC_INTERVAL seconds, poll_updates reads /v0/updates.json, the items and profiles changed recently.
+We don't store the profiles, and most items are comments: only the stories we already store are fetched,
+by apply_updates_redis jobs on the refresh queue. So a cycle sends a request per changed story,
+instead of a request per story of the periodic refresh.
+
+The job compares each story to the one stored and only writes the fields that changed,
+in a single pipeline for all the stories. Each change is also added to the stream changes:hn
+as an entry with the ID of the story, the field, and its old and new values, for the downstream consumers.
+The changed stories are logged to changelog:hn and indexed again, like any other write.
+
+Usage:
+    python cdc.py            # Poll the updates once and apply them in this process.
+    python cdc.py tail [n]   # Print the last n changes (10 by default).
+"""
+
+# The interval in seconds between two polls of the updates feed. 0 disables the change data capture.
+CDC_INTERVAL = int(getenv("CDC_INTERVAL", "0"))
+# The stream of the changes of the fields of the stories.
+CHANGES_KEY = "changes:hn"
+# The approximate number of changes kept in the stream.
+CHANGES_MAXLEN = int(getenv("CHANGES_MAXLEN", "1000000"))
+# The number of stories fetched by a single apply_updates_redis job.
+CDC_CHUNK_SIZE = 100
+
+
+def get_changes(current: list[bytes | None], mapping: dict) -> dict:
+    """
+    Compare a story fetched from Hacker News to the one stored.
+
+    Args:
+        current (list[bytes | None]): The values stored of STORY_FIELDS, as read from the storage layout.
+        mapping (dict): The story fetched, parsed by parse_story.
+
+    Returns:
+        dict: The fields that changed, with their new value.
+    """
+    return {field: mapping[field] for field, value in zip(STORY_FIELDS, current)
+            if value != to_bytes(mapping[field])}
+
+
+@job("apply_updates")
+def apply_updates_redis(ids: list[int]) -> int:
+    """
+    Fetch stories changed on Hacker News and write the fields that changed.
+
+    Args:
+        ids (list[int]): The IDs of the stories.
+
+    Returns:
+        int: The number of fields changed.
+    """
+    stories = fetch_posts_hn(ids)
+    stored = storage.read_posts(ids, STORY_FIELDS)
+
+    now = int(time.time())
+    changed_stories = 0
+    changed_fields = 0
+    pipe = rPost.pipeline(transaction=False)
+    for id, current in zip(ids, stored):
+        story = stories.get(id)
+        # Not fetched, deleted from Redis in between, or not a story anymore (dead or deleted).
+        if story is None or all(value is None for value in current):
+            continue
+        mapping = parse_story(id, story)
+        if mapping is None:
+            continue
+
+        changes = get_changes(current, mapping)
+        if len(changes) == 0:
+            continue
+
+        storage.update_story(pipe, id, changes, mapping)
+        log_change(pipe, str(id))
+        old_values = dict(zip(STORY_FIELDS, current))
+        if "score" in changes or "time" in changes or "url" in changes:
+            index_story(pipe, str(id), mapping, old_values["url"])
+        for field, value in changes.items():
+            pipe.xadd(CHANGES_KEY, {"id": id, "field": field, "old": old_values[field] or b"",
+                                    "new": value, "time": now},
+                      maxlen=CHANGES_MAXLEN, approximate=True)
+            CDC_CHANGES.labels(field).inc()
+        changed_stories += 1
+        changed_fields += len(changes)
+    pipe.execute()
+
+    print("Updated {} fields of {} stories out of {}.".format(
+        changed_fields, changed_stories, len(ids)))
+    return changed_fields
+
+
+def get_updated_stories() -> list[int]:
+    """
+    Get the IDs of the stories we store that are in the updates feed.
+
+    Returns:
+        list[int]: The IDs.
+    """
+    updates = get_updates_HN()
+    pipe = rPost.pipeline(transaction=False)
+    for id in updates:
+        storage.queue_exists(pipe, id)
+    return [id for id, exists in zip(updates, pipe.execute()) if exists]
+
+
+def poll_updates():
+    """
+    Poll the updates feed and push the stories changed to the refresh queue.
+    """
+    if is_open("hn"):
+        print("The circuit of the Hacker News API is open. Skipping.")
+        return
+
+    ids = get_updated_stories()
+    if len(ids) == 0:
+        return
+
+    jobs_list = [Queue.prepare_data(apply_updates_redis, (ids[i:i + CDC_CHUNK_SIZE],),
+                                    timeout=120, result_ttl=10)
+                 for i in range(0, len(ids), CDC_CHUNK_SIZE)]
+    refresh_queue.enqueue_many(jobs_list)
+    print("Enqueued {} updated stories in {} jobs.".format(
+        len(ids), len(jobs_list)))
+
+
+def print_changes(count: int):
+    for entry_id, fields in reversed(rPost.xrevrange(CHANGES_KEY, count=count)):
+        fields = {name.decode("utf-8"): value.decode("utf-8")
+                  for name, value in fields.items()}
+        print("{} story {} {}: {} -> {}".format(entry_id.decode("utf-8"), fields["id"], fields["field"],
+                                                 fields["old"], fields["new"]))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "tail":
+        print_changes(int(sys.argv[2]) if len(sys.argv) > 2 else 10)
+    else:
+        ids = get_updated_stories()
+        print("{} stories in the updates feed.".format(len(ids)))
+        for i in range(0, len(ids), CDC_CHUNK_SIZE):
+            apply_updates_redis(ids[i:i + CDC_CHUNK_SIZE])
@@ -1,115 +1,295 @@
-from persistence import rPost
-from os import remove, mkdir, getenv
-from bz2 import decompress
-from json import loads
-from gc import collect
+from persistence import get_changelog_end, changelog_has_gap, read_changed_ids
+from scan import scan_posts, read_posts, SCAN_WORKERS
+from indexes import is_index_ready
+from os import remove, mkdir, makedirs, getenv
+from os.path import exists
+from shutil import rmtree
+from uuid import uuid4
+from embedding_format import decode_embedding, DIMENSIONS
+from metrics import timed, start_metrics_server, STAGE_LATENCY
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import duckdb
 import time
-import csv
+import sys
 
 """
 Some explanation about the data export.
 
-I'm building a giant CSV file with all the posts in it because it's faster than
-using INSERT statements. I'm using the COPY command to import the CSV file into
-duckDB.
+The posts are streamed from Redis to DuckDB: the workers of scan_posts read ranges
+of IDs with pipelined HMGETs and convert them to Arrow record batches,
+which are appended to the story table.
+The embeddings are a fixed-size list of float32, so they're copied once from Redis
+into a single NumPy buffer instead of being parsed as Python lists.
+
+The memory used depends on the batch size (EXPORTER_BATCH_SIZE) and the number of
+workers (EXPORTER_WORKERS), not on the number of posts.
+A batch of 10 000 posts with embeddings is about 60 MB. DuckDB itself is bounded
+by EXPORTER_MEMORY_LIMIT and spills to disk above it.
+
+Once the table is built, DuckDB exports it to CSV, JSON and Parquet.
+
+The export is incremental when the database already exists: every write to a post
+appends its ID to the changelog stream (see persistence.log_change), and the database
+stores the ID of the last entry exported. Only the posts changed since are read
+from Redis and upserted in the story table.
+Each batch is also written as Parquet files in data_export/parts/month=<YYYY-MM>/,
+by month of the post, so downstream readers only pick up the new part files.
+The CSV, JSON and Parquet exports of the whole table are written again after each run
+that changed posts, so they're never older than the database.
+A post changed several times is in several part files: the last one written
+(the names sort by time of writing) is the current one.
+A full rebuild runs when there is no database, when the changelog has been trimmed
+past the last entry exported, or with --full.
 
 At first, I was using small CSV files (500 000 rows) and importing them into duckDB
 using the COPY command. But DuckDB has a weird bug making a segfault. It was hard to debug
 because Python would not printed out and would exit silently.
-Same with small JSON files.
-
-WARNING:  The program can use quite a lot of memory (more than 16gb). Make sure you have some swap space.
-To try to reduce the memory usage, I'm deleting the posts from memory after inserting them into the database.
+Same with small JSON files. Arrow batches don't go through a file at all.
 """
 
+# The number of IDs read from Redis and inserted in DuckDB at once.
+# Most IDs are comments, so a batch holds about a tenth of it in posts.
+BATCH_SIZE = int(getenv("EXPORTER_BATCH_SIZE", "100000"))
+# The number of processes reading Redis.
+WORKERS = int(getenv("EXPORTER_WORKERS", str(SCAN_WORKERS)))
+# The maximum memory DuckDB can use before spilling to disk.
+MEMORY_LIMIT = getenv("EXPORTER_MEMORY_LIMIT", "2GB")
+# The fields of the posts exported.
+FIELDS = ("title", "url", "score", "time", "comments", "by", "embeddings")
+DATABASE_NAME = "data_export/hn.duckdb"  # The name of the database.
+PARTS_FOLDER = "data_export/parts"  # The folder of the Parquet part files.
+# The number of changed posts read from Redis at once in incremental mode.
+INCREMENTAL_BATCH_SIZE = 10000
+
+EMBEDDING_TYPE = pa.list_(pa.float32(), DIMENSIONS)
+SCHEMA = pa.schema([
+    ("id", pa.int32()),
+    ("title", pa.string()),
+    ("url", pa.string()),
+    ("score", pa.int32()),
+    ("time", pa.int32()),
+    ("comments", pa.int32()),
+    ("author", pa.string()),
+    ("embeddings", EMBEDDING_TYPE),
+])
+
+
+def to_record_batch(ids: list[int], rows: list[list[bytes]]) -> pa.RecordBatch:
+    """
+    Convert posts read from Redis to a record batch.
+    It runs in the workers of scan_posts.
+
+    Args:
+        ids (list[int]): The IDs of the posts.
+        rows (list[list[bytes]]): The values of FIELDS for each post.
 
-def poll_post_CSV(cursor: int = 0):
+    Returns:
+        pa.RecordBatch: The posts, with the columns of SCHEMA.
+    """
+    columns = [[] for _ in range(7)]
+    embeddings = []
+    for id, fields in zip(ids, rows):
+        # A post missing fields is not a story we can export.
+        if None in fields[:6]:
+            continue
+
+        columns[0].append(id)
+        columns[1].append(fields[0].decode("utf-8"))
+        columns[2].append(fields[1].decode("utf-8"))
+        columns[3].append(int(fields[2]))
+        columns[4].append(int(fields[3]))
+        columns[5].append(int(fields[4]))
+        columns[6].append(fields[5].decode("utf-8"))
+        embeddings.append(fields[6])
+
+    arrays = [pa.array(column, type=field.type)
+              for column, field in zip(columns, SCHEMA)]
+    arrays.append(embeddings_array(embeddings))
+    return pa.RecordBatch.from_arrays(arrays, schema=SCHEMA)
+
+
+def embeddings_array(embeddings: list[bytes | None]) -> pa.Array:
     """
-    Poll the posts in Redis and export them to a DuckDB database.
+    Convert the embeddings stored in Redis to a fixed-size list array.
 
-    To do so, we iterate over the posts in Redis using the SCAN command.
+    Args:
+        embeddings (list[bytes | None]): The "embeddings" fields. None if the post has no embedding.
+
+    Returns:
+        pa.Array: The embeddings, null for the posts without one.
     """
+    valid = np.zeros(len(embeddings), dtype=bool)
+    values = np.zeros((len(embeddings), DIMENSIONS), dtype="<f4")
+    for i, data in enumerate(embeddings):
+        if data is None:
+            continue
 
-    before = time.time()
-    res_scan = rPost.scan(cursor=cursor, count=SCAN_COUNT)
-    print("Polling posts for embeddings. Cursor: {}. New cursor: {}".format(
-        cursor, res_scan[0]))
-    print("{} posts to scan.".format(len(res_scan[1])))
-    print("Scanning took {} ms".format((time.time() - before) * 1000))
+        vector = decode_embedding(data)
+        if len(vector) != DIMENSIONS:
+            print("Embedding has {} dimensions instead of {}.".format(
+                len(vector), DIMENSIONS))
+            continue
 
-    # Ids are prefixed with "hn:". We remove it.
-    id = [postID.decode("utf-8")[3:] for postID in res_scan[1]]
+        values[i] = vector
+        valid[i] = True
 
-    # We iterate over the posts to get their fields
-    # and add them to the database.
+    # A boolean array without null has its bits in its second buffer.
+    # It's the validity bitmap of the list array.
+    validity = pa.array(valid).buffers()[1]
+    return pa.Array.from_buffers(EMBEDDING_TYPE, len(embeddings), [validity],
+                                 children=[pa.array(values.reshape(-1))])
 
-    before = time.time()
-    pipe = rPost.pipeline()
-    for postID in res_scan[1]:
-        pipe.hmget(postID, "title", "url", "score",
-                   "time", "comments", "by", "embeddings")
 
-    # We execute the pipeline.
-    res = pipe.execute()
-    print("Fetching took {} ms".format((time.time() - before) * 1000))
+def write_parts(batch: pa.RecordBatch, parts_folder: str):
+    """
+    Write a batch as Parquet files, one per month of the posts.
+    The files are named part-<timestamp in ms>-<random>.parquet, so they sort by time of writing.
 
-    # A list of posts to add to the database.
-    posts = []
+    Args:
+        batch (pa.RecordBatch): The posts.
+        parts_folder (str): The folder of the part files.
+    """
+    name = "{}-{}".format(int(time.time() * 1000), uuid4().hex[:8])
+    table = pa.Table.from_batches([batch])
+    months = np.array(batch.column("time"),
+                      dtype="datetime64[s]").astype("datetime64[M]")
+    for month in np.unique(months):
+        folder = "{}/month={}".format(parts_folder, month)
+        makedirs(folder, exist_ok=True)
+        pq.write_table(table.filter(pa.array(months == month)),
+                       "{}/part-{}.parquet".format(folder, name))
+
+
+def export_duckdb(con: duckdb.DuckDBPyConnection, batch_size: int = BATCH_SIZE,
+                  workers: int = WORKERS, parts_folder: str | None = PARTS_FOLDER) -> int:
+    """
+    Stream all the posts from Redis to the story table.
 
-    for i in range(len(res)):
-        embedding: list[float] = None
-        if res[i][6] != None:
-            # We decompress the embedding and parse the JSON.
-            embedding = loads(decompress(res[i][6]))
+    Args:
+        con (duckdb.DuckDBPyConnection): The database.
+        batch_size (int): The number of IDs per batch, hence the maximum number of posts per batch.
+        workers (int): The number of processes reading Redis.
+        parts_folder (str | None): The folder of the Parquet part files. None to not write them.
 
-        posts.append({
-            "id": id[i],
-            "title": res[i][0].decode("utf-8"),
-            "url": res[i][1].decode("utf-8"),
-            "score": int(res[i][2]),
-            "time": int(res[i][3]),
-            "comments": int(res[i][4]),
-            "author": res[i][5].decode("utf-8"),
-            "embeddings": embedding
-        })
-    # Inserting using SQL is too slow. We use the CSV import instead.
-    # We dump the posts to a temp csv file.
+    Returns:
+        int: The number of posts read.
+    """
+    count = 0
+    # Once the indexes are built, only the stories of the bitmap are read (see scan.py).
+    for batch in scan_posts(FIELDS, to_record_batch, workers, batch_size, indexed=is_index_ready()):
+        if batch.num_rows == 0:
+            continue
+
+        before = time.time()
+        con.register("batch", pa.Table.from_batches([batch]))
+        con.execute("INSERT INTO story SELECT * FROM batch")
+        con.unregister("batch")
+        if parts_folder is not None:
+            write_parts(batch, parts_folder)
+        count += batch.num_rows
+        print("Inserting {} posts took {} ms".format(
+            batch.num_rows, (time.time() - before) * 1000))
+
+    return count
+
+
+def export_incremental(con: duckdb.DuckDBPyConnection,
+                       parts_folder: str = PARTS_FOLDER) -> int | None:
+    """
+    Upsert the posts changed since the last export into the story table.
 
-    # cursor = con.cursor()
+    Args:
+        con (duckdb.DuckDBPyConnection): The database of the last export.
+        parts_folder (str): The folder of the Parquet part files.
 
-    # Append the posts to the CSV file.
-    before = time.time()
-    with open("data_export/story.csv", "a", newline="") as f:
-        writer = csv.DictWriter(f, fieldnames=posts[0].keys())
-        writer.writerows(posts)
+    Returns:
+        int | None: The number of posts upserted, or None if a full rebuild is needed.
+    """
+    last_id = get_state(con, "changelog_id")
+    if last_id is None:
+        print("The database has no changelog position.")
+        return None
+    if changelog_has_gap(last_id):
+        print("The changelog has been trimmed since the last export.")
+        return None
+
+    end_id = get_changelog_end()
+    ids = sorted(read_changed_ids(last_id, end_id))
+    print("{} posts changed since the last export.".format(len(ids)))
+
+    count = 0
+    for i in range(0, len(ids), INCREMENTAL_BATCH_SIZE):
+        before = time.time()
+        batch = to_record_batch(
+            *read_posts(ids[i:i + INCREMENTAL_BATCH_SIZE], FIELDS))
+        if batch.num_rows == 0:
+            continue
+
+        # DuckDB can't update a list column, so INSERT OR REPLACE is not possible.
+        # We delete the rows first.
+        con.register("batch", pa.Table.from_batches([batch]))
+        con.execute("DELETE FROM story WHERE id IN (SELECT id FROM batch)")
+        con.execute("INSERT INTO story SELECT * FROM batch")
+        con.unregister("batch")
+        write_parts(batch, parts_folder)
+        count += batch.num_rows
+        print("Upserting {} posts took {} ms".format(
+            batch.num_rows, (time.time() - before) * 1000))
+
+    # We move the position only once all the changes are in the database.
+    # If we crash before, the next export upserts them again.
+    set_state(con, "changelog_id", end_id)
+    return count
+
+
+def export_full(parts_folder: str = PARTS_FOLDER) -> duckdb.DuckDBPyConnection:
+    """
+    Rebuild the database and the part files from all the posts in Redis.
 
-    # We import the CSV file.
-    # cursor.execute(
-    #    "COPY story FROM 'temp.csv' ( DELIMITER ',', HEADER TRUE );")
-    print("Inserting into CSV took {} ms \n".format(
-        (time.time() - before) * 1000))
+    Returns:
+        duckdb.DuckDBPyConnection: The connection to the new database.
+    """
+    # We read the position before the posts, so the changes made
+    # while we read them are upserted by the next export.
+    end_id = get_changelog_end()
+
+    con = create_database()
+    rmtree(parts_folder, ignore_errors=True)
 
-    # Delete from memory the posts.
-    print("Cleaning up memory.")
-    del posts
-    del res
-    collect()
+    count = export_duckdb(con, parts_folder=parts_folder)
+    print("I have inserted {} posts into the database.".format(count))
 
-    # We check if we need to continue scanning.
-    return res_scan[0]
+    set_state(con, "changelog_id", end_id)
+    return con
 
 
-def export_various_format():
+def get_state(con: duckdb.DuckDBPyConnection, key: str) -> str | None:
+    """
+    Get a value saved in the export_state table of the database.
+    """
+    res = con.execute(
+        "SELECT value FROM export_state WHERE key = ?", [key]).fetchone()
+    return res[0] if res is not None else None
+
+
+def set_state(con: duckdb.DuckDBPyConnection, key: str, value: str):
+    """
+    Save a value in the export_state table of the database.
+    """
+    con.execute("INSERT OR REPLACE INTO export_state VALUES (?, ?)", [key, value])
+
+
+def export_various_format(con: duckdb.DuckDBPyConnection):
     """
     Export the DuckDB database to various formats.
     """
 
     # Export to CSV.
     print("Exporting to CSV.")
-    # We don't need to export the story because we already have it.
-    # con.execute(
-    #    "COPY (SELECT id, title, url, score, time, comments, author FROM story) TO 'data_export/story.csv' ( DELIMITER ',', HEADER);")
+    con.execute(
+        "COPY (SELECT id, title, url, score, time, comments, author FROM story) TO 'data_export/story.csv' ( DELIMITER ',', HEADER);")
     con.execute("COPY (SELECT * FROM story WHERE len(embeddings) > 0) TO 'data_export/story_with_embeddings.csv' ( DELIMITER ',', HEADER);")
 
     # Export to JSON.
@@ -124,57 +304,84 @@ def export_various_format():
     con.execute("COPY (SELECT * FROM story WHERE len(embeddings) > 0) TO 'data_export/story_with_embeddings.parquet' ( FORMAT PARQUET );")
 
 
-if __name__ == "__main__":
-    print("Starting data export.")
-
-    print("Trying to create the folder data_export.")
-    # Check if folder data_export exists.
-    try:
-        mkdir("data_export")
-    except OSError:
-        pass
+def create_database(database_name: str = DATABASE_NAME) -> duckdb.DuckDBPyConnection:
+    """
+    Create an empty database with the story table.
+    If the database already exists, it is deleted.
 
-    # The number of posts to scan in Redis per iteration.
-    SCAN_COUNT = int(getenv("EXPORTER_SCAN_COUNT"))
-    PATTERN = "hn:*"  # The pattern to use to scan Redis.
-    DATABASE_NAME = "data_export/hn.duckdb"  # The name of the database.
+    Args:
+        database_name (str): The path of the database.
 
+    Returns:
+        duckdb.DuckDBPyConnection: The connection to the database.
+    """
     # Delete the database if it already exists.
     try:
-        remove(DATABASE_NAME)
+        remove(database_name)
     except OSError:
         print("No database to delete.")
         pass
 
-    # Delete the CSV file if it already exists.
-    try:
-        remove("data_export/story.csv")
-    except OSError:
-        print("No CSV file to delete.")
-        pass
-
-    # Open the database.
-    con = duckdb.connect(database=DATABASE_NAME, read_only=False)
+    con = open_database(database_name)
 
     # Create the table.
     con.execute("""CREATE TABLE story (id INTEGER PRIMARY KEY, title VARCHAR, url VARCHAR, score INTEGER,
     time INTEGER, comments INTEGER, author VARCHAR, embeddings FLOAT[]);""")
-    # We start the polling.
-    now = time.time()
-    cursor = poll_post_CSV()
+    return con
 
-    # We continue polling until we have scanned all the posts.
-    while cursor != 0:
-        cursor = poll_post_CSV(cursor)
 
-    print("I'm done creating a CSV")
+def open_database(database_name: str = DATABASE_NAME) -> duckdb.DuckDBPyConnection:
+    """
+    Open the database, creating the export_state table if needed.
+
+    Args:
+        database_name (str): The path of the database.
 
-    # Now import the CSV file into the database.
+    Returns:
+        duckdb.DuckDBPyConnection: The connection to the database.
+    """
+    con = duckdb.connect(database=database_name, read_only=False)
+    con.execute("SET memory_limit='{}'".format(MEMORY_LIMIT))
+    # The state of the incremental export, e.g. the position in the changelog.
     con.execute(
-        "COPY story FROM 'data_export/story.csv' ( DELIMITER ',', HEADER TRUE );")
-    print("I have successfully imported the CSV file into the database.")
+        "CREATE TABLE IF NOT EXISTS export_state (key VARCHAR PRIMARY KEY, value VARCHAR);")
+    return con
+
+
+if __name__ == "__main__":
+    print("Starting data export.")
+    start_metrics_server()
+
+    print("Trying to create the folder data_export.")
+    # Check if folder data_export exists.
+    try:
+        mkdir("data_export")
+    except OSError:
+        pass
+
+    # We start the polling.
+    now = time.time()
 
-    # We export the database to various formats.
-    export_various_format()
+    count = None
+    if "--full" not in sys.argv and exists(DATABASE_NAME):
+        con = open_database()
+        with timed(STAGE_LATENCY, stage="export incremental"):
+            count = export_incremental(con)
+        if count is None:
+            con.close()
+
+    if count is None:
+        print("Rebuilding the database from scratch.")
+        with timed(STAGE_LATENCY, stage="export full"):
+            con = export_full()
+    else:
+        print("I have upserted {} posts into the database.".format(count))
+
+    # We export the database to various formats, unless nothing changed since the last export.
+    if count != 0:
+        with timed(STAGE_LATENCY, stage="export formats"):
+            export_various_format(con)
+
+    con.close()
 
     print("Polling total took {} ms".format((time.time() - now) * 1000))
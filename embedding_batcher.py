@@ -0,0 +1,224 @@
+from persistence import rPost, redis_connection_queue
+from embeddings import set_embeddings, request_embeddings, PENDING_TEXTS_KEY, PENDING_IDS_KEY, MODEL_ID
+from cache import set_cached_embeddings
+from rate_limit import call, backoff_delay
+from failures import record_failure
+from metrics import start_metrics_server, EMBEDDING_API_INPUTS
+from scheduler import RENEW_SCRIPT, RELEASE_SCRIPT
+from json import loads
+from os import getenv
+from uuid import uuid4
+import time
+
+"""
+Embed the texts pushed by add_embeddings_redis in batches.
+
+The API accepts several inputs per request, so we pay one round trip and one request
+of the rate limit for many posts. A request holds at most EMBEDDING_BATCH_MAX_INPUTS texts
+and EMBEDDING_BATCH_MAX_TOKENS tokens.
+
+The texts are removed from the list only once their embeddings are written,
+so a crash never loses a text. Two batchers would embed the same texts: a batcher only runs
+while it holds the lock BATCHER_LOCK_KEY, like the leader lock of scheduler.py.
+The others wait to take over if it stops renewing the lock.
+"""
+
+# The maximum number of texts per request. Azure OpenAI accepts 16 for text-embedding-ada-002.
+BATCH_MAX_INPUTS = int(getenv("EMBEDDING_BATCH_MAX_INPUTS", "16"))
+# The maximum number of tokens per request.
+BATCH_MAX_TOKENS = int(getenv("EMBEDDING_BATCH_MAX_TOKENS", "8192"))
+# The time in seconds to wait when there is no text to embed.
+IDLE_DELAY = 1
+# The number of attempts of a request before moving its texts to FAILED_TEXTS_KEY.
+BATCH_TRIES = 5
+# The list of texts that couldn't be embedded, in the queue database.
+FAILED_TEXTS_KEY = "embeddings:failed"
+# The interval in seconds between two reports of the throughput.
+REPORT_INTERVAL = 60
+# The key of the lock held by the running batcher.
+BATCHER_LOCK_KEY = "embeddings:batcher"
+# The time in seconds after which the lock expires if the batcher doesn't renew it.
+# It's above the longest request, so the lock isn't lost while waiting for the API.
+BATCHER_LOCK_TTL = 120
+# The interval in seconds between two renewals of the lock.
+BATCHER_LOCK_RENEW_INTERVAL = 10
+
+
+def take_batch() -> list[dict]:
+    """
+    Get the first texts of the list, up to the limits of a request.
+    The texts stay in the list.
+
+    Returns:
+        list[dict]: The texts, with the ID of their post and their number of tokens.
+    """
+    items = [loads(item) for item in redis_connection_queue.lrange(
+        PENDING_TEXTS_KEY, 0, BATCH_MAX_INPUTS - 1)]
+
+    batch = []
+    tokens = 0
+    for item in items:
+        # We always take the first text, even if it's above the limit alone.
+        if len(batch) > 0 and tokens + item["tokens"] > BATCH_MAX_TOKENS:
+            break
+        batch.append(item)
+        tokens += item["tokens"]
+
+    return batch
+
+
+def embed_batch(batch: list[dict]) -> list[list[float]]:
+    """
+    Compute the embeddings of texts in a single request.
+
+    Returns:
+        list[list[float]]: The embeddings, in the order of the texts.
+    """
+    EMBEDDING_API_INPUTS.inc(len(batch))
+    # run() retries the batch itself, so the request is sent once within the rate limit.
+    response = call("embeddings", lambda: request_embeddings(
+        [item["text"] for item in batch]), tries=1)
+
+    # The API doesn't guarantee the order of the results.
+    return [result['embedding'] for result in sorted(response, key=lambda result: result['index'])]
+
+
+def write_batch(batch: list[dict], embeddings: list[list[float]]):
+    """
+    Write the embeddings in a single pipeline and cache them, then remove the texts from the list.
+    """
+    pipe = rPost.pipeline(transaction=False)
+    for item, vector in zip(batch, embeddings):
+        set_embeddings(pipe, item["id"], vector)
+    pipe.execute()
+
+    for item, vector in zip(batch, embeddings):
+        set_cached_embeddings(MODEL_ID, item["text"], vector)
+
+    pipe = redis_connection_queue.pipeline()
+    pipe.ltrim(PENDING_TEXTS_KEY, len(batch), -1)
+    pipe.srem(PENDING_IDS_KEY, *[item["id"] for item in batch])
+    pipe.execute()
+
+
+def discard_batch(batch: list[dict], error: Exception):
+    """
+    Move texts that can't be embedded to FAILED_TEXTS_KEY so they don't block the others.
+    Their failure is recorded so the poller retries them later (see failures.py).
+    """
+    pipe = redis_connection_queue.pipeline()
+    pipe.ltrim(PENDING_TEXTS_KEY, len(batch), -1)
+    pipe.srem(PENDING_IDS_KEY, *[item["id"] for item in batch])
+    pipe.rpush(FAILED_TEXTS_KEY, *[item["id"] for item in batch])
+    pipe.execute()
+
+    for item in batch:
+        record_failure(item["id"], error)
+
+
+class BatcherLock:
+    """
+    The lock of the running batcher: acquired with SET NX PX and renewed while we own it.
+    """
+
+    def __init__(self):
+        # A unique value identifying this batcher in the lock.
+        self.identity = str(uuid4())
+        self.renewed = 0
+
+    def acquire(self):
+        """
+        Acquire the lock, waiting for the running batcher to release it or stop renewing it.
+        """
+        waiting = False
+        while not redis_connection_queue.set(BATCHER_LOCK_KEY, self.identity, nx=True,
+                                             px=BATCHER_LOCK_TTL * 1000):
+            if not waiting:
+                print("Another batcher holds the lock. Waiting.")
+                waiting = True
+            time.sleep(BATCHER_LOCK_RENEW_INTERVAL)
+        self.renewed = time.time()
+        print("Batcher lock acquired.")
+
+    def renew(self) -> bool:
+        """
+        Renew the lock if BATCHER_LOCK_RENEW_INTERVAL seconds passed since the last renewal.
+
+        Returns:
+            bool: False if we don't own the lock anymore.
+        """
+        if time.time() - self.renewed < BATCHER_LOCK_RENEW_INTERVAL:
+            return True
+        renewed = redis_connection_queue.eval(
+            RENEW_SCRIPT, 1, BATCHER_LOCK_KEY, self.identity, BATCHER_LOCK_TTL * 1000)
+        if not renewed:
+            print("Batcher lock lost.")
+            return False
+        self.renewed = time.time()
+        return True
+
+    def release(self):
+        redis_connection_queue.eval(
+            RELEASE_SCRIPT, 1, BATCHER_LOCK_KEY, self.identity)
+
+
+def run(burst: bool = False):
+    """
+    Embed the pending texts forever, while holding the batcher lock.
+
+    Args:
+        burst (bool): Stop when there is no text to embed, like the burst mode of RQ workers.
+    """
+    lock = BatcherLock()
+    lock.acquire()
+    try:
+        run_locked(lock, burst)
+    finally:
+        lock.release()
+
+
+def run_locked(lock: BatcherLock, burst: bool):
+    texts = 0
+    requests = 0
+    failures = 0
+    since = time.time()
+
+    while True:
+        # Another batcher may have taken over while we couldn't renew the lock.
+        if not lock.renew():
+            lock.acquire()
+        batch = take_batch()
+        if len(batch) == 0:
+            if burst:
+                return
+            time.sleep(IDLE_DELAY)
+        else:
+            try:
+                write_batch(batch, embed_batch(batch))
+                texts += len(batch)
+                requests += 1
+                failures = 0
+            except Exception as e:
+                failures += 1
+                print("Embedding {} texts failed ({} / {}): {}".format(
+                    len(batch), failures, BATCH_TRIES, e))
+                if failures >= BATCH_TRIES:
+                    discard_batch(batch, e)
+                    failures = 0
+                else:
+                    # We wait for the Retry-After of the API, or back off.
+                    time.sleep(backoff_delay(
+                        failures - 1, getattr(e, "retry_after", None)))
+
+        elapsed = time.time() - since
+        if elapsed >= REPORT_INTERVAL:
+            print("Embedded {} texts in {} requests ({:.1f} texts/s, {} requests saved).".format(
+                texts, requests, texts / elapsed, texts - requests))
+            texts = 0
+            requests = 0
+            since = time.time()
+
+
+if __name__ == "__main__":
+    start_metrics_server()
+    run()
@@ -0,0 +1,153 @@
+from bz2 import compress, decompress
+from json import dumps, loads
+from os import getenv
+import struct
+import numpy as np
+
+"""
+The binary format of the embeddings stored in the "embeddings" field of hn:<id>.
+
+An embedding is a header followed by the vector:
+- 2 bytes: the magic b"HE"
+- 1 byte: the version of the format
+- 1 byte: the type of the values (float32, float16 or int8)
+- 4 bytes: the number of dimensions (little-endian)
+- for int8 only, 4 bytes: the scale of the quantization (float32)
+- the values (little-endian)
+
+The header is 8 bytes long so the float32 values are aligned and can be read
+without copy using numpy.frombuffer.
+
+Before this format, embeddings were stored as bz2 compressed JSON.
+decode_embedding still reads them until migrate_embeddings.py has rewritten them all.
+"""
+
+MAGIC = b"HE"
+VERSION = 1
+HEADER = struct.Struct("<2sBBI")
+SCALE = struct.Struct("<f")
+
+FORMAT_FLOAT32 = 1
+FORMAT_FLOAT16 = 2
+FORMAT_INT8 = 3
+FORMATS = {
+    "float32": FORMAT_FLOAT32,
+    "float16": FORMAT_FLOAT16,
+    "int8": FORMAT_INT8,
+}
+
+# The number of dimensions of the embeddings of text-embedding-ada-002.
+DIMENSIONS = 1536
+
+# The format used to write new embeddings.
+EMBEDDING_FORMAT = getenv("EMBEDDING_FORMAT", "float32")
+
+# The first bytes of a bz2 stream. It's how we recognize the legacy format.
+LEGACY_MAGIC = b"BZh"
+
+
+def encode_embedding(vector, format: str = EMBEDDING_FORMAT) -> bytes:
+    """
+    Encode an embedding to the binary format.
+
+    Args:
+        vector (list[float] | np.ndarray): The embedding.
+        format (str): float32, float16 or int8.
+
+    Returns:
+        bytes: The encoded embedding.
+    """
+    if format not in FORMATS:
+        raise Exception("Unknown embedding format: {}".format(format))
+
+    values = np.asarray(vector, dtype="<f4")
+    header = HEADER.pack(MAGIC, VERSION, FORMATS[format], len(values))
+
+    if format == "float32":
+        return header + values.tobytes()
+
+    if format == "float16":
+        return header + values.astype("<f2").tobytes()
+
+    # We quantize symmetrically: the largest absolute value is mapped to 127.
+    max_value = float(np.abs(values).max()) if len(values) > 0 else 0
+    scale = max_value / 127 if max_value > 0 else 1
+    quantized = np.round(values / scale).astype("i1")
+    return header + SCALE.pack(scale) + quantized.tobytes()
+
+
+def decode_embedding(data: bytes) -> np.ndarray:
+    """
+    Decode an embedding stored in the binary format or in the legacy format.
+
+    For float32, the array returned is a read-only view of data (no copy).
+
+    Args:
+        data (bytes): The content of the "embeddings" field.
+
+    Returns:
+        np.ndarray: The embedding as float32.
+    """
+    if is_legacy_embedding(data):
+        return np.array(loads(decompress(data)), dtype="<f4")
+
+    magic, version, format, dimensions = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise Exception("Unknown embedding header.")
+
+    if format == FORMAT_FLOAT32:
+        return np.frombuffer(data, dtype="<f4", count=dimensions, offset=HEADER.size)
+
+    if format == FORMAT_FLOAT16:
+        return np.frombuffer(data, dtype="<f2", count=dimensions, offset=HEADER.size).astype("<f4")
+
+    if format == FORMAT_INT8:
+        scale = SCALE.unpack_from(data, HEADER.size)[0]
+        quantized = np.frombuffer(data, dtype="i1", count=dimensions,
+                                  offset=HEADER.size + SCALE.size)
+        return quantized.astype("<f4") * np.float32(scale)
+
+    raise Exception("Unknown embedding format: {}".format(format))
+
+
+def is_legacy_embedding(data: bytes) -> bool:
+    """
+    Check if an embedding is stored as bz2 compressed JSON.
+    """
+    return data[:len(LEGACY_MAGIC)] == LEGACY_MAGIC
+
+
+def encode_embedding_legacy(vector: list[float]) -> bytes:
+    """
+    Encode an embedding as bz2 compressed JSON, the format used before the binary format.
+    Only used to compare the formats.
+    """
+    return compress(dumps(list(vector)).encode("utf-8"))
+
+
+if __name__ == "__main__":
+    # We compare the formats on random vectors of the size of text-embedding-ada-002.
+    import time
+
+    VECTORS = 1000
+
+    vectors = np.random.default_rng(0).normal(
+        0, 0.02, (VECTORS, DIMENSIONS)).astype("<f4")
+
+    formats = {"legacy": encode_embedding_legacy}
+    for name in FORMATS:
+        formats[name] = lambda vector, name=name: encode_embedding(vector, name)
+
+    for name, encode in formats.items():
+        before = time.time()
+        encoded = [encode(vector) for vector in vectors]
+        encode_time = time.time() - before
+
+        before = time.time()
+        decoded = [decode_embedding(data) for data in encoded]
+        decode_time = time.time() - before
+
+        size = sum(len(data) for data in encoded) / VECTORS
+        error = float(np.abs(np.array(decoded) - vectors).max())
+        print("{:>8}: {:7.0f} bytes/vector, encode {:7.1f} us, decode {:7.1f} us, max error {:.2e}".format(
+            name, size, encode_time / VECTORS * 1e6, decode_time / VECTORS * 1e6, error))
@@ -1,13 +1,19 @@
-from persistence import rPost
+from persistence import rPost, redis_connection_queue, log_change, storage, NEEDS_EMBEDDING_KEY
 from retry import retry
-from bz2 import compress, decompress
+from embedding_format import encode_embedding
+from cache import get_cached_text, set_cached_text, get_cached_embeddings, set_cached_embeddings
 from tiktoken import get_encoding
 from youtube_transcript_api import YouTubeTranscriptApi
 from urllib.parse import urlparse
 from fitz import open as open_pdf
+from http_client import proxies
+from metrics import timed, job, EXTRACTION_LATENCY, EXTRACTION_ERRORS, EMBEDDING_API_LATENCY, EMBEDDING_API_ERRORS, EMBEDDING_API_INPUTS
 from os import getenv
 from json import dumps
-import requests
+from tempfile import NamedTemporaryFile
+from rate_limit import call, check_response, parse_retry_after, UpstreamError, RetryableError
+from failures import PermanentError, record_failure, clear_failure
+import http_client
 import openai
 
 # Set to a global variable to avoid calling the function every time.
@@ -19,43 +25,111 @@ openai.api_base = getenv("AZURE_AI_ENDPOINT")
 openai.api_type = "azure"
 openai.api_version = getenv("AZURE_AI_VERSION")
 
-# We define the proxies to use.
-proxies = {
-    'http': getenv("PROXY_URL_USA"),
-    'https': getenv("PROXY_URL_USA"),
-}
-
 # Constants
 # The maximum number of tokens we will use to compute embeddings.
 MAX_TOKENS = 512
-DIMENSIONS = 1536  # The number of dimensions of the embeddings.
 MODEL_ID = "text-embedding-ada-002"  # The ID of the model to use.
+# The URL of Diffbot's Article API. It can be overridden to point to a local stub server.
+DIFFBOT_API_URL = getenv("DIFFBOT_API_URL", "https://api.diffbot.com/v3/article")
+
+# Whether the texts are embedded by embedding_batcher.py instead of the job itself.
+EMBEDDING_BATCHING = getenv("EMBEDDING_BATCHING", "1") == "1"
+# The list of texts waiting for embedding_batcher.py, in the queue database.
+PENDING_TEXTS_KEY = "embeddings:pending"
+# The set of the IDs of the posts in PENDING_TEXTS_KEY, so the poller doesn't enqueue them again.
+PENDING_IDS_KEY = "embeddings:pending:ids"
+
+# The maximum size in bytes of a PDF we download.
+PDF_MAX_BYTES = int(getenv("PDF_MAX_BYTES", str(50 * 1024 * 1024)))
+# Above this size in bytes, a PDF is written to a temporary file instead of being kept in memory.
+PDF_SPOOL_BYTES = int(getenv("PDF_SPOOL_BYTES", str(5 * 1024 * 1024)))
+# The size in bytes of the chunks read from the response.
+PDF_CHUNK_SIZE = 64 * 1024
+# The number of tokens extracted beyond MAX_TOKENS before we stop reading the pages.
+PDF_TOKENS_MARGIN = 64
+# The number of characters per token of the first prefix tokenized by get_text_truncated_tokenized.
+# English has about 4 characters per token, so the first prefix is almost always long enough.
+TRUNCATE_CHARS_PER_TOKEN = 6
+
+
+@job("add_embeddings")
+def add_embeddings_redis(id: str):
+    """
+    Upsert the embeddings of a post to Redis.
 
+    If it fails, the failure is recorded before the job fails (see failures.py),
+    so the poller retries the post later, or never if the failure is permanent.
+    """
+    try:
+        upsert_embeddings(id)
+    except Exception as e:
+        record_failure(id, e)
+        raise
 
-def add_embeddings_redis(id: str):
+
+def upsert_embeddings(id: str):
     """
     Upsert the embeddings of a post to Redis.
+
+    With EMBEDDING_BATCHING, the job only extracts the text and pushes it
+    to PENDING_TEXTS_KEY. embedding_batcher.py sends the texts of many posts
+    to the API in a single request and writes the embeddings.
     """
 
-    id = "hn:{}".format(id)
-    res = rPost.hget(id, "url")
+    postID = id
+    res = storage.read_posts([postID], ("url",))[0][0]
     if res is None:
-        raise Exception("URL is empty.")
-        return
+        raise PermanentError("URL is empty.", "no_url")
     res = res.decode("utf-8")
     if res == "":
-        raise Exception("URL is empty.")
+        raise PermanentError("URL is empty.", "no_url")
+
+    if EMBEDDING_BATCHING:
+        text = get_text_truncated_tokenized(get_text(res), MAX_TOKENS)
+        if (len(text) == 0):
+            raise PermanentError("Text extracted is empty.", "empty_text")
+
+        # The same text may have been embedded for another post.
+        cached = get_cached_embeddings(MODEL_ID, text)
+        if cached is not None:
+            pipe = rPost.pipeline(transaction=False)
+            set_embeddings(pipe, postID, cached)
+            pipe.execute()
+            return
+
+        # We store the number of tokens so the batcher can fill its requests.
+        # The job ends before the post is embedded: the set keeps the poller from enqueueing it again.
+        pipe = redis_connection_queue.pipeline()
+        pipe.sadd(PENDING_IDS_KEY, postID)
+        pipe.rpush(PENDING_TEXTS_KEY, dumps(
+            {"id": postID, "text": text, "tokens": len(enc.encode(text))}))
+        pipe.execute()
+        return
 
     embeddings = compute_embeddings(res)
 
-    if len(embeddings) == 0:
-        raise Exception("Embeddings are empty.")
+    pipe = rPost.pipeline(transaction=False)
+    set_embeddings(pipe, postID, embeddings)
+    pipe.execute()
+
 
-    stringifiedJSON = dumps(embeddings)
+def set_embeddings(pipe, id: str, embeddings: list[float]):
+    """
+    Add the write of the embeddings of a post to a pipeline.
+    It also removes the post from the index of the posts to embed and clears its failure, if any.
 
-    compressedJSON = compress(stringifiedJSON.encode("utf-8"))
+    Args:
+        pipe (redis.client.Pipeline): A pipeline of rPost.
+        id (str): The ID of the post, without the "hn:" prefix.
+        embeddings (list[float]): The embeddings.
+    """
+    if len(embeddings) == 0:
+        raise Exception("Embeddings are empty.")
 
-    rPost.hset(id, "embeddings", compressedJSON)
+    storage.write_embeddings(pipe, id, encode_embedding(embeddings))
+    log_change(pipe, id)
+    pipe.zrem(NEEDS_EMBEDDING_KEY, id)
+    clear_failure(pipe, id)
 
 
 def compute_embeddings(url: str) -> list[float]:
@@ -74,19 +148,79 @@ def compute_embeddings(url: str) -> list[float]:
         list[float]: The embeddings of the article.
     """
     text = get_text(url)
+    return compute_embeddings_text(text)
+
+
+def compute_embeddings_text(text: str) -> list[float]:
+    """
+    Compute the embeddings of a text, shrunk to MAX_TOKENS tokens.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        list[float]: The embeddings of the text.
+    """
     text = get_text_truncated_tokenized(text, MAX_TOKENS)
 
     if (len(text) == 0):
-        raise Exception("Text extracted is empty.")
+        raise PermanentError("Text extracted is empty.", "empty_text")
+
+    # The same text may have been embedded for another post.
+    cached = get_cached_embeddings(MODEL_ID, text)
+    if cached is not None:
+        return cached
 
     # We compute the embeddings.
-    response = openai.Embedding.create(input=text, model=MODEL_ID, deployment_id=getenv("AZURE_DEPLOYMENT_ID"))[
-        'data'][0]['embedding']
+    EMBEDDING_API_INPUTS.inc()
+    response = call("embeddings", lambda: request_embeddings(text))[
+        0]['embedding']
 
+    set_cached_embeddings(MODEL_ID, text, response)
     return response
 
 
+def request_embeddings(input: str | list[str]) -> list:
+    """
+    Send a request to the embeddings API.
+    The errors worth retrying (rate limited, unavailable, timeout) are raised as UpstreamError.
+
+    Args:
+        input (str | list[str]): The text, or the texts, to embed.
+
+    Returns:
+        list: The data of the response, with the embedding and the index of each text.
+    """
+    try:
+        with timed(EMBEDDING_API_LATENCY, EMBEDDING_API_ERRORS):
+            return openai.Embedding.create(input=input, model=MODEL_ID,
+                                           deployment_id=getenv("AZURE_DEPLOYMENT_ID"))['data']
+    except (openai.error.RateLimitError, openai.error.ServiceUnavailableError, openai.error.APIConnectionError,
+            openai.error.Timeout, openai.error.TryAgain, openai.error.APIError) as e:
+        # The other API errors (4xx) won't succeed if retried.
+        if isinstance(e, openai.error.APIError) and (e.http_status or 500) < 500:
+            raise
+        raise UpstreamError(str(e), parse_retry_after(
+            e.headers.get("Retry-After") or e.headers.get("retry-after"))) from e
+
+
 def get_text(url: str) -> str:
+    """
+    Get the text of a URL from the cache, or extract it.
+
+    Args:
+        url (str): The URL of the article.
+    """
+    text = get_cached_text(url)
+    if text is not None:
+        return text
+
+    text = extract_text(url)
+    set_cached_text(url, text)
+    return text
+
+
+def extract_text(url: str) -> str:
     """
     Sort the type of URL and call the appropriate function to extract the text.
 
@@ -100,7 +234,8 @@ def get_text(url: str) -> str:
     parsed = urlparse(url)
 
     if (parsed.hostname == "www.youtube.com" or parsed.hostname == "youtube.com" or parsed.hostname == "youtu.be"):
-        return get_text_YouTube(url)
+        with timed(EXTRACTION_LATENCY, EXTRACTION_ERRORS, source="youtube"):
+            return get_text_YouTube(url)
 
     # We check if the URL is a PDF.
     # To do so, we send a HEAD request to the URL and check the Content-Type.
@@ -109,9 +244,14 @@ def get_text(url: str) -> str:
     # can be wrong (e.g. a PDF served without an extension).
 
     # We send a HEAD request to the URL.
-    response = requests.head(url, allow_redirects=True, proxies=proxies)
-
-    if response.status_code == 404 or response.status_code >= 500:
+    with timed(EXTRACTION_LATENCY, EXTRACTION_ERRORS, source="head"):
+        response = http_client.head(url, allow_redirects=True)
+
+    # A page that doesn't exist won't come back. A server error may be temporary.
+    if response.status_code in (404, 410):
+        raise PermanentError(
+            "Status code is not 200: {}".format(response.status_code), "not_found")
+    if response.status_code >= 500:
         raise Exception(
             "Status code is not 200: {}".format(response.status_code))
 
@@ -120,25 +260,29 @@ def get_text(url: str) -> str:
 
     # We check if the Content-Type is application/pdf.
     if response.headers["Content-Type"] == "application/pdf":
-        return get_text_pdf(url)
+        with timed(EXTRACTION_LATENCY, EXTRACTION_ERRORS, source="pdf"):
+            return get_text_pdf(url)
 
     # We check if the URL is an image.
     matching_types = ["image/jpeg", "image/png",
                       "image/gif", "image/webp", "image/tiff", "image/bmp"]
     if response.headers["Content-Type"] in matching_types:
         # We raise an exception because we can't compute embeddings from an image.
-        raise Exception("URL {} is an image. We can't extract text from an image.".format(
-            url))
+        EXTRACTION_ERRORS.labels("image").inc()
+        raise PermanentError("URL {} is an image. We can't extract text from an image.".format(
+            url), "image")
 
     # Before checking if a URL is an Arxiv article, we check if it's a PDF.
     # get_text_arxiv will modify the URL to get the PDF URL.
     # We don't want to modify the URL if it's already a PDF URL so we check before.
 
     if (parsed.hostname == "www.arxiv.org" or parsed.hostname == "arxiv.org"):
-        return get_text_Arxiv(url)
+        with timed(EXTRACTION_LATENCY, EXTRACTION_ERRORS, source="arxiv"):
+            return get_text_Arxiv(url)
 
     # If the URL didn't match any of the previous cases, we hope it's an article.
-    return get_text_Article(url)
+    with timed(EXTRACTION_LATENCY, EXTRACTION_ERRORS, source="article"):
+        return get_text_Article(url)
 
 
 def get_text_Article(url: str) -> str:
@@ -161,28 +305,58 @@ def get_text_Article(url: str) -> str:
         "Accept": "application/json",
     }
 
-    response = requests.get(
-        "https://api.diffbot.com/v3/article", params=params, headers=headers, proxies=proxies)
+    # Diffbot is rate limited: the request waits for its slot and is retried with a backoff.
+    response = call("diffbot", lambda: check_diffbot_response(http_client.get(
+        DIFFBOT_API_URL, params=params, headers=headers)))
 
     # We check if the request was successful.
     if (response.status_code != 200):
         raise Exception("Error while fetching the text of the article. Status code: {}".format(
             response.status_code))
 
+    # Diffbot couldn't extract the page (e.g. it doesn't exist or isn't an article).
+    # The transient errors were raised by check_diffbot_response.
     if "error" in response.json():
-        raise Exception("Error while fetching the text of the article: {}".format(
-            response.json()["error"]))
+        raise PermanentError("Error while fetching the text of the article: {}".format(
+            response.json()["error"]), "extraction")
 
     data = response.json()["objects"][0]
 
     # We check if the text is returned by the API.
     if ("text" not in data):
-        raise Exception("Error while fetching the text of the article: {}".format(
-            data["error"]))
+        raise PermanentError("Error while fetching the text of the article: {}".format(
+            data.get("error")), "extraction")
 
     return data["text"]
 
 
+def check_diffbot_response(response):
+    """
+    Raise a RetryableError if Diffbot couldn't fetch the page for a reason worth retrying.
+
+    Diffbot answers 200 with an errorCode when the extraction fails. 5xx codes (the site or
+    Diffbot timed out or failed) and 429 (the site rate limits Diffbot) are transient.
+    The other codes (e.g. 404, the page doesn't exist) are permanent and left to get_text_Article.
+
+    Args:
+        response (requests.Response): The response of the Article API.
+
+    Returns:
+        requests.Response: The response.
+    """
+    response = check_response(response)
+    if response.status_code != 200:
+        return response
+
+    data = response.json()
+    code = data.get("errorCode")
+    if "error" in data and isinstance(code, int) and (code >= 500 or code == 429):
+        # It's usually the site failing, not Diffbot: it doesn't count towards opening the circuit of Diffbot.
+        raise RetryableError("Diffbot error {} for {}: {}".format(
+            code, data.get("url"), data["error"]))
+    return response
+
+
 def get_text_YouTube(url: str) -> str:
 
     # ---------------------------- Parse the video ID ---------------------------- #
@@ -215,7 +389,7 @@ def get_text_YouTube(url: str) -> str:
         video_id = path[1:]
     else:
         # We raise an exception because we can't compute embeddings from a channel.
-        raise Exception("We can't extract text from this url: {}".format(url))
+        raise PermanentError("We can't extract text from this url: {}".format(url), "unsupported_url")
 
     # ---------------------------- Get the captions ---------------------------- #
     captions = YouTubeTranscriptApi.get_transcript(
@@ -229,23 +403,102 @@ def get_text_YouTube(url: str) -> str:
     return text
 
 
-def get_text_pdf(url: str) -> str:
+def get_text_pdf(url: str, max_tokens: int = MAX_TOKENS) -> str:
+    """
+    Extract the text of a PDF.
+
+    The PDF is streamed: it's kept in memory up to PDF_SPOOL_BYTES, and written to a temporary file above.
+    The download stops with an exception above PDF_MAX_BYTES.
+    Only the first pages are read, until there is enough text for max_tokens.
+
+    Args:
+        url (str): The URL of the PDF.
+        max_tokens (int): The number of tokens the text is truncated to afterwards.
+
+    Returns:
+        str: The text of the first pages.
+    """
 
-    # We download the PDF.
-    # We use the stream parameter to avoid loading the whole PDF in memory.
     # We use the timeout parameter to avoid waiting too long for the PDF.
-    response = requests.get(url, stream=True, timeout=15)
+    with http_client.get(url, stream=True, timeout=15) as response, \
+            NamedTemporaryFile(suffix=".pdf") as spool:
+        # We don't download a PDF we know is too large.
+        length = response.headers.get("Content-Length")
+        if length is not None and length.isdigit() and int(length) > PDF_MAX_BYTES:
+            raise PermanentError("The PDF is too large: {} bytes.".format(length), "pdf_too_large")
+
+        content = download_pdf(response, spool)
+
+        # We open the PDF from memory, or from the temporary file so MuPDF reads it lazily.
+        # We use the context manager to close the PDF automatically.
+        try:
+            if content is not None:
+                pdf = open_pdf(stream=content, filetype="pdf")
+            else:
+                pdf = open_pdf(spool.name, filetype="pdf")
+        except RuntimeError as e:
+            # MuPDF can't read the file: it's broken or not a PDF.
+            raise PermanentError("The PDF can't be opened: {}".format(e), "invalid_pdf") from e
+        with pdf:
+            return get_text_pages(pdf, max_tokens)
+
+
+def download_pdf(response, spool) -> bytes | None:
+    """
+    Download the body of a response, up to PDF_MAX_BYTES.
 
-    # We open the PDF.
-    # We use the context manager to close the PDF automatically.
-    with open_pdf(stream=response.content, filetype="pdf") as pdf:
-        # We get the text of the PDF.
-        text = ""
-        for page in pdf:
-            text += page.get_text()
+    Args:
+        response (requests.Response): The streamed response.
+        spool (file): The file the body is written to above PDF_SPOOL_BYTES.
 
-        # We return the text.
-        return text
+    Returns:
+        bytes | None: The body, or None if it was written to the spool.
+    """
+    buffer = bytearray()
+    size = 0
+    spooled = False
+    for chunk in response.iter_content(chunk_size=PDF_CHUNK_SIZE):
+        size += len(chunk)
+        if size > PDF_MAX_BYTES:
+            raise PermanentError(
+                "The PDF is too large: more than {} bytes.".format(PDF_MAX_BYTES), "pdf_too_large")
+
+        if spooled:
+            spool.write(chunk)
+            continue
+
+        buffer += chunk
+        if len(buffer) > PDF_SPOOL_BYTES:
+            spool.write(buffer)
+            buffer = bytearray()
+            spooled = True
+
+    if spooled:
+        spool.flush()
+        return None
+    return bytes(buffer)
+
+
+def get_text_pages(pdf, max_tokens: int) -> str:
+    """
+    Extract the text of the pages of a PDF until there is enough for max_tokens.
+
+    We read PDF_TOKENS_MARGIN tokens more than needed, so the last words of the text
+    are tokenized the same way as in the whole document and the truncated text doesn't change.
+    """
+    pages = []
+    characters = 0
+    for page in pdf:
+        pages.append(page.get_text())
+        characters += len(pages[-1])
+
+        # A token is almost never shorter than a character,
+        # so we only count the tokens once there are enough characters.
+        if characters >= max_tokens + PDF_TOKENS_MARGIN and \
+                len(enc.encode("".join(pages))) >= max_tokens + PDF_TOKENS_MARGIN:
+            break
+
+    return "".join(pages)
 
 
 def get_text_Arxiv(url: str) -> str:
@@ -267,25 +520,94 @@ def get_text_truncated_tokenized(text: str, max_tokens: int) -> str:
     Truncate a text to the desired number of tokens.
     It's to avoid excessive costs when computing embeddings.
 
+    Only a prefix of the text is tokenized, so the cost depends on max_tokens
+    and not on the length of the text. The result is the same as tokenizing the whole text.
+
     Args:
         text (str): The text to truncate.
         max_tokens (int): The maximum number of tokens in cl100k_base
 
     """
-    # We tokenize the text.
-    tokens = enc.encode(text)
+    length = max_tokens * TRUNCATE_CHARS_PER_TOKEN
+    while True:
+        prefix = get_prefix_untouched(text, length)
+        if prefix is not None:
+            tokens = enc.encode(prefix)
+            if len(tokens) >= max_tokens or len(prefix) == len(text):
+                return decode_truncated(tokens[:max_tokens])
+
+        # The prefix is too short, we try again with a longer one.
+        length *= 2
+
+
+def get_texts_truncated_tokenized(texts: list[str], max_tokens: int, num_threads: int = 8) -> list[str]:
+    """
+    Truncate many texts to the desired number of tokens.
+
+    The prefixes are tokenized with tiktoken's encode_batch, which uses num_threads threads.
+
+    Args:
+        texts (list[str]): The texts to truncate.
+        max_tokens (int): The maximum number of tokens in cl100k_base
+        num_threads (int): The number of threads tokenizing the prefixes.
+
+    Returns:
+        list[str]: The truncated texts, in the same order.
+    """
+    results = [""] * len(texts)
+    pending = list(range(len(texts)))
+    length = max_tokens * TRUNCATE_CHARS_PER_TOKEN
+
+    while len(pending) > 0:
+        prefixes = {i: get_prefix_untouched(texts[i], length) for i in pending}
+        batch = [i for i in pending if prefixes[i] is not None]
+        pending = [i for i in pending if prefixes[i] is None]
+
+        tokenized = enc.encode_batch(
+            [prefixes[i] for i in batch], num_threads=num_threads)
+        for i, tokens in zip(batch, tokenized):
+            if len(tokens) >= max_tokens or len(prefixes[i]) == len(texts[i]):
+                results[i] = decode_truncated(tokens[:max_tokens])
+            else:
+                pending.append(i)
+
+        length *= 2
+
+    return results
+
+
+def get_prefix_untouched(text: str, length: int) -> str | None:
+    """
+    Get the longest prefix of a text, of at most length characters, whose tokens are
+    the first tokens of the whole text.
+
+    cl100k_base splits the text with a regular expression before merging the bytes.
+    No piece contains a non-space character followed by a space, and the pieces before
+    such a space don't depend on the characters after it.
+    So we cut the text just before a space preceded by a non-space character.
+
+    Returns:
+        str | None: The prefix, or None if there is no such space in the first length characters.
+    """
+    if length >= len(text):
+        return text
 
-    # We truncate the tokens.
-    tokens = tokens[:max_tokens]
+    end = text.rfind(" ", 1, length)
+    while end > 0 and text[end - 1].isspace():
+        end = text.rfind(" ", 1, end)
 
-    # We decode the tokens.
+    return text[:end] if end > 0 else None
+
+
+def decode_truncated(tokens: list[int]) -> str:
+    """
+    Decode the tokens of a truncated text.
+    """
     text = enc.decode(tokens)
 
     # As stated here: https://learn.microsoft.com/en-us/azure/cognitive-services/openai/reference#embeddings
     # It's best to replace newlines with spaces.
-    text = text.replace("\n", " ")
-
-    return text
+    return text.replace("\n", " ")
 
 
 if __name__ == "__main__":
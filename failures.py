@@ -0,0 +1,208 @@
+from persistence import rPost
+from rate_limit import RetryableError
+from metrics import EMBEDDING_FAILURES
+from youtube_transcript_api import VideoUnavailable, InvalidVideoId, TranscriptsDisabled, \
+    NoTranscriptAvailable, NoTranscriptFound
+from rq.timeouts import JobTimeoutException
+from os import getenv
+import requests
+import time
+import sys
+
+"""
+The failures of the embeddings of the stories, and when to retry them.
+
+When a story can't be embedded, we record its status in the hash failure:<id> of the posts database:
+- kind: permanent (it will fail again: no URL, an image, a 404, no transcript, an empty text...)
+  or transient (the upstream is failing, a timeout...).
+- reason: the cause of the failure, e.g. image or timeout.
+- attempts: the number of failed attempts.
+- next_retry: the timestamp after which a transient failure can be retried.
+- error: the message of the exception.
+
+poll_post_for_embedding skips the permanent failures and the transient ones not due yet,
+with the same pipeline that checks if the embeddings exist. The delay between two attempts doubles
+from FAILURE_RETRY_BASE, and a story failing FAILURE_MAX_ATTEMPTS times becomes a permanent failure.
+Writing the embeddings of a story clears its failure.
+
+The number of stories by kind and reason is kept in the hash failures:count.
+
+Usage:
+    python failures.py                 # Print the number of failed stories by kind and reason.
+    python failures.py reset [reason]  # Retry the permanent failures (of a reason) at the next poll.
+"""
+
+# The hash of the number of failed stories, by "<kind>:<reason>".
+FAILURE_COUNTS_KEY = "failures:count"
+# The delay in seconds before retrying a transient failure for the first time.
+FAILURE_RETRY_BASE = int(getenv("FAILURE_RETRY_BASE", "3600"))
+# The maximum delay in seconds between two attempts (one week).
+FAILURE_RETRY_MAX = int(getenv("FAILURE_RETRY_MAX", str(7 * 24 * 3600)))
+# The number of failed attempts after which a transient failure becomes permanent.
+FAILURE_MAX_ATTEMPTS = int(getenv("FAILURE_MAX_ATTEMPTS", "8"))
+# The maximum number of characters of the error message stored.
+FAILURE_MESSAGE_LENGTH = 200
+
+PERMANENT = "permanent"
+TRANSIENT = "transient"
+
+# The transcripts that don't exist, whatever the number of attempts.
+MISSING_TRANSCRIPT_ERRORS = (VideoUnavailable, InvalidVideoId, TranscriptsDisabled,
+                             NoTranscriptAvailable, NoTranscriptFound)
+
+# Record a failure, move the story between the counts and return the next retry time.
+# A transient failure becomes permanent after ARGV[7] attempts.
+RECORD_SCRIPT = """
+local previous = redis.call("HMGET", KEYS[1], "kind", "reason", "attempts")
+local attempts = tonumber(previous[3] or "0") + 1
+local kind = ARGV[1]
+if kind == "transient" and attempts >= tonumber(ARGV[7]) then
+    kind = "permanent"
+end
+
+local next_retry = 0
+if kind == "transient" then
+    next_retry = tonumber(ARGV[4]) + math.min(tonumber(ARGV[6]), tonumber(ARGV[5]) * 2 ^ (attempts - 1))
+end
+
+if previous[1] then
+    redis.call("HINCRBY", KEYS[2], previous[1] .. ":" .. previous[2], -1)
+end
+redis.call("HINCRBY", KEYS[2], kind .. ":" .. ARGV[2], 1)
+redis.call("HSET", KEYS[1], "kind", kind, "reason", ARGV[2], "attempts", attempts,
+           "next_retry", next_retry, "error", ARGV[3], "time", ARGV[4])
+return {kind, tostring(next_retry)}
+"""
+
+# Delete the failure of a story and remove it from the counts.
+CLEAR_SCRIPT = """
+local previous = redis.call("HMGET", KEYS[1], "kind", "reason")
+if not previous[1] then
+    return 0
+end
+redis.call("HINCRBY", KEYS[2], previous[1] .. ":" .. previous[2], -1)
+return redis.call("DEL", KEYS[1])
+"""
+
+record_script = rPost.register_script(RECORD_SCRIPT)
+clear_script = rPost.register_script(CLEAR_SCRIPT)
+
+
+class PermanentError(Exception):
+    """
+    A story that can't be embedded, however many times it's retried.
+
+    Args:
+        reason (str): The cause of the failure, e.g. image or not_found.
+    """
+
+    def __init__(self, message: str, reason: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+def classify(error: BaseException) -> tuple[str, str]:
+    """
+    Sort a failure between permanent and transient, and give its reason.
+
+    Returns:
+        tuple[str, str]: The kind (permanent or transient) and the reason.
+    """
+    if isinstance(error, PermanentError):
+        return PERMANENT, error.reason
+    if isinstance(error, MISSING_TRANSCRIPT_ERRORS):
+        return PERMANENT, "no_transcript"
+    if isinstance(error, RetryableError):
+        return TRANSIENT, "upstream"
+    if isinstance(error, (requests.Timeout, JobTimeoutException, TimeoutError)):
+        return TRANSIENT, "timeout"
+    if isinstance(error, (requests.ConnectionError, ConnectionError)):
+        return TRANSIENT, "connection"
+    # We don't know: we retry it, until it becomes permanent after FAILURE_MAX_ATTEMPTS.
+    return TRANSIENT, "error"
+
+
+def failure_key(id: str) -> str:
+    return "failure:{}".format(id)
+
+
+def record_failure(id: str, error: BaseException) -> tuple[str, float]:
+    """
+    Record that the embeddings of a story failed.
+
+    Args:
+        id (str): The ID of the story, without the "hn:" prefix.
+        error (BaseException): The exception raised.
+
+    Returns:
+        tuple[str, float]: The kind of the failure and the timestamp of the next retry (0 if never).
+    """
+    kind, reason = classify(error)
+    kind, next_retry = record_script(keys=[failure_key(id), FAILURE_COUNTS_KEY],
+                                     args=[kind, reason, str(error)[:FAILURE_MESSAGE_LENGTH], int(time.time()),
+                                           FAILURE_RETRY_BASE, FAILURE_RETRY_MAX, FAILURE_MAX_ATTEMPTS])
+    kind = kind.decode("utf-8")
+    EMBEDDING_FAILURES.labels(kind, reason).inc()
+    print("Embeddings of story {} failed ({}, {}): {}".format(
+        id, kind, reason, error))
+    return kind, float(next_retry)
+
+
+def clear_failure(pipe, id: str):
+    """
+    Add the deletion of the failure of a story to a pipeline, once its embeddings are written.
+
+    Args:
+        pipe (redis.client.Pipeline): A pipeline of rPost.
+        id (str): The ID of the story, without the "hn:" prefix.
+    """
+    clear_script(keys=[failure_key(id), FAILURE_COUNTS_KEY], client=pipe)
+
+
+def is_retry_due(kind: bytes | None, next_retry: bytes | None, now: float) -> bool:
+    """
+    Check if a story can be embedded, from the kind and the next_retry fields of its failure.
+    A story without failure is always due.
+    """
+    if kind is None:
+        return True
+    if kind.decode("utf-8") == PERMANENT:
+        return False
+    return float(next_retry or 0) <= now
+
+
+def get_failure_counts() -> dict[str, int]:
+    """
+    Get the number of failed stories by "<kind>:<reason>".
+    """
+    counts = rPost.hgetall(FAILURE_COUNTS_KEY)
+    return {key.decode("utf-8"): int(value) for key, value in counts.items() if int(value) > 0}
+
+
+def reset_failures(reason: str = None) -> int:
+    """
+    Delete the permanent failures, e.g. after fixing the extraction of a kind of URL.
+    The stories are enqueued again at the next poll.
+
+    Args:
+        reason (str): Only reset the failures of this reason.
+
+    Returns:
+        int: The number of failures deleted.
+    """
+    reset = 0
+    for key in rPost.scan_iter(match=failure_key("*"), count=1000):
+        kind, key_reason = rPost.hmget(key, "kind", "reason")
+        if kind != PERMANENT.encode("utf-8") or (reason is not None and key_reason != reason.encode("utf-8")):
+            continue
+        reset += clear_script(keys=[key, FAILURE_COUNTS_KEY])
+    return reset
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "reset":
+        reason = sys.argv[2] if len(sys.argv) > 2 else None
+        print("Reset {} permanent failures.".format(reset_failures(reason)))
+    else:
+        for key, count in sorted(get_failure_counts().items(), key=lambda item: -item[1]):
+            print("{:>40}: {}".format(key, count))
@@ -1,40 +1,226 @@
-import requests
+import asyncio
+from collections import Counter
+import aiohttp
+import http_client
+import time
 from time import sleep
-from persistence import rPost
-from retry import retry
+from persistence import rPost, redis_connection_queue, StoryWriter, log_change, index_story, storage
+from metrics import timed, job, HN_API_LATENCY, HN_API_ERRORS
+from rate_limit import call, check_response, reserve, reserve_async, get_interval, record_requests, backoff_delay, parse_retry_after, RetryableError, RETRYABLE_STATUSES
+from http_client import proxies
 from os import getenv
 
-proxies = {
-    'http': getenv("PROXY_URL_USA"),
-    'https': getenv("PROXY_URL_USA"),
-}
+# The base URL of the Hacker News API.
+# It can be overridden to point the scraper to a local stub server.
+HN_API_URL = getenv("HN_API_URL", "https://hacker-news.firebaseio.com/v0")
 
-# We define a decorator to retry the function in case of failure.
+# The maximum number of requests in flight when fetching items in batch.
+FETCH_CONCURRENCY = int(getenv("HN_FETCH_CONCURRENCY", "50"))
+# The number of attempts to fetch an item in batch before giving up.
+FETCH_TRIES = 5
+# The number of attempts to fetch a single item. A new item may not be available right after maxitem.
+FETCH_POST_TRIES = 10
+# The timeout in seconds of a request to the API.
+FETCH_TIMEOUT = 10
+
+# The highest ID of the ranges ingested, in the queue database.
+# The ingestion lag is the max ID of Hacker News minus this ID.
+INGESTED_ID_KEY = "max:ID:ingested:hn"
+
+# Set a key to a number only if it's higher than its current value.
+SET_MAX_SCRIPT = """
+if tonumber(ARGV[1]) > tonumber(redis.call("GET", KEYS[1]) or "0") then
+    redis.call("SET", KEYS[1], ARGV[1])
+end
+return 0
+"""
 
 
-@retry(tries=10, delay=1)
 def fetch_post_hn(id: str) -> dict:
     """
     Fetch a story from Hacker News.
+    The request is rate limited and retried with a backoff (see rate_limit.py).
 
     Returns:
         dict: A story object.
     """
-    story_url = 'https://hacker-news.firebaseio.com/v0/item/{}.json'.format(
-        id)
-    story = requests.get(story_url, proxies=proxies).json()
-    if type(story) is not dict:
-        raise Exception("Story {} is not a dictionary.".format(id))
+    story_url = '{}/item/{}.json'.format(HN_API_URL, id)
+
+    def fetch() -> dict:
+        with timed(HN_API_LATENCY, HN_API_ERRORS, endpoint="item"):
+            story = check_response(http_client.get(story_url)).json()
+        if type(story) is not dict:
+            raise RetryableError("Story {} is not a dictionary.".format(id))
+
+        # Check if the story has all the required fields.
+        required_fields = ["type"]
+        for field in required_fields:
+            if field not in story:
+                raise RetryableError(
+                    "Story {} is missing field {}.".format(id, field))
+
+        return story
+
+    return call("hn", fetch, FETCH_POST_TRIES)
+
+
+async def fetch_post_hn_async(session: aiohttp.ClientSession, id: int, start_at: float = 0,
+                              attempts: Counter = None) -> dict | None:
+    """
+    Fetch an item from Hacker News using a shared aiohttp session.
+
+    Unlike fetch_post_hn, we don't raise when the item can't be fetched
+    because one bad item must not fail the whole batch.
+
+    The first request uses the slot reserved for the batch by fetch_posts_hn.
+    A failure of the upstream is recorded at once, with the requests sent since the last one,
+    so the circuit can open during the batch.
+    Once a request of the batch has failed, every request reserves a new slot of the rate limit
+    and waits for it: the retries of all the workers are spaced by the shared limiter,
+    and wait while the circuit is open, instead of being sent in lockstep.
+
+    Args:
+        session (aiohttp.ClientSession): The session holding the connection pool.
+        id (int): The ID of the item.
+        start_at (float): The time of the event loop of the slot reserved in the rate limit.
+        attempts (Counter): Counts the requests not recorded yet in the circuit, and the failures.
+
+    Returns:
+        dict | None: The item, or None if it couldn't be fetched.
+    """
+    delay = start_at - asyncio.get_running_loop().time()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+    if attempts is None:
+        attempts = Counter()
+
+    story_url = '{}/item/{}.json'.format(HN_API_URL, id)
+    for attempt in range(FETCH_TRIES):
+        if attempt > 0 or attempts["failures"] > 0:
+            delay = await reserve_async("hn")
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        retry_after = None
+        try:
+            with timed(HN_API_LATENCY, HN_API_ERRORS, endpoint="item"):
+                async with session.get(story_url, proxy=proxies["https"]) as response:
+                    if response.status in RETRYABLE_STATUSES:
+                        retry_after = parse_retry_after(
+                            response.headers.get("Retry-After"))
+                        raise aiohttp.ClientResponseError(
+                            response.request_info, (), status=response.status)
+                    story = await response.json(content_type=None)
+            attempts["unrecorded"] += 1
+            if type(story) is dict and "type" in story:
+                return story
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            # The upstream is failing, not only this item.
+            attempts["failures"] += 1
+            unrecorded = attempts["unrecorded"]
+            attempts["unrecorded"] = 0
+            await asyncio.to_thread(record_requests, "hn", unrecorded + 1, 1)
+        except ValueError:
+            attempts["unrecorded"] += 1
+        await asyncio.sleep(backoff_delay(attempt, retry_after))
+
+    print("Item {} could not be fetched.".format(id))
+    return None
+
+
+async def fetch_posts_hn_async(ids: list[int], concurrency: int = FETCH_CONCURRENCY,
+                               delay: float = 0, interval: float = 0, attempts: Counter = None) -> dict[int, dict]:
+    """
+    Fetch many items from Hacker News concurrently.
+
+    All the requests share the same connection pool so we only pay the TCP/TLS
+    handshake once per connection. The pool size bounds the number of requests in flight.
+
+    Args:
+        ids (list[int]): The IDs of the items.
+        concurrency (int): The maximum number of requests in flight.
+        delay (float): The time in seconds before the first slot reserved in the rate limit.
+        interval (float): The time in seconds between two slots.
+        attempts (Counter): Counts the requests sent and the failures of the upstream.
+
+    Returns:
+        dict[int, dict]: The items fetched, indexed by ID. Items that couldn't be fetched are missing.
+    """
+    start = asyncio.get_running_loop().time() + delay
+    connector = aiohttp.TCPConnector(limit=concurrency, keepalive_timeout=30)
+    timeout = aiohttp.ClientTimeout(total=FETCH_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        stories = await asyncio.gather(
+            *[fetch_post_hn_async(session, id, start + i * interval, attempts) for i, id in enumerate(ids)])
+
+    return {id: story for id, story in zip(ids, stories) if story is not None}
+
 
-    # Check if the story has all the required fields.
-    required_fields = ["type"]
+def fetch_posts_hn(ids: list[int], concurrency: int = FETCH_CONCURRENCY) -> dict[int, dict]:
+    """
+    Synchronous wrapper around fetch_posts_hn_async for RQ jobs.
+    It also reports the throughput of the batch.
+
+    The slots of all the requests are reserved at once in the rate limit,
+    and the requests are spaced evenly over them.
+
+    Args:
+        ids (list[int]): The IDs of the items.
+        concurrency (int): The maximum number of requests in flight.
+
+    Returns:
+        dict[int, dict]: The items fetched, indexed by ID.
+    """
+    before = time.time()
+    delay = reserve("hn", len(ids))
+    attempts = Counter()
+    stories = asyncio.run(fetch_posts_hn_async(
+        ids, concurrency, delay, get_interval("hn"), attempts))
+    # The failures were recorded as they happened: only the last requests are left.
+    record_requests("hn", attempts["unrecorded"], 0)
+    elapsed = time.time() - before
+    print("Fetched {} items out of {} in {} ms ({:.1f} items/s).".format(
+        len(stories), len(ids), elapsed * 1000, len(ids) / elapsed if elapsed > 0 else 0))
+    return stories
+
+
+def parse_story(id: str, story: dict) -> dict | None:
+    """
+    Convert an item from the Hacker News API to the mapping stored in Redis.
+
+    Args:
+        id (str): The ID of the post
+        story (dict): The item returned by the API.
+
+    Returns:
+        dict | None: The mapping to store, or None if the item is not a story
+        or is missing required fields.
+    """
+    # We check if the item is a story.
+    # We don't print anything here because most items are comments.
+    if story["type"] != "story":
+        return None
+
+    # We check if the story has all the required fields.
+    required_fields = ["by", "title", "score", "time", "descendants"]
     for field in required_fields:
         if field not in story:
-            raise Exception("Story {} is missing field {}.".format(id, field))
+            print("Story {} is missing field {}.".format(id, field))
+            return None
 
-    return story
+    return {
+        "by": story["by"],
+        "title": story["title"],
+        # We check if the story has a URL. If not, we set it to an empty string.
+        "url": story["url"] if "url" in story else "",
+        "score": story["score"],
+        "time": story["time"],
+        "comments": story["descendants"],
+    }
 
 
+@job("add_story")
 def add_story_redis(id: str):
     """
     Fetch an item from Hacker News and add it to Redis.
@@ -55,32 +241,93 @@ def add_story_redis(id: str):
         print("Item {} is not a story.".format(id))
         return
 
-    # We check if the story has all the required fields.
-    required_fields = ["by", "title", "score", "time", "descendants"]
-    for field in required_fields:
-        if field not in story:
-            print("Story {} is missing field {}.".format(id, field))
-            return
+    mapping = parse_story(id, story)
+    if mapping is None:
+        return
 
-    # We check if the story is already in Redis.
-    storyAlreadyInRedis: bool = rPost.exists(id) >= 1
+    # We read the URL stored, to remove the story from the index of its old URL if it changed.
+    old_url = storage.read_posts([int(id)], ("url",))[0][0]
 
     # We add the story to Redis.
-    mapping = {
-        "by": story["by"],
-        "title": story["title"],
-        # We check if the story has a URL. If not, we set it to an empty string.
-        "url": story["url"] if "url" in story else "",
-        "score": story["score"],
-        "time": story["time"],
-        "comments": story["descendants"],
+    pipe = rPost.pipeline(transaction=False)
+    storage.write_story(pipe, id, mapping)
+    log_change(pipe, id)
+    index_story(pipe, id, mapping, old_url)
+    pipe.execute()
 
-    }
 
-    redisPostID = "hn:{}".format(id)
+@job("add_story_range")
+def add_story_range_redis(start: int, end: int):
+    """
+    Fetch all the items in the range [start, end) from Hacker News
+    and add the stories to Redis.
+
+    It replaces one add_story_redis job per ID when we have to catch up
+    with a lot of IDs: the items are fetched concurrently over a shared connection pool.
 
-    # We add the story to Redis.
-    rPost.hset(redisPostID, mapping=mapping)
+    Args:
+        start (int): The first ID of the range.
+        end (int): The ID after the last ID of the range.
+    """
+    ingest_range(start, end)
+
+    # The ranges don't finish in order, so we only keep the highest ID.
+    redis_connection_queue.eval(SET_MAX_SCRIPT, 1, INGESTED_ID_KEY, end - 1)
+
+
+@job("add_stories")
+def add_stories_redis(ids: list[int], end: int):
+    """
+    Fetch a list of stories from Hacker News and add them to Redis.
+
+    The pre-filter of pollNewStory enqueues it with the IDs of the newstories list:
+    the other IDs of the range are not stories, so they're not fetched.
+
+    Args:
+        ids (list[int]): The IDs of the stories.
+        end (int): The ID after the range the stories were picked from.
+    """
+    ingest_ids(ids)
+
+    # The ranges don't finish in order, so we only keep the highest ID.
+    redis_connection_queue.eval(SET_MAX_SCRIPT, 1, INGESTED_ID_KEY, end - 1)
+
+
+def ingest_range(start: int, end: int) -> int:
+    """
+    Fetch the items in the range [start, end) and write the stories to Redis.
+    Used by the range jobs of the live polling and by the backfill.
+
+    Returns:
+        int: The number of stories written.
+    """
+    written = ingest_ids(list(range(start, end)))
+    print("Added {} stories from range {} - {}.".format(
+        written, start, end - 1))
+    return written
+
+
+def ingest_ids(ids: list[int]) -> int:
+    """
+    Fetch items and write the stories to Redis.
+
+    Returns:
+        int: The number of stories written.
+    """
+    stories = fetch_posts_hn(ids)
+
+    # The stories are written in a single pipeline instead of one HSET per story.
+    with StoryWriter() as writer:
+        for id, story in stories.items():
+            mapping = parse_story(id, story)
+            if mapping is None:
+                continue
+
+            writer.add(id, mapping)
+
+    print("Added {} stories out of {} items in {} round trips.".format(
+        writer.written, len(ids), writer.round_trips))
+    return writer.written
 
 
 def get_max_id_HN() -> int:
@@ -90,7 +337,43 @@ def get_max_id_HN() -> int:
     Returns:
         int: The max ID.
     """
-    max_id = requests.get(
-        'https://hacker-news.firebaseio.com/v0/maxitem.json', proxies=proxies).json()
+    def fetch() -> int:
+        with timed(HN_API_LATENCY, HN_API_ERRORS, endpoint="maxitem"):
+            return check_response(http_client.get('{}/maxitem.json'.format(HN_API_URL))).json()
+
+    max_id = call("hn", fetch)
     # We convert the ID to an integer in case of the API returning a string.
     return int(max_id)
+
+
+def get_list_HN(name: str) -> list[int]:
+    """
+    Get a list of story IDs from Hacker News.
+
+    Args:
+        name (str): The name of the list: topstories, newstories or beststories.
+
+    Returns:
+        list[int]: The IDs, ranked as on Hacker News.
+    """
+    def fetch() -> list:
+        with timed(HN_API_LATENCY, HN_API_ERRORS, endpoint=name):
+            return check_response(http_client.get('{}/{}.json'.format(HN_API_URL, name))).json()
+
+    ids = call("hn", fetch)
+    return [int(id) for id in ids]
+
+
+def get_updates_HN() -> list[int]:
+    """
+    Get the IDs of the items that changed recently on Hacker News.
+
+    Returns:
+        list[int]: The IDs of the items changed.
+    """
+    def fetch() -> dict:
+        with timed(HN_API_LATENCY, HN_API_ERRORS, endpoint="updates"):
+            return check_response(http_client.get('{}/updates.json'.format(HN_API_URL))).json()
+
+    updates = call("hn", fetch)
+    return [int(id) for id in updates["items"]]
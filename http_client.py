@@ -0,0 +1,80 @@
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from threading import BoundedSemaphore, Lock
+from os import getenv
+import requests
+
+"""
+The HTTP client shared by all the fetchers (Hacker News, Diffbot, PDFs, etc.).
+
+The requests go through a single session, so the connections are kept alive
+and reused: there is one pool of connections per host.
+Every request has a connect and a read timeout, so a slow origin can't block
+a worker until RQ kills the job.
+The number of requests in flight to the same host is limited per process.
+"""
+
+# We define the proxies to use.
+proxies = {
+    'http': getenv("PROXY_URL_USA"),
+    'https': getenv("PROXY_URL_USA"),
+}
+
+# The time in seconds to establish a connection.
+CONNECT_TIMEOUT = float(getenv("HTTP_CONNECT_TIMEOUT", "5"))
+# The maximum time in seconds between two bytes received.
+READ_TIMEOUT = float(getenv("HTTP_READ_TIMEOUT", "30"))
+# The number of connections kept alive per host.
+POOL_SIZE = int(getenv("HTTP_POOL_SIZE", "10"))
+# The number of hosts whose connections are kept alive.
+POOL_HOSTS = 100
+# The maximum number of requests in flight to the same host.
+HOST_CONCURRENCY = int(getenv("HTTP_HOST_CONCURRENCY", "10"))
+
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE)
+session.mount("http://", adapter)
+session.mount("https://", adapter)
+
+# A semaphore per host to limit the requests in flight.
+host_limits: dict[str, BoundedSemaphore] = {}
+host_limits_lock = Lock()
+
+
+def get_host_limit(url: str) -> BoundedSemaphore:
+    """
+    Get the semaphore limiting the requests in flight to the host of a URL.
+    """
+    host = urlparse(url).hostname or ""
+    with host_limits_lock:
+        if host not in host_limits:
+            host_limits[host] = BoundedSemaphore(HOST_CONCURRENCY)
+        return host_limits[host]
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Send a request through the shared session.
+
+    The timeout and the proxies can be overridden with the arguments of requests.request.
+    With stream=True, the host limit only covers the request until the headers are received.
+
+    Args:
+        method (str): The HTTP method.
+        url (str): The URL.
+
+    Returns:
+        requests.Response: The response.
+    """
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    kwargs.setdefault("proxies", proxies)
+    with get_host_limit(url):
+        return session.request(method, url, **kwargs)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+
+def head(url: str, **kwargs) -> requests.Response:
+    return request("HEAD", url, **kwargs)
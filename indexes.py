@@ -0,0 +1,133 @@
+from persistence import rPost, index_story, SCORE_INDEX_KEY, TIME_INDEX_KEY, NEEDS_EMBEDDING_KEY, URL_INDEX_KEY, \
+    KNOWN_STORIES_KEY
+from scan import scan_posts, SCAN_WORKERS
+from urls import canonicalize_url
+import time
+import sys
+
+"""
+Secondary indexes of the stories, to find them without reading every post.
+
+Every write of a story (add_story_redis, StoryWriter) updates, in the same pipeline:
+- idx:score: a sorted set of the IDs by score.
+- idx:time: a sorted set of the IDs by time of submission.
+- idx:needs_embedding: a sorted set of the IDs of the stories with a URL and without embeddings, by score.
+  set_embeddings removes the story from it. So the stories to embed above a score are a single ZRANGEBYSCORE.
+- idx:url: a hash of the IDs of the stories of each canonical URL, to find the duplicates.
+  The writes pass the URL stored before them: a story whose URL changed is removed from its old URL,
+  and a story without URL anymore from idx:needs_embedding.
+- idx:stories: a bitmap of the IDs of the stories, so the ingestion skips the stories already stored.
+
+The stories written before the indexes must be indexed once with `python indexes.py rebuild`.
+Until a rebuild has finished (idx:ready), the readers fall back to a scan of the posts.
+
+Usage:
+    python indexes.py            # Print the size of the indexes.
+    python indexes.py rebuild    # Rebuild the indexes from the posts.
+    python indexes.py url <url>  # Print the IDs of the stories of a URL.
+"""
+
+# Set at the end of a rebuild: the indexes hold every story.
+INDEX_READY_KEY = "idx:ready"
+# The number of stories indexed in a single pipeline during a rebuild.
+REBUILD_BATCH_SIZE = 1000
+
+
+def is_index_ready() -> bool:
+    return rPost.exists(INDEX_READY_KEY) > 0
+
+
+def index_posts(ids: list[int], rows: list[list[bytes]]) -> int:
+    """
+    Index the posts of a range during a rebuild.
+    It runs in the workers of scan_posts.
+
+    Args:
+        ids (list[int]): The IDs of the posts.
+        rows (list[list[bytes]]): The score, the time and the URL of each post.
+
+    Returns:
+        int: The number of stories indexed.
+    """
+    indexed = 0
+    pipe = rPost.pipeline(transaction=False)
+    for id, (score, submitted, url) in zip(ids, rows):
+        # A post without score or time is not a complete story.
+        if score is None or submitted is None:
+            continue
+
+        index_story(pipe, str(id), {"score": int(score), "time": int(submitted),
+                                    "url": url.decode("utf-8") if url is not None else ""})
+        indexed += 1
+        if indexed % REBUILD_BATCH_SIZE == 0:
+            pipe.execute()
+
+    pipe.execute()
+    return indexed
+
+
+def rebuild_indexes(workers: int = SCAN_WORKERS) -> int:
+    """
+    Rebuild the indexes from all the posts.
+
+    The indexes are dropped first, so the readers scan the posts until the rebuild ends.
+    The stories written during the rebuild are indexed by their write.
+
+    Args:
+        workers (int): The number of processes reading Redis.
+
+    Returns:
+        int: The number of stories indexed.
+    """
+    rPost.delete(INDEX_READY_KEY)
+    # UNLINK frees the memory in the background: the indexes may be large.
+    rPost.unlink(SCORE_INDEX_KEY, TIME_INDEX_KEY,
+                 NEEDS_EMBEDDING_KEY, URL_INDEX_KEY, KNOWN_STORIES_KEY)
+
+    indexed = sum(scan_posts(("score", "time", "url"), index_posts, workers))
+    rPost.set(INDEX_READY_KEY, int(time.time()))
+    return indexed
+
+
+def get_ids_needing_embedding(min_score: int) -> list[int]:
+    """
+    Get the IDs of the stories without embeddings whose score is at least min_score.
+    The index may still hold a few stories embedded meanwhile: the caller checks them.
+
+    Returns:
+        list[int]: The IDs, from the highest score.
+    """
+    return [int(id) for id in rPost.zrevrangebyscore(NEEDS_EMBEDDING_KEY, "+inf", min_score)]
+
+
+def get_ids_by_url(url: str) -> list[int]:
+    """
+    Get the IDs of the stories of a URL, or of any URL with the same canonical URL.
+
+    Returns:
+        list[int]: The IDs, in the order they were indexed.
+    """
+    ids = rPost.hget(URL_INDEX_KEY, canonicalize_url(url))
+    return [int(id) for id in ids.split()] if ids is not None else []
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "rebuild":
+        before = time.time()
+        indexed = rebuild_indexes()
+        print("Indexed {} stories in {:.1f} s.".format(
+            indexed, time.time() - before))
+    elif len(sys.argv) > 2 and sys.argv[1] == "url":
+        print(get_ids_by_url(sys.argv[2]))
+    else:
+        pipe = rPost.pipeline(transaction=False)
+        pipe.zcard(SCORE_INDEX_KEY)
+        pipe.zcard(TIME_INDEX_KEY)
+        pipe.zcard(NEEDS_EMBEDDING_KEY)
+        pipe.hlen(URL_INDEX_KEY)
+        pipe.bitcount(KNOWN_STORIES_KEY)
+        pipe.get(INDEX_READY_KEY)
+        scores, times, needs, urls, known, ready = pipe.execute()
+        print("Stories by score: {}, by time: {}, to embed: {}, URLs: {}, known: {}.".format(
+            scores, times, needs, urls, known))
+        print("Ready: {}".format("yes" if ready is not None else "no, run `python indexes.py rebuild`"))
@@ -1,12 +1,40 @@
 from polling import pollNewStory
+from refresh import pollHotStories, REFRESH_INTERVAL
+from polling_embedding import poll_post_for_embedding
+from scheduler import Scheduler, PeriodicTask
+from metrics import start_metrics_server
+from persistence import observe_queues
+from cdc import poll_updates, CDC_INTERVAL
+
+# The interval in seconds between two polls of new stories.
+NEW_STORY_INTERVAL = 10
+# The interval in seconds between two scans for posts to embed.
+EMBEDDING_INTERVAL = 3600
+# The interval in seconds between two updates of the metrics of the queues.
+QUEUE_METRICS_INTERVAL = 15
 
 
 def main():
     """
     Main function of the scraper.
     """
-    # We start the polling.
-    pollNewStory()
+    start_metrics_server()
+    tasks = [
+        # We poll the new stories.
+        PeriodicTask("new stories", pollNewStory, NEW_STORY_INTERVAL, 2),
+        # We refresh the stories already fetched.
+        PeriodicTask("hot stories", pollHotStories, REFRESH_INTERVAL, 10),
+        # We look for posts to compute embeddings for.
+        PeriodicTask("embeddings", poll_post_for_embedding,
+                     EMBEDDING_INTERVAL, 300),
+        # We measure the depth and the age of the queues.
+        PeriodicTask("queues", observe_queues, QUEUE_METRICS_INTERVAL, 1),
+    ]
+    # We apply the changes of the updates feed, if enabled.
+    if CDC_INTERVAL > 0:
+        tasks.append(PeriodicTask("updates", poll_updates, CDC_INTERVAL, 10))
+    scheduler = Scheduler(tasks)
+    scheduler.run()
 
 
 if __name__ == "__main__":
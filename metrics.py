@@ -0,0 +1,145 @@
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, start_http_server
+from prometheus_client import multiprocess
+from contextlib import contextmanager
+from functools import wraps
+from os import getenv
+import time
+
+"""
+The metrics of the scraper, in the Prometheus format.
+
+Each process serves its metrics over HTTP on METRICS_PORT (start_metrics_server).
+The RQ workers run several processes: set PROMETHEUS_MULTIPROC_DIR to a writable folder
+shared by them, and run `python metrics.py` to serve the metrics of all the workers.
+
+The latencies are histograms in seconds, the failures are counters.
+"""
+
+# The port of the HTTP server of the metrics. Empty to disable it.
+METRICS_PORT = getenv("METRICS_PORT", "8000")
+
+# The buckets in seconds of the latencies of Redis, from 0.5 ms to 1 s.
+REDIS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01,
+                 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# The buckets in seconds of the slow operations (text extraction, jobs, stages), from 100 ms to 10 min.
+SLOW_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                30.0, 60.0, 120.0, 300.0, 600.0)
+
+HN_API_LATENCY = Histogram("hn_api_request_seconds",
+                           "Latency of the requests to the Hacker News API.", ["endpoint"])
+HN_API_ERRORS = Counter("hn_api_errors",
+                        "Requests to the Hacker News API that failed.", ["endpoint"])
+
+REDIS_LATENCY = Histogram("redis_command_seconds",
+                          "Latency of the round trips to Redis, by command or pipeline.",
+                          ["command"], buckets=REDIS_BUCKETS)
+
+EXTRACTION_LATENCY = Histogram("extraction_seconds",
+                               "Latency of the extraction of the text of a URL.",
+                               ["source"], buckets=SLOW_BUCKETS)
+EXTRACTION_ERRORS = Counter("extraction_errors",
+                            "Extractions of the text of a URL that failed.", ["source"])
+
+EMBEDDING_API_LATENCY = Histogram("embedding_api_request_seconds",
+                                  "Latency of the requests to the embeddings API.", buckets=SLOW_BUCKETS)
+EMBEDDING_API_ERRORS = Counter("embedding_api_errors",
+                               "Requests to the embeddings API that failed.")
+EMBEDDING_API_INPUTS = Counter("embedding_api_inputs",
+                               "Texts sent to the embeddings API.")
+EMBEDDING_FAILURES = Counter("embedding_failures",
+                             "Stories whose embeddings failed, by kind (permanent or transient) and reason.",
+                             ["kind", "reason"])
+
+CDC_CHANGES = Counter("cdc_field_changes",
+                      "Fields of the stories changed by the updates feed, by field.", ["field"])
+
+INGEST_LAG = Gauge("ingest_lag_items",
+                   "IDs between the max ID of Hacker News and the highest ID ingested.",
+                   multiprocess_mode="max")
+
+QUEUE_DEPTH = Gauge("queue_depth_jobs", "Jobs waiting in each RQ queue.",
+                    ["queue"], multiprocess_mode="max")
+QUEUE_AGE = Gauge("queue_oldest_job_age_seconds",
+                  "Time the oldest job of each RQ queue has been waiting.",
+                  ["queue"], multiprocess_mode="max")
+
+JOB_LATENCY = Histogram("job_seconds", "Duration of the RQ jobs.",
+                        ["job"], buckets=SLOW_BUCKETS)
+JOBS = Counter("jobs", "RQ jobs run, by outcome (success or failure).",
+               ["job", "outcome"])
+
+STAGE_LATENCY = Histogram("stage_seconds",
+                          "Duration of the stages of the pipeline (scheduled tasks, exports, scans).",
+                          ["stage"], buckets=SLOW_BUCKETS)
+
+
+@contextmanager
+def timed(histogram: Histogram, errors: Counter = None, **labels):
+    """
+    Observe the duration of a block in a histogram, and count it in errors if it raises.
+
+    Usage:
+        with timed(HN_API_LATENCY, HN_API_ERRORS, endpoint="item"):
+            ...
+    """
+    before = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        if errors is not None:
+            (errors.labels(**labels) if labels else errors).inc()
+        raise
+    finally:
+        (histogram.labels(**labels) if labels else histogram).observe(
+            time.perf_counter() - before)
+
+
+def job(name: str):
+    """
+    Decorate the function of an RQ job to measure its duration and count its outcomes.
+
+    Args:
+        name (str): The name of the job in the metrics.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            before = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except BaseException:
+                JOBS.labels(name, "failure").inc()
+                raise
+            finally:
+                JOB_LATENCY.labels(name).observe(time.perf_counter() - before)
+
+            JOBS.labels(name, "success").inc()
+            return result
+        return wrapper
+    return decorator
+
+
+def start_metrics_server():
+    """
+    Serve the metrics on METRICS_PORT in a background thread.
+
+    With PROMETHEUS_MULTIPROC_DIR, the metrics of all the processes writing to the folder are served.
+    """
+    if METRICS_PORT == "":
+        return
+
+    if getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        start_http_server(int(METRICS_PORT), registry=registry)
+    else:
+        start_http_server(int(METRICS_PORT))
+
+    print("Serving the metrics on port {}.".format(METRICS_PORT))
+
+
+if __name__ == "__main__":
+    # We serve the metrics of the RQ workers.
+    start_metrics_server()
+    while True:
+        time.sleep(3600)
@@ -0,0 +1,66 @@
+from persistence import rPost, backfill_queue, storage
+from embedding_format import decode_embedding, encode_embedding, is_legacy_embedding
+from metrics import job
+
+"""
+Rewrite the embeddings stored as bz2 compressed JSON to the binary format.
+
+The migration is a chain of RQ jobs: each job migrates one SCAN page,
+then enqueues the job for the next cursor. It can run while the workers
+keep writing embeddings because the readers handle both formats.
+"""
+
+SCAN_COUNT = 1000  # The number of posts to scan in Redis per job.
+PATTERN = "hn:*"  # The pattern to use to scan Redis.
+
+# Replace the embedding only if it's still in the legacy format.
+# Otherwise, a worker has written a new embedding since we read it.
+REPLACE_SCRIPT = """
+local current = redis.call("HGET", KEYS[1], "embeddings")
+if current and string.sub(current, 1, 3) == "BZh" then
+    redis.call("HSET", KEYS[1], "embeddings", ARGV[1])
+    return 1
+end
+return 0
+"""
+
+
+@job("migrate_embeddings")
+def migrate_embeddings_redis(cursor: int = 0):
+    """
+    Migrate the embeddings of a SCAN page and enqueue the next page.
+
+    Args:
+        cursor (int): The SCAN cursor of the page.
+    """
+    next_cursor, keys = rPost.scan(
+        cursor=cursor, match=PATTERN, count=SCAN_COUNT)
+
+    pipe = rPost.pipeline(transaction=False)
+    for key in keys:
+        pipe.hget(key, "embeddings")
+    res = pipe.execute()
+
+    replace = rPost.register_script(REPLACE_SCRIPT)
+    pipe = rPost.pipeline(transaction=False)
+    for key, data in zip(keys, res):
+        if data is None or not is_legacy_embedding(data):
+            continue
+        replace(keys=[key], args=[encode_embedding(
+            decode_embedding(data))], client=pipe)
+    migrated = sum(pipe.execute())
+
+    print("Migrated {} embeddings. Cursor: {}".format(migrated, cursor))
+
+    if next_cursor != 0:
+        backfill_queue.enqueue(migrate_embeddings_redis,
+                               next_cursor, result_ttl=10)
+
+
+if __name__ == "__main__":
+    # migrate_storage.py converts the legacy embeddings when it moves them to another layout.
+    if storage.name != "hash":
+        raise Exception("The legacy embeddings are only in the hash layout.")
+
+    # We start the migration. The workers do the rest.
+    backfill_queue.enqueue(migrate_embeddings_redis, 0, result_ttl=10)
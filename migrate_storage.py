@@ -0,0 +1,102 @@
+from persistence import rPost
+from storage import get_layout, HashLayout, STORY_FIELDS
+from scan import get_max_id_redis, PIPELINE_SIZE
+from embedding_format import decode_embedding, encode_embedding, is_legacy_embedding
+import time
+import sys
+
+"""
+Move the stories from a storage layout to another (see storage.py).
+
+The IDs from 1 to max:ID:hn are read by ranges of PIPELINE_SIZE with the source layout,
+written with the target layout, then deleted from the source in the same pipeline.
+The embeddings still in the legacy format are converted on the way.
+The migration can be stopped and run again: the stories already moved aren't in the source anymore.
+
+Stop the workers while it runs, and set STORAGE_LAYOUT to the target layout before restarting them.
+The indexes, the failures and the changelog don't depend on the layout.
+
+Usage:
+    python migrate_storage.py <from> <to>   # e.g. python migrate_storage.py hash bucket
+"""
+
+# The fields of a story in the target layout when the source doesn't have them.
+DEFAULTS = {"by": "", "title": "", "url": "", "comments": 0}
+
+
+def migrate_range(source: HashLayout, target: HashLayout, ids: list[int]) -> tuple[int, int]:
+    """
+    Move the stories of a range of IDs to the target layout.
+
+    Args:
+        source (HashLayout): The layout the stories are read from and deleted from.
+        target (HashLayout): The layout the stories are written to.
+        ids (list[int]): The IDs of the range.
+
+    Returns:
+        tuple[int, int]: The number of stories moved, and of incomplete posts left in the source.
+    """
+    fields = STORY_FIELDS + ("embeddings",)
+    moved = []
+    incomplete = 0
+    pipe = rPost.pipeline(transaction=False)
+    for id, row in zip(ids, source.read_posts(ids, fields)):
+        if all(value is None for value in row):
+            continue
+
+        values = dict(zip(fields, row))
+        # A post without score or time is not a complete story: we leave it for a manual check.
+        if values["score"] is None or values["time"] is None:
+            incomplete += 1
+            continue
+
+        embeddings = values.pop("embeddings")
+        mapping = {field: value if value is not None else DEFAULTS[field]
+                   for field, value in values.items()}
+        target.write_story(pipe, id, mapping)
+        if embeddings is not None:
+            if is_legacy_embedding(embeddings):
+                embeddings = encode_embedding(decode_embedding(embeddings))
+            target.write_embeddings(pipe, id, embeddings)
+        moved.append(id)
+
+    source.delete_posts(pipe, moved)
+    pipe.execute()
+    return len(moved), incomplete
+
+
+def migrate(source: HashLayout, target: HashLayout) -> tuple[int, int]:
+    """
+    Move all the stories to the target layout.
+
+    Returns:
+        tuple[int, int]: The number of stories moved, and of incomplete posts left in the source.
+    """
+    max_id = get_max_id_redis()
+    before = time.time()
+    moved = 0
+    incomplete = 0
+    for start in range(1, max_id + 1, PIPELINE_SIZE):
+        end = min(start + PIPELINE_SIZE, max_id + 1)
+        range_moved, range_incomplete = migrate_range(
+            source, target, list(range(start, end)))
+        moved += range_moved
+        incomplete += range_incomplete
+        print("Read {} / {} IDs, moved {} stories in {:.1f} s.".format(
+            end - 1, max_id, moved, time.time() - before))
+
+    return moved, incomplete
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] == sys.argv[2]:
+        print("Usage: python migrate_storage.py <from> <to>")
+        sys.exit(1)
+
+    moved, incomplete = migrate(get_layout(sys.argv[1], rPost),
+                                get_layout(sys.argv[2], rPost))
+    print("Moved {} stories to the {} layout. Set STORAGE_LAYOUT={} before restarting the workers.".format(
+        moved, sys.argv[2], sys.argv[2]))
+    if incomplete > 0:
+        print("{} incomplete posts were left in the {} layout.".format(
+            incomplete, sys.argv[1]))
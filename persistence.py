@@ -1,12 +1,426 @@
 import redis
 from os import getenv
+from time import time, perf_counter
+from datetime import timezone
 from rq import Queue
+from rq.utils import utcparse
+from metrics import REDIS_LATENCY, QUEUE_DEPTH, QUEUE_AGE
+from urls import canonicalize_url
+from storage import get_layout, STORAGE_LAYOUT
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    """
+    A pipeline measuring the latency of its round trips.
+    """
+
+    def execute(self, raise_on_error=True):
+        before = perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            REDIS_LATENCY.labels("pipeline").observe(perf_counter() - before)
+
+
+class InstrumentedRedis(redis.Redis):
+    """
+    A Redis client measuring the latency of each command, and of the pipelines it creates.
+    """
+
+    def execute_command(self, *args, **options):
+        before = perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            REDIS_LATENCY.labels(str(args[0]).split(" ")[0].upper()).observe(
+                perf_counter() - before)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks,
+                                    transaction, shard_hint)
 
 
 # The connection to the Redis server for the queue is on database 0.
-redis_connection_queue = redis.StrictRedis().from_url(getenv("REDIS_URL_QUEUE"))
+redis_connection_queue = InstrumentedRedis.from_url(getenv("REDIS_URL_QUEUE"))
 
 # The connection to the Redis server for the post data is on database 1.
-rPost = redis.Redis().from_url(getenv("REDIS_URL_POST"))
+rPost = InstrumentedRedis.from_url(getenv("REDIS_URL_POST"))
+
+# The layout of the stories in the database of the posts (see storage.py).
+storage = get_layout(STORAGE_LAYOUT, rPost)
+
+# The queues of the jobs, from the highest priority to the lowest.
+# A worker listening to several queues always takes the next job of the first one that isn't empty.
+QUEUE_NAMES = ["ingest", "refresh", "embed", "backfill"]
+
+# The new stories, by chunks of IDs. The jobs are short and the freshness of the data depends on them.
+ingest_queue = Queue("ingest", connection=redis_connection_queue)
+# The refreshes of the score and comments of the recent stories.
+refresh_queue = Queue("refresh", connection=redis_connection_queue)
+# The text extraction and the embeddings of the stories. The jobs are slow and bound by Diffbot and OpenAI.
+embed_queue = Queue("embed", connection=redis_connection_queue)
+# The one-time jobs over the whole database, such as migrations.
+backfill_queue = Queue("backfill", connection=redis_connection_queue)
+
+queues = {queue.name: queue for queue in [
+    ingest_queue, refresh_queue, embed_queue, backfill_queue]}
+
+
+def get_queue_stats() -> dict[str, tuple[int, float]]:
+    """
+    Get the number of jobs waiting in each queue and the age of the oldest one.
+
+    Returns:
+        dict[str, tuple[int, float]]: The depth and the age in seconds (0 if empty) by queue name.
+    """
+    # RQ pushes the jobs to the tail of the list and pops them from the head.
+    pipe = redis_connection_queue.pipeline(transaction=False)
+    for name in QUEUE_NAMES:
+        pipe.llen(queues[name].key)
+        pipe.lindex(queues[name].key, 0)
+    res = pipe.execute()
+    depths, heads = res[0::2], res[1::2]
+
+    pipe = redis_connection_queue.pipeline(transaction=False)
+    for head in heads:
+        if head is not None:
+            pipe.hget("rq:job:{}".format(head.decode("utf-8")), "enqueued_at")
+    enqueued_at = iter(pipe.execute())
+
+    now = time()
+    stats = {}
+    for name, depth, head in zip(QUEUE_NAMES, depths, heads):
+        age = 0
+        if head is not None:
+            # The job may have been dequeued or deleted in between.
+            value = next(enqueued_at)
+            if value:
+                enqueued = utcparse(value.decode("utf-8")).replace(tzinfo=timezone.utc)
+                age = max(0, now - enqueued.timestamp())
+        stats[name] = (depth, age)
+    return stats
+
+
+def observe_queues() -> dict[str, tuple[int, float]]:
+    """
+    Update the metrics of the depth and age of the queues.
+
+    Returns:
+        dict[str, tuple[int, float]]: The stats of get_queue_stats.
+    """
+    stats = get_queue_stats()
+    for name, (depth, age) in stats.items():
+        QUEUE_DEPTH.labels(name).set(depth)
+        QUEUE_AGE.labels(name).set(age)
+    return stats
+
+
+# The stream of the IDs of the posts changed, read by the incremental export and the search index.
+CHANGELOG_KEY = "changelog:hn"
+# The approximate number of changes kept in the stream.
+# It must hold the changes between two exports, or the next export is a full rebuild.
+CHANGELOG_MAXLEN = int(getenv("CHANGELOG_MAXLEN", "5000000"))
+# The number of changelog entries read at once.
+CHANGELOG_PAGE_SIZE = 10000
+
+
+def log_change(pipe: redis.client.Pipeline, id: str):
+    """
+    Record in the changelog that a post has changed.
+    It's added to a pipeline so it's sent with the write itself.
+
+    Args:
+        pipe (redis.client.Pipeline): The pipeline writing the post.
+        id (str): The ID of the post, without the "hn:" prefix.
+    """
+    pipe.xadd(CHANGELOG_KEY, {"id": id},
+              maxlen=CHANGELOG_MAXLEN, approximate=True)
+
+
+# The secondary indexes of the stories, maintained by every write (see indexes.py).
+# The IDs of the stories by score.
+SCORE_INDEX_KEY = "idx:score"
+# The IDs of the stories by time of submission.
+TIME_INDEX_KEY = "idx:time"
+# The IDs of the stories with a URL and without embeddings, by score.
+NEEDS_EMBEDDING_KEY = "idx:needs_embedding"
+# The IDs of the stories of each canonical URL, separated by spaces.
+URL_INDEX_KEY = "idx:url"
+# A bitmap with the bit of the ID of each story set, to skip the stories already stored cheaply.
+KNOWN_STORIES_KEY = "idx:stories"
+
+# Index a story written just before in the same pipeline.
+# KEYS[1] holds its embeddings: in the field ARGV[5] of a hash, or in a string if ARGV[5] is empty.
+# ARGV[6] is the canonical URL the story had before the write, if it changed: the ID is removed from it.
+INDEX_SCRIPT = """
+redis.call("ZADD", KEYS[2], ARGV[2], ARGV[1])
+redis.call("ZADD", KEYS[3], ARGV[3], ARGV[1])
+redis.call("SETBIT", KEYS[6], ARGV[1], 1)
+if ARGV[6] ~= "" and ARGV[6] ~= ARGV[4] then
+    local old = redis.call("HGET", KEYS[5], ARGV[6])
+    if old then
+        local kept = {}
+        for other in string.gmatch(old, "%S+") do
+            if other ~= ARGV[1] then
+                table.insert(kept, other)
+            end
+        end
+        if #kept == 0 then
+            redis.call("HDEL", KEYS[5], ARGV[6])
+        else
+            redis.call("HSET", KEYS[5], ARGV[6], table.concat(kept, " "))
+        end
+    end
+end
+if ARGV[4] == "" then
+    -- Without a URL, there is no text to embed.
+    redis.call("ZREM", KEYS[4], ARGV[1])
+    return 0
+end
+
+local embedded
+if ARGV[5] == "" then
+    embedded = redis.call("EXISTS", KEYS[1])
+else
+    embedded = redis.call("HEXISTS", KEYS[1], ARGV[5])
+end
+if embedded == 0 then
+    redis.call("ZADD", KEYS[4], ARGV[2], ARGV[1])
+end
+local ids = redis.call("HGET", KEYS[5], ARGV[4])
+if not ids then
+    redis.call("HSET", KEYS[5], ARGV[4], ARGV[1])
+elseif not string.find(" " .. ids .. " ", " " .. ARGV[1] .. " ", 1, true) then
+    redis.call("HSET", KEYS[5], ARGV[4], ids .. " " .. ARGV[1])
+end
+return 0
+"""
+
+index_script = rPost.register_script(INDEX_SCRIPT)
+
+
+def index_url(url: str | bytes | None) -> str:
+    """
+    Get the key of a URL in idx:url: its canonical URL, or "" if there is no URL.
+    """
+    if url is None:
+        return ""
+    if isinstance(url, bytes):
+        url = url.decode("utf-8")
+    if url == "":
+        return ""
+    try:
+        return canonicalize_url(url)
+    except ValueError:
+        # An invalid port or host: we index the raw URL rather than failing the write of the story.
+        return url
+
+
+def index_story(pipe: redis.client.Pipeline, id: str, mapping: dict, old_url: str | bytes | None = None):
+    """
+    Update the secondary indexes of a story.
+    It's added to the pipeline writing the story, after the write.
+
+    Args:
+        pipe (redis.client.Pipeline): The pipeline writing the story.
+        id (str): The ID of the story, without the "hn:" prefix.
+        mapping (dict): The fields of the story, with its score, time and URL.
+        old_url (str | bytes | None): The URL stored before the write, None if the story is new.
+            If it changed, the story is removed from the entry of the old URL in idx:url.
+    """
+    embeddings_key, embeddings_field = storage.embeddings_location(id)
+    index_script(keys=[embeddings_key, SCORE_INDEX_KEY, TIME_INDEX_KEY, NEEDS_EMBEDDING_KEY, URL_INDEX_KEY,
+                       KNOWN_STORIES_KEY],
+                 args=[id, mapping["score"], mapping["time"], index_url(mapping["url"]), embeddings_field,
+                       index_url(old_url)], client=pipe)
+
+
+def get_known_stories(ids: list[int]) -> list[bool]:
+    """
+    Check in the bitmap of the stories which IDs are stories already stored.
+
+    Returns:
+        list[bool]: Whether each ID is a known story.
+    """
+    pipe = rPost.pipeline(transaction=False)
+    for id in ids:
+        pipe.getbit(KNOWN_STORIES_KEY, id)
+    return [bit == 1 for bit in pipe.execute()]
+
+
+def get_known_stories_in_range(start: int, end: int) -> list[int]:
+    """
+    Get the IDs of the stories in the range [start, end) from the bitmap of the stories.
+    The bytes of the range are read with a single GETRANGE.
+
+    Returns:
+        list[int]: The IDs, in increasing order.
+    """
+    if start >= end:
+        return []
+    first_byte = start // 8
+    data = rPost.getrange(KNOWN_STORIES_KEY, first_byte, (end - 1) // 8)
+    ids = []
+    for offset, byte in enumerate(data):
+        if byte == 0:
+            continue
+        # The bit 0 of the bitmap is the most significant bit of the first byte.
+        for bit in range(8):
+            id = (first_byte + offset) * 8 + bit
+            if byte & (0x80 >> bit) and start <= id < end:
+                ids.append(id)
+    return ids
+
+
+def parse_stream_id(id: str) -> tuple[int, int]:
+    """
+    Convert the ID of a stream entry (<ms>-<seq>) to a tuple to compare it.
+    """
+    ms, seq = id.split("-")
+    return int(ms), int(seq)
+
+
+def get_changelog_end() -> str:
+    """
+    Get the ID of the last entry of the changelog.
+
+    Returns:
+        str: The ID, or "0-0" if the changelog is empty.
+    """
+    entries = rPost.xrevrange(CHANGELOG_KEY, count=1)
+    return entries[0][0].decode("utf-8") if len(entries) > 0 else "0-0"
+
+
+def changelog_has_gap(last_id: str) -> bool:
+    """
+    Check if changes after last_id may have been trimmed from the changelog.
+
+    Args:
+        last_id (str): The ID of the last entry read.
+
+    Returns:
+        bool: True if changes may have been missed, so a full rebuild is needed.
+    """
+    entries = rPost.xrange(CHANGELOG_KEY, count=1)
+    if last_id == "0-0":
+        # The changelog was empty at the last read.
+        # Entries have been trimmed only if the stream has reached its maximum length.
+        return rPost.xlen(CHANGELOG_KEY) >= CHANGELOG_MAXLEN
+
+    # Entries are only removed by trimming, oldest first.
+    # If the last entry read is gone, the entries after it may be gone too.
+    if len(entries) == 0:
+        return True
+    return parse_stream_id(entries[0][0].decode("utf-8")) > parse_stream_id(last_id)
+
+
+def read_changed_ids(last_id: str, end_id: str) -> set[int]:
+    """
+    Get the IDs of the posts changed after last_id, up to end_id included.
+
+    Args:
+        last_id (str): The ID of the last entry read.
+        end_id (str): The ID of the last entry to read.
+
+    Returns:
+        set[int]: The IDs of the posts changed.
+    """
+    ids = set()
+    start = last_id
+    while True:
+        # The "(" prefix makes the start exclusive.
+        entries = rPost.xrange(CHANGELOG_KEY, min="(" + start,
+                               max=end_id, count=CHANGELOG_PAGE_SIZE)
+        for _, fields in entries:
+            ids.add(int(fields[b"id"]))
+
+        if len(entries) < CHANGELOG_PAGE_SIZE:
+            return ids
+        start = entries[-1][0].decode("utf-8")
+
+
+# The number of stories buffered by StoryWriter before writing them to Redis.
+STORY_FLUSH_SIZE = int(getenv("STORY_FLUSH_SIZE", "500"))
+# The age in seconds of the oldest story in the buffer of StoryWriter above which the next add flushes it.
+# It's only checked on add: there is no timer, so the last stories wait for the writer to be closed.
+STORY_FLUSH_INTERVAL = float(getenv("STORY_FLUSH_INTERVAL", "5"))
+# Whether the pipeline is wrapped in MULTI/EXEC.
+# Stories are independent, so we don't need a transaction by default.
+STORY_FLUSH_TRANSACTION = getenv("STORY_FLUSH_TRANSACTION", "0") == "1"
+
+
+class StoryWriter:
+    """
+    Buffer stories and write them to Redis in a single pipeline.
+
+    Each story is written with the storage layout and indexed, as add_story_redis does.
+    A flush first reads the URLs stored in one pipeline, so a story whose URL changed
+    is removed from the index of its old URL: a flush takes two round trips.
+    The buffer is flushed when it holds flush_size stories, when a story is added while the oldest
+    one is older than flush_interval seconds, or when the writer is closed.
+    flush_interval is only checked on add: without a new story, the buffer waits for the writer to be closed.
+
+    Usage:
+        with StoryWriter() as writer:
+            writer.add(id, mapping)
+    """
+
+    def __init__(self, flush_size: int = STORY_FLUSH_SIZE,
+                 flush_interval: float = STORY_FLUSH_INTERVAL,
+                 transaction: bool = STORY_FLUSH_TRANSACTION,
+                 connection: redis.Redis = rPost):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.transaction = transaction
+        self.connection = connection
+
+        self.buffer: list[tuple[str, dict]] = []
+        self.buffer_since: float = 0
+
+        # The number of pipelines executed, i.e. the number of round trips to Redis.
+        self.round_trips = 0
+        # The number of stories written.
+        self.written = 0
+
+    def add(self, id: str, mapping: dict):
+        """
+        Add a story to the buffer and flush it if it's full or its oldest story is older than flush_interval.
+
+        Args:
+            id (str): The ID of the post, without the "hn:" prefix.
+            mapping (dict): The fields of the post.
+        """
+        if len(self.buffer) == 0:
+            self.buffer_since = time()
+        self.buffer.append((id, mapping))
+
+        if len(self.buffer) >= self.flush_size or time() - self.buffer_since >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered stories to Redis in a single pipeline, after reading their URLs.
+        """
+        if len(self.buffer) == 0:
+            return
+
+        # The URLs before the write, to remove the stories whose URL changed from idx:url.
+        old_urls = storage.read_posts([id for id, _ in self.buffer], ("url",))
+
+        pipe = self.connection.pipeline(transaction=self.transaction)
+        for (id, mapping), (old_url,) in zip(self.buffer, old_urls):
+            storage.write_story(pipe, id, mapping)
+            log_change(pipe, id)
+            index_story(pipe, id, mapping, old_url)
+        pipe.execute()
+
+        self.round_trips += 2
+        self.written += len(self.buffer)
+        self.buffer = []
+
+    def __enter__(self):
+        return self
 
-redis_queue = Queue(connection=redis_connection_queue)
+    def __exit__(self, exc_type, exc_value, traceback):
+        # We flush even on error so the stories already parsed are not lost.
+        self.flush()
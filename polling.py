@@ -1,6 +1,25 @@
-from threading import Timer
-from persistence import redis_connection_queue, redis_queue
-from hn_api import get_max_id_HN, add_story_redis
+from persistence import redis_connection_queue, ingest_queue, backfill_queue, get_known_stories
+from hn_api import get_max_id_HN, get_list_HN, add_story_range_redis, add_stories_redis, INGESTED_ID_KEY
+from metrics import INGEST_LAG
+from rate_limit import is_open
+from rq import Queue
+from os import getenv
+import time
+
+# The number of IDs fetched by a single add_story_range_redis or add_stories_redis job.
+CHUNK_SIZE = 500
+# The timeout of a chunk job. It's higher than for a single item because we fetch CHUNK_SIZE items.
+CHUNK_JOB_TIMEOUT = 300
+# The number of jobs pushed to the queue in a single pipeline.
+ENQUEUE_BATCH_SIZE = 100
+
+# Only enqueue the stories of the newstories list, instead of every new ID (see plan_ingest).
+INGEST_PREFILTER = getenv("INGEST_PREFILTER", "1") == "1"
+# The maximum number of IDs after the newest story listed left to the next poll.
+# Beyond, the list is probably stale: we fetch them in chunks.
+PREFILTER_MAX_TAIL = 2000
+# Whether the IDs skipped by the pre-filter are fetched again by jobs on the backfill queue (see plan_ingest).
+PREFILTER_RECHECK = getenv("PREFILTER_RECHECK", "0") == "1"
 
 
 def pollNewStory():
@@ -11,35 +30,162 @@ def pollNewStory():
 
     To do so, we compare the max ID from redis. If it's different, we add all the IDs in the interval
     because HN is sequential.
+    The interval is split in chunks of CHUNK_SIZE IDs, one job per chunk.
+    With INGEST_PREFILTER, only the stories are enqueued when the newstories list covers the interval.
     """
 
+    # The API is failing: we don't add jobs that would fail too.
+    if is_open("hn"):
+        print("The circuit of the Hacker News API is open. Skipping.")
+        return
+
     # We get the max ID from the API.
     maxID = get_max_id_HN()
 
-    # We get the max ID from Redis.
-    maxIDRedis = redis_connection_queue.get("max:ID:hn")
+    # We get the max ID enqueued and the max ID ingested from Redis.
+    maxIDRedis, ingestedID = redis_connection_queue.mget(
+        "max:ID:hn", INGESTED_ID_KEY)
 
     # We convert the max ID from Redis to an integer or set it to 0 if it is None.
     maxIDRedis = int(maxIDRedis) if maxIDRedis is not None else 0
 
+    # The number of IDs not ingested yet, enqueued or not.
+    INGEST_LAG.set(maxID - (int(ingestedID) if ingestedID is not None else 0))
+
     # We check if the max ID from the API is greater than the max ID from Redis.
     if maxID > maxIDRedis:
         print("New stories available. Adding them to the queue.")
         print("{} new stories ({} - {}).".format(maxID -
               maxIDRedis, maxIDRedis + 1, maxID))
-        # We add all the IDs in the interval.
-        for id in range(maxIDRedis + 1, maxID + 1):
-            # We add the ID to the queue.
-            redis_queue.enqueue(add_story_redis, str(
-                id), job_timeout=10, result_ttl=10)
-
-            # We do a partial commit every 100 IDs.
-            if id % 100 == 0:
-                redis_connection_queue.set("max:ID:hn", id)
-                print("Partial commit. ID: {}".format(id))
-
-        # We update the max ID in Redis.
-        redis_connection_queue.set("max:ID:hn", maxID)
-
-    # We schedule the next poll.
-    Timer(10, pollNewStory).start()
+
+        before = time.time()
+        if INGEST_PREFILTER:
+            jobs, covered, skipped = plan_ingest(maxIDRedis + 1, maxID + 1)
+        else:
+            jobs, covered, skipped = get_range_jobs(maxIDRedis + 1, maxID + 1), maxID + 1, []
+
+        # We push the jobs by batch.
+        for i in range(0, len(jobs), ENQUEUE_BATCH_SIZE):
+            enqueue_jobs(jobs[i:i + ENQUEUE_BATCH_SIZE])
+        # The IDs after the last job are not stories: we only commit them.
+        # The ingested ID is left to the jobs, which may not have run yet.
+        if covered > maxIDRedis + 1 and (len(jobs) == 0 or jobs[-1][1] < covered):
+            redis_connection_queue.set("max:ID:hn", covered - 1)
+
+        if PREFILTER_RECHECK and len(skipped) > 0:
+            backfill_queue.enqueue_many([data for data, _ in get_stories_jobs(skipped, covered)])
+            print("Enqueued {} IDs skipped by the pre-filter on the backfill queue.".format(len(skipped)))
+
+        elapsed = time.time() - before
+        print("Enqueued {} jobs ({} IDs, up to {}) in {} ms ({:.0f} IDs/s).".format(
+            len(jobs), covered - maxIDRedis - 1, covered - 1, elapsed * 1000,
+            (covered - maxIDRedis - 1) / elapsed if elapsed > 0 else 0))
+
+
+def get_range_jobs(start: int, end: int) -> list[tuple[dict, int]]:
+    """
+    Split the IDs in [start, end) in add_story_range_redis jobs of CHUNK_SIZE IDs.
+
+    Returns:
+        list[tuple[dict, int]]: The data of each job for enqueue_many, and the ID after its range.
+    """
+    jobs = []
+    for chunk_start in range(start, end, CHUNK_SIZE):
+        chunk_end = min(chunk_start + CHUNK_SIZE, end)
+        jobs.append((Queue.prepare_data(add_story_range_redis,
+                                        (chunk_start, chunk_end),
+                                        timeout=CHUNK_JOB_TIMEOUT,
+                                        result_ttl=10), chunk_end))
+    return jobs
+
+
+def get_stories_jobs(ids: list[int], end: int) -> list[tuple[dict, int]]:
+    """
+    Split a list of IDs in add_stories_redis jobs of CHUNK_SIZE IDs.
+
+    Args:
+        ids (list[int]): The IDs, in increasing order.
+        end (int): The ID after the range the IDs were picked from. The last job covers the IDs up to it.
+
+    Returns:
+        list[tuple[dict, int]]: The data of each job for enqueue_many, and the ID after its range.
+    """
+    jobs = []
+    for i in range(0, len(ids), CHUNK_SIZE):
+        batch = ids[i:i + CHUNK_SIZE]
+        batch_end = batch[-1] + 1 if i + CHUNK_SIZE < len(ids) else end
+        jobs.append((Queue.prepare_data(add_stories_redis,
+                                        (batch, batch_end),
+                                        timeout=CHUNK_JOB_TIMEOUT,
+                                        result_ttl=10), batch_end))
+    return jobs
+
+
+def plan_ingest(start: int, end: int) -> tuple[list[tuple[dict, int]], int, list[int]]:
+    """
+    Plan the jobs ingesting the IDs in [start, end), without the IDs that are not stories.
+
+    Most items are comments, and the newstories list holds the last 500 stories.
+    So between its oldest and its newest story, the IDs missing from the list are mostly not stories:
+    only the stories listed are enqueued, in add_stories_redis jobs, minus those already stored
+    (see get_known_stories).
+    - The IDs older than the list are fetched in chunks: the jobs drop the items that are not stories.
+    - The IDs after the newest story listed are comments so far, or stories not listed yet:
+      they're left to the next poll, unless there are more than PREFILTER_MAX_TAIL of them.
+
+    Two kinds of stories are missing from the list and are never fetched by the live polling:
+    - The dead stories (killed by the spam filter or flagged). A range job would store them.
+    - A story listed after a later story, when the list lags: it's below max:ID:hn at the next poll.
+    The skipped IDs are returned: with PREFILTER_RECHECK, pollNewStory fetches them again
+    on the backfill queue, which the workers only take when the other queues are empty.
+    It fetches as many items as without the pre-filter, but outside of the path of the new stories.
+
+    Args:
+        start (int): The first ID to ingest.
+        end (int): The ID after the last ID to ingest.
+
+    Returns:
+        tuple[list[tuple[dict, int]], int, list[int]]: The jobs, with the ID after the range of each one,
+        the ID after the IDs they cover, and the IDs skipped in between.
+    """
+    listed = sorted(get_list_HN("newstories"))
+    if len(listed) == 0 or listed[-1] < start:
+        # No new story listed yet.
+        if end - start > PREFILTER_MAX_TAIL:
+            return get_range_jobs(start, end), end, []
+        return [], start, []
+
+    window_start = min(max(start, listed[0]), end)
+    window_end = min(end, listed[-1] + 1)
+    jobs = get_range_jobs(start, window_start)
+
+    listed_window = [id for id in listed if window_start <= id < window_end]
+    ids = [id for id, known in zip(listed_window, get_known_stories(listed_window)) if not known]
+    # The last job covers the IDs up to the end of the window.
+    jobs += get_stories_jobs(ids, window_end)
+
+    listed_window = set(listed_window)
+    skipped = [id for id in range(window_start, window_end) if id not in listed_window]
+
+    if end - window_end > PREFILTER_MAX_TAIL:
+        return jobs + get_range_jobs(window_end, end), end, skipped
+    return jobs, window_end, skipped
+
+
+def enqueue_jobs(jobs: list[tuple[dict, int]]):
+    """
+    Push a batch of ingestion jobs to the queue and commit the max ID.
+
+    The jobs and the checkpoint are sent in the same MULTI/EXEC pipeline,
+    so a crash can't enqueue a range without committing it, or the opposite.
+
+    Args:
+        jobs (list[tuple[dict, int]]): The data of the jobs, and the ID after the range of each one.
+    """
+    # The pipeline of redis-py is transactional by default.
+    pipe = redis_connection_queue.pipeline()
+    ingest_queue.enqueue_many([data for data, _ in jobs], pipeline=pipe)
+    pipe.set("max:ID:hn", jobs[-1][1] - 1)
+    pipe.execute()
+
+    print("Partial commit. ID: {}".format(jobs[-1][1] - 1))
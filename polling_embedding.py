@@ -1,102 +1,180 @@
-from persistence import rPost, redis_queue, redis_connection_queue
+from persistence import rPost, redis_connection_queue, embed_queue, storage, NEEDS_EMBEDDING_KEY
 from rq.job import Job
 from rq import Queue
-from embeddings import add_embeddings_redis
+from embeddings import add_embeddings_redis, PENDING_IDS_KEY
+from scan import scan_posts, SCAN_WORKERS
+from indexes import is_index_ready, get_ids_needing_embedding
+from metrics import timed, start_metrics_server, STAGE_LATENCY
+from rate_limit import is_open
+from failures import failure_key, is_retry_due, FAILURE_RETRY_BASE
+from os import getenv
 import time
 
 
 THRESHOLD = 100  # The minimum score of the post to compute embeddings.
-SCAN_COUNT = 10000  # The number of posts to scan in Redis per iteration.
-PATTERN = "hn:*"  # The pattern to use to scan Redis.
+# The number of processes reading Redis.
+WORKERS = int(getenv("EMBEDDING_SCAN_WORKERS", str(SCAN_WORKERS)))
+# The maximum number of jobs waiting in the embed queue. We stop enqueueing above it,
+# so a backlog of embeddings doesn't grow without bound while the workers can't keep up.
+EMBED_QUEUE_MAX_DEPTH = int(getenv("EMBED_QUEUE_MAX_DEPTH", "5000"))
+# The time in seconds a failed job stays in the failed registry of RQ.
+# The post can't be enqueued again before, so it's below FAILURE_RETRY_BASE.
+FAILED_JOB_TTL = min(3600, FAILURE_RETRY_BASE)
+# The number of posts of the index checked in a single pipeline.
+QUERY_BATCH_SIZE = 10000
+
+
+def find_posts_for_embedding(ids: list[int], rows: list[list[bytes]]) -> list[int]:
+    """
+    Select the posts to compute embeddings for.
+    It runs in the workers of scan_posts.
+
+    A post is selected if its score is above the threshold, it has a URL,
+    and filter_posts_for_embedding keeps it.
 
+    Args:
+        ids (list[int]): The IDs of the posts.
+        rows (list[list[bytes]]): The score and the URL of each post.
 
-def poll_post_for_embedding(cursor: int = 0):
+    Returns:
+        list[int]: The IDs of the posts to push to the queue.
     """
-    Poll the posts in Redis to compute their embeddings.
-    If the post has already been added to the queue, 
-    or if it has already been computed, we do nothing.
+    # We check the score first because it's already fetched.
+    # Only a few posts are above the threshold.
+    # Posts without URL (e.g. "Ask HN") have no text to compute embeddings from.
+    postID_to_check = [id for id, (score, url) in zip(ids, rows)
+                       if score is not None and int(score) >= THRESHOLD and url]
+
+    return filter_posts_for_embedding(postID_to_check)
+
 
-    To do so, we iterate over the posts in Redis using the SCAN command.
+def filter_posts_for_embedding(postID_to_check: list[int]) -> list[int]:
     """
+    Keep the posts whose embeddings have not been computed yet, that haven't failed permanently,
+    whose next retry is due if they failed before (see failures.py),
+    for which no job has been added to the queue, and whose text isn't waiting for embedding_batcher.py.
 
-    res_scan = rPost.scan(cursor=cursor, count=SCAN_COUNT)
-    print("Polling posts for embeddings. Cursor: {}".format(cursor))
-    print("{} posts to scan.".format(len(res_scan[1])))
+    Args:
+        postID_to_check (list[int]): The IDs of the posts.
 
-    # We iterate over the posts to check if they have to be added to the queue.
-    # or if they have already been computed.
+    Returns:
+        list[int]: The IDs of the posts to push to the queue.
+    """
+    # We batch fetch if the post contains the "embeddings" field and its failure using a pipeline.
+    pipe = rPost.pipeline(transaction=False)
+    for postID in postID_to_check:
+        storage.queue_has_embeddings(pipe, postID)
+        pipe.hmget(failure_key(postID), "kind", "next_retry")
+    res = pipe.execute()
+    now = time.time()
 
-    # Convert the bytes to strings.
-    # We remove the "hn:" prefix.
-    # We add the "embedding_" prefix.
-    list_post_id = ["embedding_"+(id.decode("utf-8")[3:])
-                    for id in res_scan[1]]
+    # The index of the posts to embed may still hold posts embedded during its rebuild.
+    embedded = [postID for postID, exists in zip(
+        postID_to_check, res[0::2]) if exists]
+    if len(embedded) > 0:
+        rPost.zrem(NEEDS_EMBEDDING_KEY, *embedded)
 
-    # We iterate over the jobs to check if they have already been computed.
-    # If not, we add them to "jobID_to_check_for_embedding".
-    jobs = Job.fetch_many(list_post_id,
+    postID_to_check = [postID for postID, exists, (kind, next_retry)
+                       in zip(postID_to_check, res[0::2], res[1::2])
+                       if not exists and is_retry_due(kind, next_retry, now)]
+
+    # We check if a job has already been added to the queue for the post.
+    jobs = Job.fetch_many(["embedding_{}".format(postID) for postID in postID_to_check],
                           connection=redis_connection_queue)
 
-    jobID_to_check_for_embedding = []
-    for i in range(len(jobs)):
-        if jobs[i] == None:
-            # We add the job to the list of jobs to check for embeddings.
-            # We remove the "embedding_" prefix.
-            jobID_to_check_for_embedding.append(list_post_id[i][10:])
+    postID_to_check = [postID for postID, job in zip(
+        postID_to_check, jobs) if job is None]
+    if len(postID_to_check) == 0:
+        return []
 
-    # We iterate over the jobs to check if they have already been computed.
-    # If not, we will push them to the queue.
-    # To do so, we batch fetch if the post contains the "embeddings" field using a pipeline.
+    # The job of a batched post ends once its text is pushed, before the post is embedded.
+    pending = redis_connection_queue.smismember(
+        PENDING_IDS_KEY, [str(postID) for postID in postID_to_check])
+    return [postID for postID, is_pending in zip(postID_to_check, pending) if not is_pending]
 
-    jobID_to_check_for_score = []
-    pipe = rPost.pipeline()
-    for postID in jobID_to_check_for_embedding:
-        pipe.hexists("hn:"+postID, "embeddings")
 
-    # We execute the pipeline.
-    res = pipe.execute()
-    for i in range(len(res)):
-        if res[i] == False:
-            jobID_to_check_for_score.append(jobID_to_check_for_embedding[i])
+def query_posts_for_embedding(batch_size: int = QUERY_BATCH_SIZE):
+    """
+    Find the posts to compute embeddings for with the index of the posts without embeddings.
 
-    # We check if the score is above the threshold.
-    # We batch fetch the score using a pipeline.
-    jobID_to_push = []
+    Yields:
+        list[int]: The IDs of the posts to push to the queue, by batch, from the highest score.
+    """
+    ids = get_ids_needing_embedding(THRESHOLD)
+    print("{} posts without embeddings above the threshold in the index.".format(len(ids)))
+    for i in range(0, len(ids), batch_size):
+        yield filter_posts_for_embedding(ids[i:i + batch_size])
 
-    pipe = rPost.pipeline()
-    for postID in jobID_to_check_for_score:
-        pipe.hget("hn:"+postID, "score")
 
-    # We execute the pipeline.
-    res = pipe.execute()
-    for i in range(len(res)):
-        if res[i] != None and int(res[i]) >= THRESHOLD:
-            jobID_to_push.append(jobID_to_check_for_score[i])
+def discover_posts_for_embedding(workers: int = WORKERS):
+    """
+    Find the posts to compute embeddings for: with the indexes once they are built,
+    or by reading all the posts in parallel with scan_posts.
 
-    # We batch push the job to the queue.
-    # We use postID[3:] because we want to remove the "hn:" prefix.
+    Yields:
+        list[int]: The IDs of the posts to push to the queue, by batch.
+    """
+    if is_index_ready():
+        return query_posts_for_embedding()
 
-    jobs_list = []
-    for postID in jobID_to_push:
-        jobs_list.append(
+    print("The indexes are not built. Reading all the posts.")
+    return scan_posts(("score", "url"), find_posts_for_embedding, workers)
 
-            Queue.prepare_data(add_embeddings_redis,
-                               (postID,),
-                               job_id="embedding_{}".format(postID),
-                               result_ttl=10)
-        )
 
-    redis_queue.enqueue_many(jobs_list)
+def poll_post_for_embedding(workers: int = WORKERS):
+    """
+    Poll the posts in Redis to compute their embeddings.
+    If the post has already been added to the queue,
+    or if it has already been computed, we do nothing.
 
-    print("I have enqueued {} jobs.\n".format(len(jobs_list)))
+    To do so, we query the index of the posts without embeddings (see indexes.py),
+    or read all the posts if it's not built yet.
+    We enqueue at most enough jobs to fill the embed queue up to EMBED_QUEUE_MAX_DEPTH.
+    The other posts are enqueued by the next polls, once the workers have caught up.
 
-    # We call the function with the next cursor.
-    if res_scan[0] != 0:
-        poll_post_for_embedding(cursor=res_scan[0])
+    Args:
+        workers (int): The number of processes reading Redis.
+    """
+    print("Polling posts for embeddings.")
+    if is_open("diffbot") or is_open("embeddings"):
+        print("The circuit of Diffbot or of the embeddings API is open. Skipping.")
+        return
+
+    capacity = EMBED_QUEUE_MAX_DEPTH - embed_queue.count
+    if capacity <= 0:
+        print("The embed queue is full ({} jobs). Skipping.".format(
+            EMBED_QUEUE_MAX_DEPTH - capacity))
+        return
+
+    enqueued = 0
+    for jobID_to_push in discover_posts_for_embedding(workers):
+        # We batch push the jobs to the queue.
+        jobs_list = []
+        for postID in jobID_to_push[:capacity - enqueued]:
+            jobs_list.append(
+                Queue.prepare_data(add_embeddings_redis,
+                                   (str(postID),),
+                                   job_id="embedding_{}".format(postID),
+                                   result_ttl=10,
+                                   failure_ttl=FAILED_JOB_TTL)
+            )
+
+        if len(jobs_list) > 0:
+            embed_queue.enqueue_many(jobs_list)
+            enqueued += len(jobs_list)
+
+        if enqueued >= capacity:
+            print("The embed queue is full. The other posts are left for the next poll.")
+            break
+
+    print("I have enqueued {} jobs.\n".format(enqueued))
 
 
 if __name__ == "__main__":
+    start_metrics_server()
+
     # We start the polling.
     now = time.time()
-    poll_post_for_embedding()
+    with timed(STAGE_LATENCY, stage="embeddings"):
+        poll_post_for_embedding()
     print("Polling total took {} ms".format((time.time() - now) * 1000))
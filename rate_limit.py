@@ -0,0 +1,293 @@
+from persistence import redis_connection_queue
+from email.utils import parsedate_to_datetime
+from random import uniform
+from os import getenv
+import requests
+import asyncio
+import time
+
+"""
+Rate limiting, retries and circuit breaking of the external APIs (Hacker News, Diffbot, embeddings).
+
+- Rate limiting: all the workers share a limiter per upstream in Redis (GCRA, a token bucket
+  computed from a single timestamp). A request reserves the next free slot and sleeps until it,
+  so the workers are spaced evenly up to the quota instead of bursting and being rejected together.
+- Retries: the failed requests are retried with an exponential backoff with full jitter,
+  or after the delay of the Retry-After header of the upstream.
+- Circuit breaking: when at least CIRCUIT_FAILURES requests, and CIRCUIT_FAILURE_RATIO of the requests,
+  failed in CIRCUIT_WINDOW seconds, the circuit of the upstream opens for CIRCUIT_COOLDOWN seconds.
+  A few errors under load don't open it. While it's open, the requests wait instead of
+  being sent, and the pollers stop enqueueing jobs for the upstream (see is_open).
+  The first requests after the cooldown test the upstream: if they fail, the circuit opens again.
+
+The state is in the queue database: ratelimit:<upstream>, circuit:<upstream>:window
+(the requests and the failures of the current window) and circuit:<upstream>:open.
+"""
+
+# The maximum number of requests per second to each upstream. 0 disables the limit.
+RATE_LIMITS = {
+    "hn": float(getenv("RATE_LIMIT_HN", "200")),
+    "diffbot": float(getenv("RATE_LIMIT_DIFFBOT", "5")),
+    "embeddings": float(getenv("RATE_LIMIT_EMBEDDINGS", "20")),
+    # The share of the Hacker News limit the backfill can use, so the live polling keeps the rest.
+    "backfill": float(getenv("RATE_LIMIT_BACKFILL", "100")),
+}
+# The number of seconds of requests that can be sent at once after an idle period.
+RATE_LIMIT_BURST = 1
+
+# The minimum number of failures in CIRCUIT_WINDOW seconds opening the circuit.
+CIRCUIT_FAILURES = int(getenv("CIRCUIT_FAILURES", "20"))
+# The minimum fraction of the requests in CIRCUIT_WINDOW seconds that failed opening the circuit.
+CIRCUIT_FAILURE_RATIO = float(getenv("CIRCUIT_FAILURE_RATIO", "0.5"))
+CIRCUIT_WINDOW = 30
+# The time in seconds the circuit stays open.
+CIRCUIT_COOLDOWN = int(getenv("CIRCUIT_COOLDOWN", "30"))
+
+# The first delay in seconds of the backoff. It doubles after each failure.
+BACKOFF_BASE = 0.5
+# The maximum delay in seconds of the backoff, and of a Retry-After.
+BACKOFF_MAX = 60
+# The number of attempts of a request.
+BACKOFF_TRIES = 5
+
+# The HTTP statuses worth retrying: rate limited or the upstream failed.
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+# Returns the time in ms to wait: before the first slot reserved,
+# or negative while the circuit is open (nothing is reserved).
+ACQUIRE_SCRIPT = """
+local open = redis.call("PTTL", KEYS[2])
+if open > 0 then
+    return -open
+end
+
+local interval = tonumber(ARGV[1])
+if interval <= 0 then
+    return 0
+end
+
+local time = redis.call("TIME")
+local now = tonumber(time[1]) * 1000 + tonumber(time[2]) / 1000
+local tat = tonumber(redis.call("GET", KEYS[1]) or "0")
+if tat < now then
+    tat = now
+end
+
+local wait = tat - now - (tonumber(ARGV[2]) - 1) * interval
+if wait < 0 then
+    wait = 0
+end
+
+tat = tat + tonumber(ARGV[3]) * interval
+redis.call("SET", KEYS[1], tostring(tat), "PX", math.ceil(tat - now) + 1000)
+return math.ceil(wait)
+"""
+
+# Count requests and failures in the window of an upstream and return both counts.
+# They share a single hash and expiry, so they're reset together.
+RECORD_SCRIPT = """
+local new = redis.call("EXISTS", KEYS[1]) == 0
+local total = redis.call("HINCRBY", KEYS[1], "requests", ARGV[1])
+local failed = redis.call("HINCRBY", KEYS[1], "failures", ARGV[2])
+if new then
+    redis.call("EXPIRE", KEYS[1], ARGV[3])
+end
+return {total, failed}
+"""
+
+acquire_script = redis_connection_queue.register_script(ACQUIRE_SCRIPT)
+record_script = redis_connection_queue.register_script(RECORD_SCRIPT)
+
+
+class RetryableError(Exception):
+    """
+    A request that failed but may succeed if sent again.
+
+    Args:
+        retry_after (float | None): The delay in seconds asked by the upstream before retrying.
+    """
+
+    def __init__(self, message: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class UpstreamError(RetryableError):
+    """
+    The upstream is rate limiting us or failing. It counts towards opening the circuit.
+    """
+
+
+def get_interval(upstream: str) -> float:
+    """
+    Get the time in seconds between two requests to an upstream, 0 if there is no limit.
+    """
+    rate = RATE_LIMITS.get(upstream, 0)
+    return 1 / rate if rate > 0 else 0
+
+
+def reserve(upstream: str, count: int = 1) -> float:
+    """
+    Reserve the next count slots of the rate limit of an upstream.
+    While the circuit of the upstream is open, we wait for it to close.
+
+    The slots are spaced by get_interval(upstream): the caller sends the i-th request
+    i * get_interval(upstream) seconds after the first.
+
+    Args:
+        upstream (str): The name of the upstream: hn, diffbot or embeddings.
+        count (int): The number of requests to send.
+
+    Returns:
+        float: The time in seconds to wait before sending the first request.
+    """
+    while True:
+        wait = acquire(upstream, count)
+        if wait >= 0:
+            return wait / 1000
+
+        time.sleep(-wait / 1000)
+
+
+async def reserve_async(upstream: str, count: int = 1) -> float:
+    """
+    Reserve the next count slots of the rate limit of an upstream, from an event loop.
+    While the circuit of the upstream is open, the coroutine waits without blocking the others.
+
+    Returns:
+        float: The time in seconds to wait before sending the first request.
+    """
+    while True:
+        wait = await asyncio.to_thread(acquire, upstream, count)
+        if wait >= 0:
+            return wait / 1000
+
+        await asyncio.sleep(-wait / 1000)
+
+
+def acquire(upstream: str, count: int) -> float:
+    """
+    Try to reserve the next count slots of the rate limit of an upstream.
+
+    Returns:
+        float: The time in milliseconds to wait before the first slot,
+        or minus the time left before the circuit of the upstream closes.
+    """
+    interval_ms = get_interval(upstream) * 1000
+    burst = max(1, RATE_LIMIT_BURST * RATE_LIMITS.get(upstream, 0))
+    return acquire_script(keys=["ratelimit:{}".format(upstream), "circuit:{}:open".format(upstream)],
+                          args=[interval_ms, burst, count])
+
+
+def is_open(upstream: str) -> bool:
+    """
+    Whether the circuit of an upstream is open. The pollers don't enqueue jobs for it until it closes.
+    """
+    return redis_connection_queue.exists("circuit:{}:open".format(upstream)) > 0
+
+
+def record_requests(upstream: str, count: int, failures: int):
+    """
+    Count the requests sent to an upstream and their failures, and open its circuit if too many failed.
+    The counters are reset every CIRCUIT_WINDOW seconds.
+
+    Args:
+        upstream (str): The name of the upstream.
+        count (int): The number of requests sent.
+        failures (int): The number of these requests that failed.
+    """
+    window_key = "circuit:{}:window".format(upstream)
+    total, failed = record_script(keys=[window_key], args=[
+                                  count, failures, CIRCUIT_WINDOW])
+    if failures == 0:
+        return
+
+    if failed >= CIRCUIT_FAILURES and failed >= CIRCUIT_FAILURE_RATIO * total:
+        opened = redis_connection_queue.set("circuit:{}:open".format(upstream), 1,
+                                            ex=CIRCUIT_COOLDOWN, nx=True)
+        if opened:
+            redis_connection_queue.delete(window_key)
+            print("Circuit of {} opened for {} s after {} failures out of {} requests.".format(
+                upstream, CIRCUIT_COOLDOWN, failed, total))
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """
+    Parse a Retry-After header: a number of seconds or an HTTP date.
+
+    Returns:
+        float | None: The delay in seconds, or None if the header is missing or invalid.
+    """
+    if value is None:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, retry_after: float | None = None) -> float:
+    """
+    Get the delay in seconds before retrying a request.
+
+    Args:
+        attempt (int): The number of the attempt that failed, from 0.
+        retry_after (float | None): The delay asked by the upstream.
+
+    Returns:
+        float: The delay: the Retry-After with a little jitter, or an exponential backoff with full jitter.
+    """
+    if retry_after is not None:
+        return min(BACKOFF_MAX, retry_after) + uniform(0, BACKOFF_BASE)
+    return uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def check_response(response: requests.Response) -> requests.Response:
+    """
+    Raise an UpstreamError if the status of a response is worth retrying.
+
+    Returns:
+        requests.Response: The response.
+    """
+    if response.status_code in RETRYABLE_STATUSES:
+        raise UpstreamError("Status code {} from {}.".format(response.status_code, response.url),
+                            parse_retry_after(response.headers.get("Retry-After")))
+    return response
+
+
+def call(upstream: str, func, tries: int = BACKOFF_TRIES):
+    """
+    Call a function sending a request to an upstream, within its rate limit,
+    and retry it with a backoff if it raises a RetryableError or a connection error.
+
+    Args:
+        upstream (str): The name of the upstream: hn, diffbot or embeddings.
+        func (callable): The function sending the request. It takes no argument.
+        tries (int): The number of attempts.
+
+    Returns:
+        The value returned by func.
+    """
+    for attempt in range(tries):
+        delay = reserve(upstream)
+        if delay > 0:
+            time.sleep(delay)
+
+        try:
+            result = func()
+        except (RetryableError, requests.ConnectionError, requests.Timeout) as e:
+            failed = not isinstance(
+                e, RetryableError) or isinstance(e, UpstreamError)
+            record_requests(upstream, 1, 1 if failed else 0)
+            if attempt == tries - 1:
+                raise
+            time.sleep(backoff_delay(
+                attempt, getattr(e, "retry_after", None)))
+            continue
+
+        record_requests(upstream, 1, 0)
+        return result
@@ -0,0 +1,188 @@
+from persistence import redis_connection_queue, refresh_queue, storage, StoryWriter
+from hn_api import fetch_posts_hn, get_list_HN, parse_story
+from cdc import get_updated_stories, get_changes, CDC_INTERVAL
+from storage import STORY_FIELDS
+from rq import Queue
+from metrics import job
+from rate_limit import is_open
+import time
+
+"""
+Keep the score and the number of comments of the stories up-to-date.
+
+Each story to refresh has an entry in the sorted set refresh:schedule
+whose score is the timestamp of its next refresh.
+The delay between two refreshes grows with the age of the story:
+a story of one hour is refreshed every few minutes, a story of a week twice a day.
+After REFRESH_MAX_AGE, the story is not refreshed anymore.
+
+The stories enter the schedule from the top, new and best lists.
+The updates feed only moves stories already known to the front of the schedule.
+
+With the change data capture (CDC_INTERVAL, see cdc.py), the changes come from the updates feed:
+the refresh doesn't read it, doesn't force the front page, and only re-crawls the stories
+CDC_REFRESH_FACTOR times less often, as a safety net for the changes the feed missed.
+"""
+
+# The sorted set of the stories to refresh. The score is the timestamp of the next refresh.
+SCHEDULE_KEY = "refresh:schedule"
+
+# The minimum delay in seconds between two refreshes of a story.
+REFRESH_MIN_DELAY = 300
+# The delay between two refreshes is the age of the story times this factor.
+REFRESH_AGE_FACTOR = 0.1
+# The age in seconds after which a story is not refreshed anymore (two weeks).
+REFRESH_MAX_AGE = 14 * 24 * 3600
+# The number of stories of the top list refreshed every cycle, whatever their schedule.
+TOP_STORIES_COUNT = 100
+# The factor of the delay between two refreshes when the change data capture is enabled.
+CDC_REFRESH_FACTOR = 4
+
+# The interval in seconds between two cycles.
+REFRESH_INTERVAL = 60
+# The maximum number of stories refreshed per cycle.
+# It bounds the number of API calls per hour to REFRESH_MAX_PER_CYCLE * 3600 / REFRESH_INTERVAL.
+REFRESH_MAX_PER_CYCLE = 1000
+# The number of stories fetched by a single refresh job.
+REFRESH_CHUNK_SIZE = 100
+# The delay in seconds before a dispatched story can be dispatched again
+# if its job never reschedules it (e.g. the job failed).
+REFRESH_LEASE = 1800
+
+
+def next_refresh_delay(age: float) -> float | None:
+    """
+    Compute the delay before the next refresh of a story.
+
+    Args:
+        age (float): The age of the story in seconds.
+
+    Returns:
+        float | None: The delay in seconds, or None if the story is too old to be refreshed.
+    """
+    if age > REFRESH_MAX_AGE:
+        return None
+    delay = max(REFRESH_MIN_DELAY, age * REFRESH_AGE_FACTOR)
+    return delay * CDC_REFRESH_FACTOR if CDC_INTERVAL > 0 else delay
+
+
+def schedule_hot_stories():
+    """
+    Add the stories of the top, new and best lists to the schedule,
+    and move the stories changed recently to the front of it.
+    With the change data capture, cdc.py applies the changes instead.
+    """
+    now = time.time()
+
+    top = get_list_HN("topstories")
+    lists = top + get_list_HN("newstories") + get_list_HN("beststories")
+    # The updated stories we know. Most of the updated items are comments we don't store.
+    known = get_updated_stories() if CDC_INTERVAL == 0 else []
+
+    pipe = redis_connection_queue.pipeline(transaction=False)
+    # The stories of the lists keep their schedule if they have one.
+    if len(lists) > 0:
+        pipe.zadd(SCHEDULE_KEY, {id: now for id in lists}, nx=True)
+    # The first stories of the front page and the stories updated are due now.
+    due_now = known if CDC_INTERVAL > 0 else top[:TOP_STORIES_COUNT] + known
+    if len(due_now) > 0:
+        pipe.zadd(SCHEDULE_KEY, {id: now for id in due_now})
+    pipe.execute()
+
+    print("Scheduled {} stories from lists, {} updated.".format(
+        len(set(lists)), len(known)))
+
+
+def dispatch_due_refreshes():
+    """
+    Push the stories due for a refresh to the queue.
+
+    We lease the stories dispatched by pushing back their next refresh,
+    so they're not dispatched twice while the job is pending.
+    The job sets the real schedule once the story is fetched.
+    """
+    now = time.time()
+    due = redis_connection_queue.zrangebyscore(
+        SCHEDULE_KEY, "-inf", now, start=0, num=REFRESH_MAX_PER_CYCLE)
+    if len(due) == 0:
+        return
+
+    ids = [int(id) for id in due]
+    jobs_list = []
+    for i in range(0, len(ids), REFRESH_CHUNK_SIZE):
+        jobs_list.append(
+            Queue.prepare_data(refresh_stories_redis,
+                               (ids[i:i + REFRESH_CHUNK_SIZE],),
+                               timeout=120,
+                               result_ttl=10)
+        )
+
+    pipe = redis_connection_queue.pipeline()
+    refresh_queue.enqueue_many(jobs_list, pipeline=pipe)
+    pipe.zadd(SCHEDULE_KEY, {id: now + REFRESH_LEASE for id in ids}, xx=True)
+    pipe.execute()
+
+    print("Dispatched {} stories to refresh in {} jobs.".format(
+        len(ids), len(jobs_list)))
+
+
+@job("refresh_stories")
+def refresh_stories_redis(ids: list[int]):
+    """
+    Fetch stories from Hacker News, update them in Redis and reschedule them.
+
+    Only the stories that changed are written, so the unchanged ones don't fill the changelog
+    replayed by the export and the search index.
+
+    Args:
+        ids (list[int]): The IDs of the stories.
+    """
+    stories = fetch_posts_hn(ids)
+    stored = storage.read_posts(ids, STORY_FIELDS)
+    now = time.time()
+
+    schedule = {}
+    with StoryWriter() as writer:
+        for id, current in zip(ids, stored):
+            story = stories.get(id)
+            if story is None:
+                # We couldn't fetch it. We'll retry when the lease expires.
+                continue
+
+            mapping = parse_story(id, story)
+            if mapping is None:
+                # Not a story, dead or deleted. We stop refreshing it.
+                schedule[id] = None
+                continue
+
+            # The new stories of the lists aren't stored yet: all their fields change.
+            if len(get_changes(current, mapping)) > 0:
+                writer.add(id, mapping)
+            delay = next_refresh_delay(now - mapping["time"])
+            schedule[id] = now + delay if delay is not None else None
+
+    pipe = redis_connection_queue.pipeline(transaction=False)
+    to_remove = [id for id, next_time in schedule.items() if next_time is None]
+    to_update = {id: next_time for id, next_time in schedule.items()
+                 if next_time is not None}
+    if len(to_remove) > 0:
+        pipe.zrem(SCHEDULE_KEY, *to_remove)
+    if len(to_update) > 0:
+        pipe.zadd(SCHEDULE_KEY, to_update)
+    pipe.execute()
+
+    print("Refreshed {} stories, {} changed, {} are not refreshed anymore.".format(
+        len(to_update), writer.written, len(to_remove)))
+
+
+def pollHotStories():
+    """
+    Run a refresh cycle.
+    """
+    print("Polling hot stories.")
+    if is_open("hn"):
+        print("The circuit of the Hacker News API is open. Skipping.")
+        return
+
+    schedule_hot_stories()
+    dispatch_due_refreshes()
@@ -0,0 +1,163 @@
+from persistence import redis_connection_queue, storage, get_known_stories_in_range
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from os import getenv
+import multiprocessing
+import time
+
+"""
+Read all the posts of Redis in parallel.
+
+A single SCAN cursor can't be split between workers, but the IDs of Hacker News
+are sequential: the posts have an ID between 1 and max:ID:hn.
+So we split the ID space in ranges and a pool of processes reads them.
+Each worker fetches its range with pipelined reads (see storage.py), drops the IDs that are not
+in Redis (comments, jobs, etc.) and runs a function on the posts found.
+The results are sent back to the caller, which consumes them in a single process
+(e.g. to insert them in DuckDB).
+
+At most two ranges per worker are in flight, so the memory used doesn't depend
+on the number of posts even if the caller is slower than the workers.
+
+The workers are spawned, not forked: the scheduler calls scan_posts from a thread,
+and a forked child would inherit the locks and the Redis connections of the other threads.
+Each worker imports the module of the function again, which takes about a second.
+
+Once the indexes are built (see indexes.py), the callers pass indexed=True: a worker reads the IDs
+of the stories of its range from the bitmap idx:stories, one GETRANGE of range / 8 bytes,
+and only sends an HMGET per story instead of one per ID, most of which are comments.
+The trade-off is that a post missing from the bitmap isn't read: the posts without score or time,
+which aren't indexed, and the stories written by a process that doesn't index its writes.
+indexes.py rebuilds the indexes themselves with a full read.
+"""
+
+# The number of processes reading Redis.
+SCAN_WORKERS = int(getenv("SCAN_WORKERS", "4"))
+# The number of IDs per range, i.e. per task of a worker.
+SCAN_RANGE_SIZE = int(getenv("SCAN_RANGE_SIZE", "100000"))
+# The number of HMGET sent in a single pipeline.
+PIPELINE_SIZE = 10000
+
+
+def get_max_id_redis() -> int:
+    """
+    Get the highest ID enqueued for ingestion. No post has a higher ID.
+
+    Returns:
+        int: The max ID, or 0 if nothing has been ingested yet.
+    """
+    max_id = redis_connection_queue.get("max:ID:hn")
+    return int(max_id) if max_id is not None else 0
+
+
+def read_posts(ids, fields: tuple[str]) -> tuple[list[int], list[list[bytes]]]:
+    """
+    Fetch posts with pipelined reads of the storage layout.
+
+    Args:
+        ids (Iterable[int]): The IDs of the posts.
+        fields (tuple[str]): The fields of the posts to fetch.
+
+    Returns:
+        tuple[list[int], list[list[bytes]]]: The IDs of the posts found and their fields.
+        The IDs that are not in Redis (comments, jobs, etc.) are dropped.
+    """
+    ids = list(ids)
+    found_ids = []
+    rows = []
+    for i in range(0, len(ids), PIPELINE_SIZE):
+        batch_ids = ids[i:i + PIPELINE_SIZE]
+        for id, row in zip(batch_ids, storage.read_posts(batch_ids, fields)):
+            # All the fields are None if the key doesn't exist.
+            if any(value is not None for value in row):
+                found_ids.append(id)
+                rows.append(row)
+
+    return found_ids, rows
+
+
+def read_range(start: int, end: int, fields: tuple[str], func, indexed: bool = False):
+    """
+    Fetch the posts in the range [start, end) and run func on them.
+    It runs in a worker process.
+
+    Args:
+        start (int): The first ID of the range.
+        end (int): The ID after the last ID of the range.
+        fields (tuple[str]): The fields of the posts to fetch.
+        func (callable): A function taking the IDs of the posts and their fields.
+            It must be defined at the top level of a module to be sent to the workers.
+        indexed (bool): Only fetch the stories of the bitmap idx:stories.
+
+    Returns:
+        tuple[int, object]: The number of posts found and the result of func.
+    """
+    ids = get_known_stories_in_range(start, end) if indexed else range(start, end)
+    ids, rows = read_posts(ids, fields)
+    return len(ids), func(ids, rows)
+
+
+def scan_posts(fields: tuple[str], func, workers: int = SCAN_WORKERS,
+               range_size: int = SCAN_RANGE_SIZE, max_id: int = None, indexed: bool = False):
+    """
+    Read all the posts in Redis in parallel.
+
+    Usage:
+        for result in scan_posts(("score",), count_posts):
+            total += result
+
+    Args:
+        fields (tuple[str]): The fields of the posts to fetch.
+        func (callable): A function taking the IDs of the posts and their fields, run by the workers.
+        workers (int): The number of processes. With 1, the ranges are read in the current process.
+        range_size (int): The number of IDs per range.
+        max_id (int): The highest ID to read. By default, max:ID:hn.
+        indexed (bool): Only read the stories of the bitmap idx:stories. Pass is_index_ready().
+
+    Yields:
+        object: The result of func for each range, in no particular order.
+    """
+    if max_id is None:
+        max_id = get_max_id_redis()
+
+    ranges = [(start, min(start + range_size, max_id + 1))
+              for start in range(1, max_id + 1, range_size)]
+
+    before = time.time()
+    posts = 0
+    ids_read = 0
+
+    def report(found: int, start: int, end: int):
+        nonlocal posts, ids_read
+        posts += found
+        ids_read += end - start
+        elapsed = time.time() - before
+        print("Read {} / {} IDs, {} posts in {:.1f} s ({:.0f} IDs/s, {:.0f} posts/s).".format(
+            ids_read, max_id, posts, elapsed,
+            ids_read / elapsed if elapsed > 0 else 0,
+            posts / elapsed if elapsed > 0 else 0))
+
+    if workers <= 1:
+        for start, end in ranges:
+            found, result = read_range(start, end, fields, func, indexed)
+            report(found, start, end)
+            yield result
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        pending = {}
+        next_range = 0
+        while next_range < len(ranges) or len(pending) > 0:
+            # We keep at most two ranges per worker in flight.
+            while next_range < len(ranges) and len(pending) < workers * 2:
+                start, end = ranges[next_range]
+                future = executor.submit(
+                    read_range, start, end, fields, func, indexed)
+                pending[future] = (start, end)
+                next_range += 1
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                start, end = pending.pop(future)
+                found, result = future.result()
+                report(found, start, end)
+                yield result
@@ -0,0 +1,174 @@
+from persistence import redis_connection_queue
+from metrics import STAGE_LATENCY
+from random import uniform
+from uuid import uuid4
+import asyncio
+import signal
+import time
+
+"""
+A single long-lived scheduler running the periodic tasks of the scraper.
+
+Each task runs in its own coroutine: it runs the function in a thread, waits
+for it to return, then sleeps for its interval (with some jitter).
+Hence a task never overlaps with itself, even if it takes longer than its interval.
+
+Several schedulers can run at the same time for high availability.
+Only the one holding the leader lock in Redis runs the tasks; the others wait
+to take over if the leader stops renewing the lock.
+"""
+
+# The key of the leader lock.
+LEADER_KEY = "scheduler:leader"
+# The time in seconds after which the lock expires if the leader doesn't renew it.
+LEADER_TTL = 30
+# The interval in seconds between two attempts to acquire or renew the lock.
+LEADER_RENEW_INTERVAL = 10
+
+# Renew the lock only if we still own it.
+RENEW_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Release the lock only if we still own it.
+RELEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+class PeriodicTask:
+    """
+    A function to run every interval seconds.
+
+    Args:
+        name (str): The name of the task, used in the logs.
+        func (callable): The function to run. It takes no argument.
+        interval (float): The interval in seconds between the end of a run and the start of the next one.
+        jitter (float): The maximum random delay in seconds added or removed from the interval,
+            so the tasks of several processes don't run in lockstep.
+    """
+
+    def __init__(self, name: str, func, interval: float, jitter: float = 0):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+
+    def next_delay(self) -> float:
+        return max(0, self.interval + uniform(-self.jitter, self.jitter))
+
+
+class Scheduler:
+    """
+    Run periodic tasks while holding the leader lock.
+
+    Usage:
+        scheduler = Scheduler([PeriodicTask("poll", pollNewStory, 10, 2)])
+        scheduler.run()
+    """
+
+    def __init__(self, tasks: list[PeriodicTask]):
+        self.tasks = tasks
+        # A unique value identifying this scheduler in the lock.
+        self.identity = str(uuid4())
+        self.is_leader = False
+        self.stopping: asyncio.Event = None
+
+    def try_acquire_leadership(self) -> bool:
+        """
+        Acquire the leader lock, or renew it if we already hold it.
+
+        Returns:
+            bool: True if we are the leader.
+        """
+        ttl_ms = LEADER_TTL * 1000
+        if self.is_leader:
+            renewed = redis_connection_queue.eval(
+                RENEW_SCRIPT, 1, LEADER_KEY, self.identity, ttl_ms)
+            if not renewed:
+                print("Leadership lost.")
+            self.is_leader = bool(renewed)
+        else:
+            acquired = redis_connection_queue.set(
+                LEADER_KEY, self.identity, nx=True, px=ttl_ms)
+            if acquired:
+                print("Leadership acquired.")
+            self.is_leader = bool(acquired)
+
+        return self.is_leader
+
+    def release_leadership(self):
+        if self.is_leader:
+            redis_connection_queue.eval(
+                RELEASE_SCRIPT, 1, LEADER_KEY, self.identity)
+            self.is_leader = False
+            print("Leadership released.")
+
+    async def sleep(self, delay: float) -> bool:
+        """
+        Sleep for delay seconds or until the scheduler stops.
+
+        Returns:
+            bool: True if the scheduler is stopping.
+        """
+        try:
+            await asyncio.wait_for(self.stopping.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+        return self.stopping.is_set()
+
+    async def run_leadership(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.try_acquire_leadership)
+            except Exception as e:
+                # We can't reach Redis. We can't be sure we are still the leader.
+                print("Error while renewing leadership: {}".format(e))
+                self.is_leader = False
+
+            if await self.sleep(LEADER_RENEW_INTERVAL):
+                return
+
+    async def run_task(self, task: PeriodicTask):
+        # We spread the first runs of the tasks.
+        if await self.sleep(uniform(0, task.jitter)):
+            return
+
+        while True:
+            if self.is_leader:
+                before = time.time()
+                try:
+                    await asyncio.to_thread(task.func)
+                except Exception as e:
+                    # A failing task must not stop the scheduler.
+                    print("Task {} failed: {}".format(task.name, e))
+                STAGE_LATENCY.labels(task.name).observe(time.time() - before)
+                print("Task {} took {} ms".format(
+                    task.name, (time.time() - before) * 1000))
+
+            if await self.sleep(task.next_delay()):
+                return
+
+    async def run_async(self):
+        self.stopping = asyncio.Event()
+
+        # We stop gracefully on SIGTERM (docker stop) and SIGINT (Ctrl+C).
+        # The tasks running finish their current run.
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.stopping.set)
+
+        await asyncio.gather(self.run_leadership(),
+                             *[self.run_task(task) for task in self.tasks])
+
+        await asyncio.to_thread(self.release_leadership)
+        print("Scheduler stopped.")
+
+    def run(self):
+        asyncio.run(self.run_async())
@@ -0,0 +1,425 @@
+from persistence import storage, get_changelog_end, changelog_has_gap, read_changed_ids
+from scan import scan_posts, read_posts, SCAN_WORKERS
+from indexes import is_index_ready
+from embedding_format import decode_embedding, DIMENSIONS
+from os import makedirs, remove, getenv
+from shutil import rmtree
+import numpy as np
+import json
+import time
+import sys
+
+"""
+Similarity search over the embeddings stored in Redis.
+
+The index is built from all the embeddings in Redis and saved in a folder:
+- ids.npy: the IDs of the posts
+- vectors.npy: their normalized embeddings, one row per post (memory-mapped when loaded)
+- centroids.npy and offsets.npy: the inverted file (IVF), only for large indexes
+- meta.json: the position in the changelog when the index was built
+
+Small indexes are searched exactly: a batched dot product over all the vectors.
+Large indexes are clustered with k-means; the vectors are sorted by cluster and a search
+only scans the nprobe clusters closest to the query. It's approximate: a neighbor
+in a cluster not scanned is missed. benchmark_search.py measures the recall.
+
+The posts embedded after the build are read from the changelog by update(),
+and searched exactly in a small in-memory array. The changelog also logs the posts whose score
+or title changed: update() compares their embedding to the one in the index and skips it if it's the same.
+"""
+
+# The folder of the index.
+INDEX_FOLDER = getenv("SEARCH_INDEX_FOLDER", "search_index")
+# Below this number of vectors, the index is searched exactly.
+IVF_MIN_SIZE = 50000
+# The number of clusters scanned by an approximate search.
+NPROBE = int(getenv("SEARCH_NPROBE", "16"))
+# The number of k-means iterations when building the IVF.
+KMEANS_ITERATIONS = 10
+# The number of vectors per cluster used to train k-means.
+KMEANS_SAMPLES_PER_CLUSTER = 64
+# The number of vectors multiplied at once, to bound the memory used.
+BLOCK_SIZE = 65536
+# The maximum difference between the components of two vectors considered the same embedding.
+# A vector is normalized again when added, so it isn't exactly the one in the index.
+SAME_VECTOR_TOLERANCE = 1e-6
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """
+    Scale vectors to unit length, so the dot product is the cosine similarity.
+    """
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Get the positions of the k highest scores, sorted by decreasing score.
+    """
+    if len(scores) > k:
+        positions = np.argpartition(-scores, k)[:k]
+    else:
+        positions = np.arange(len(scores))
+    return positions[np.argsort(-scores[positions])]
+
+
+def read_embeddings(ids: list[int], rows: list[list[bytes]]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Decode the embeddings of posts read from Redis.
+    It runs in the workers of scan_posts.
+
+    Args:
+        ids (list[int]): The IDs of the posts.
+        rows (list[list[bytes]]): The "embeddings" field of each post.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The IDs of the posts with an embedding and their normalized embeddings.
+    """
+    found = [(id, decode_embedding(row[0])) for id, row in zip(ids, rows)
+             if row[0] is not None]
+    found = [(id, vector) for id, vector in found if len(vector) == DIMENSIONS]
+    if len(found) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, DIMENSIONS), dtype=np.float32)
+
+    return (np.array([id for id, _ in found], dtype=np.int64),
+            normalize(np.stack([vector for _, vector in found])).astype(np.float32))
+
+
+def train_ivf(vectors: np.ndarray, nlist: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Cluster the vectors with spherical k-means.
+
+    Args:
+        vectors (np.ndarray): The normalized vectors.
+        nlist (int): The number of clusters.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The centroids and the cluster of each vector.
+    """
+    rng = np.random.default_rng(0)
+    samples_count = min(len(vectors), nlist * KMEANS_SAMPLES_PER_CLUSTER)
+    samples = np.asarray(vectors[np.sort(rng.choice(
+        len(vectors), samples_count, replace=False))])
+    centroids = samples[rng.choice(samples_count, nlist, replace=False)]
+
+    for _ in range(KMEANS_ITERATIONS):
+        assignment = assign_clusters(samples, centroids)
+        for cluster in range(nlist):
+            members = samples[assignment == cluster]
+            if len(members) > 0:
+                centroids[cluster] = members.mean(axis=0)
+            else:
+                # We move an empty cluster to a random sample.
+                centroids[cluster] = samples[rng.integers(samples_count)]
+        centroids = normalize(centroids).astype(np.float32)
+
+    return centroids, assign_clusters(vectors, centroids)
+
+
+def assign_clusters(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """
+    Get the closest centroid of each vector.
+    """
+    assignment = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), BLOCK_SIZE):
+        block = np.asarray(vectors[start:start + BLOCK_SIZE])
+        assignment[start:start + BLOCK_SIZE] = np.argmax(
+            block @ centroids.T, axis=1)
+    return assignment
+
+
+def write_index(folder: str, ids: np.ndarray, vectors: np.ndarray, changelog_id: str = "0-0"):
+    """
+    Save an index built from normalized vectors.
+
+    Args:
+        folder (str): The folder of the index. Its content is replaced.
+        ids (np.ndarray): The IDs of the posts.
+        vectors (np.ndarray): Their normalized embeddings. It can be memory-mapped.
+        changelog_id (str): The position in the changelog when the vectors were read.
+    """
+    rmtree(folder, ignore_errors=True)
+    makedirs(folder)
+
+    order = np.arange(len(ids))
+    if len(ids) >= IVF_MIN_SIZE:
+        nlist = int(np.sqrt(len(ids)))
+        before = time.time()
+        centroids, assignment = train_ivf(vectors, nlist)
+        print("Trained {} clusters in {:.1f} s.".format(
+            nlist, time.time() - before))
+
+        # The vectors are sorted by cluster, so a cluster is a contiguous slice.
+        order = np.argsort(assignment, kind="stable")
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assignment, minlength=nlist))
+        np.save("{}/centroids.npy".format(folder), centroids)
+        np.save("{}/offsets.npy".format(folder), offsets)
+
+    np.save("{}/ids.npy".format(folder), ids[order])
+    output = np.lib.format.open_memmap("{}/vectors.npy".format(folder), mode="w+",
+                                       dtype=np.float32, shape=(len(ids), DIMENSIONS))
+    for start in range(0, len(ids), BLOCK_SIZE):
+        output[start:start + BLOCK_SIZE] = vectors[order[start:start + BLOCK_SIZE]]
+    output.flush()
+    del output
+
+    with open("{}/meta.json".format(folder), "w") as f:
+        json.dump({"changelog_id": changelog_id}, f)
+
+
+def build_index(folder: str = INDEX_FOLDER, workers: int = SCAN_WORKERS):
+    """
+    Build the index from all the embeddings stored in Redis.
+
+    The vectors are appended to a temporary file as they are read,
+    so the memory used doesn't depend on the number of embeddings.
+
+    Args:
+        folder (str): The folder of the index.
+        workers (int): The number of processes reading Redis.
+    """
+    # We read the position before the embeddings, so the embeddings written
+    # while we read them are added by the next update.
+    changelog_id = get_changelog_end()
+
+    temporary = "{}.vectors.tmp".format(folder)
+    ids = []
+    with open(temporary, "wb") as f:
+        for batch_ids, batch_vectors in scan_posts(("embeddings",), read_embeddings, workers,
+                                                   indexed=is_index_ready()):
+            ids.append(batch_ids)
+            f.write(batch_vectors.tobytes())
+
+    ids = np.concatenate(ids) if len(ids) > 0 else np.zeros(0, dtype=np.int64)
+    vectors = np.memmap(temporary, dtype=np.float32, mode="r",
+                        shape=(len(ids), DIMENSIONS)) if len(ids) > 0 else np.zeros((0, DIMENSIONS), dtype=np.float32)
+    write_index(folder, ids, vectors, changelog_id)
+    del vectors
+    remove(temporary)
+    print("Indexed {} embeddings.".format(len(ids)))
+
+
+class VectorIndex:
+    """
+    Search the posts whose embeddings are the closest to a query.
+
+    Usage:
+        index = VectorIndex.load()
+        index.update()
+        for id, score in index.search("Rust for embedded systems", 10):
+            print(id, score)
+    """
+
+    def __init__(self, ids: np.ndarray, vectors: np.ndarray, centroids: np.ndarray = None,
+                 offsets: np.ndarray = None, changelog_id: str = "0-0"):
+        self.ids = ids
+        self.vectors = vectors
+        self.centroids = centroids
+        self.offsets = offsets
+        self.changelog_id = changelog_id
+
+        # The vectors added after the build, searched exactly.
+        self.added_ids: list[int] = []
+        self.added_vectors: list[np.ndarray] = []
+        self.added_positions: dict[int, int] = {}
+        # The number of added posts that also are in the built index with an old vector.
+        self.replaced = 0
+        # The positions of the IDs by increasing ID, to find the vector of a post in the built index.
+        self.order = np.argsort(ids, kind="stable")
+
+    @classmethod
+    def load(cls, folder: str = INDEX_FOLDER):
+        """
+        Load an index saved by build_index. The vectors are memory-mapped.
+        """
+        ids = np.load("{}/ids.npy".format(folder))
+        vectors = np.load("{}/vectors.npy".format(folder), mmap_mode="r")
+        centroids = None
+        offsets = None
+        try:
+            centroids = np.load("{}/centroids.npy".format(folder))
+            offsets = np.load("{}/offsets.npy".format(folder))
+        except FileNotFoundError:
+            pass
+
+        with open("{}/meta.json".format(folder)) as f:
+            meta = json.load(f)
+
+        return cls(ids, vectors, centroids, offsets, meta["changelog_id"])
+
+    def __len__(self) -> int:
+        return len(self.ids) + len(self.added_ids) - self.replaced
+
+    def built_position(self, id: int) -> int | None:
+        """
+        Get the position of a post in the built index.
+
+        Returns:
+            int | None: The position of its vector, or None if it's not in the built index.
+        """
+        index = np.searchsorted(self.ids, id, sorter=self.order)
+        if index < len(self.order) and self.ids[self.order[index]] == id:
+            return int(self.order[index])
+        return None
+
+    def add(self, id: int, vector) -> bool:
+        """
+        Add the embedding of a post, or replace it if the post is already in the index.
+
+        Args:
+            id (int): The ID of the post.
+            vector (list[float] | np.ndarray): Its embedding.
+
+        Returns:
+            bool: False if the post is already in the index with the same embedding.
+        """
+        vector = normalize(np.asarray(vector, dtype=np.float32))
+        if id in self.added_positions:
+            position = self.added_positions[id]
+            if np.allclose(self.added_vectors[position], vector, rtol=0, atol=SAME_VECTOR_TOLERANCE):
+                return False
+            self.added_vectors[position] = vector
+            return True
+
+        position = self.built_position(id)
+        if position is not None and np.allclose(self.vectors[position], vector, rtol=0,
+                                                atol=SAME_VECTOR_TOLERANCE):
+            return False
+
+        self.added_positions[id] = len(self.added_ids)
+        self.added_ids.append(id)
+        self.added_vectors.append(vector)
+        if position is not None:
+            self.replaced += 1
+        return True
+
+    def update(self) -> int:
+        """
+        Add the embeddings written since the index was built or last updated.
+        The changes are read from the changelog. Most are changes of the score or the title:
+        the posts whose embedding is already in the index are skipped, so they aren't searched twice.
+
+        Returns:
+            int: The number of embeddings added or replaced.
+        """
+        if changelog_has_gap(self.changelog_id):
+            print("The changelog has been trimmed. Embeddings may be missing: rebuild the index.")
+
+        end_id = get_changelog_end()
+        ids, rows = read_posts(sorted(read_changed_ids(
+            self.changelog_id, end_id)), ("embeddings",))
+        ids, vectors = read_embeddings(ids, rows)
+        added = 0
+        for id, vector in zip(ids.tolist(), vectors):
+            if self.add(id, vector):
+                added += 1
+
+        self.changelog_id = end_id
+        return added
+
+    def search(self, query, k: int = 10, nprobe: int = NPROBE) -> list[tuple[int, float]]:
+        """
+        Search the posts closest to a query.
+
+        Args:
+            query (str | list[float] | np.ndarray): A text, embedded with the OpenAI API, or an embedding.
+            k (int): The number of posts to return.
+            nprobe (int): The number of clusters scanned if the index is approximate.
+
+        Returns:
+            list[tuple[int, float]]: The IDs of the posts and their cosine similarity, by decreasing similarity.
+        """
+        if isinstance(query, str):
+            # The import is here because it loads the tokenizer and the OpenAI client.
+            from embeddings import compute_embeddings_text
+            query = compute_embeddings_text(query)
+        query = normalize(np.asarray(query, dtype=np.float32))
+
+        # A post added since the build may be returned with its old vector.
+        # We fetch more results to still have k after removing them.
+        candidates_ids, candidates_scores = self.search_built(
+            query, k + self.replaced, nprobe)
+        keep = [id not in self.added_positions for id in candidates_ids.tolist()]
+        candidates_ids = candidates_ids[keep]
+        candidates_scores = candidates_scores[keep]
+
+        if len(self.added_ids) > 0:
+            added_scores = np.stack(self.added_vectors) @ query
+            candidates_ids = np.concatenate(
+                [candidates_ids, np.array(self.added_ids, dtype=np.int64)])
+            candidates_scores = np.concatenate(
+                [candidates_scores, added_scores])
+
+        positions = top_k(candidates_scores, k)
+        return list(zip(candidates_ids[positions].tolist(), candidates_scores[positions].tolist()))
+
+    def search_exact(self, query: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Search the built index by scanning all the vectors.
+
+        Args:
+            query (np.ndarray): The normalized query.
+            k (int): The number of posts to return.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The IDs and the scores of the closest posts.
+        """
+        return self.search_slices(query, k, [(0, len(self.ids))])
+
+    def search_built(self, query: np.ndarray, k: int, nprobe: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Search the built index, approximately if it has clusters.
+        """
+        if self.centroids is None:
+            return self.search_exact(query, k)
+
+        clusters = top_k(self.centroids @ query, nprobe)
+        return self.search_slices(query, k, [(self.offsets[cluster], self.offsets[cluster + 1])
+                                             for cluster in clusters])
+
+    def search_slices(self, query: np.ndarray, k: int,
+                      slices: list[tuple[int, int]]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Compute the scores of the vectors in slices and keep the k best.
+        """
+        best_positions = [np.zeros(0, dtype=np.int64)]
+        best_scores = [np.zeros(0, dtype=np.float32)]
+        for slice_start, slice_end in slices:
+            for start in range(slice_start, slice_end, BLOCK_SIZE):
+                end = min(start + BLOCK_SIZE, slice_end)
+                scores = self.vectors[start:end] @ query
+                positions = top_k(scores, k)
+                best_positions.append(positions + start)
+                best_scores.append(scores[positions])
+
+        positions = np.concatenate(best_positions)
+        scores = np.concatenate(best_scores)
+        best = top_k(scores, k)
+        return self.ids[positions[best]], scores[best]
+
+
+if __name__ == "__main__":
+    # python search.py build: build the index from Redis.
+    # python search.py <text>: search the posts closest to the text.
+    if len(sys.argv) > 1 and sys.argv[1] == "build":
+        now = time.time()
+        build_index()
+        print("Building the index took {} ms".format((time.time() - now) * 1000))
+    else:
+        index = VectorIndex.load()
+        print("{} embeddings added since the build.".format(index.update()))
+
+        now = time.time()
+        results = index.search(" ".join(sys.argv[1:]))
+        print("Search took {} ms".format((time.time() - now) * 1000))
+
+        rows = storage.read_posts([id for id, _ in results], ("title", "url"))
+        for (id, score), (title, url) in zip(results, rows):
+            # The post may have been deleted from Redis since it was indexed.
+            if title is None:
+                print("{:.3f} {} (deleted)".format(score, id))
+                continue
+            print("{:.3f} {} {} {}".format(score, id, title.decode(
+                "utf-8"), url.decode("utf-8") if url is not None else ""))
@@ -0,0 +1,262 @@
+import redis
+from os import getenv
+import struct
+
+"""
+The layouts of the stories in Redis. The readers and the writers use the layout of STORAGE_LAYOUT
+through persistence.storage, so they don't depend on the keys.
+
+- hash (default): a hash hn:<id> per story, with a field per attribute stored as a string.
+- bucket: the stories of BUCKET_SIZE consecutive IDs share the hash hn:b:<id // BUCKET_SIZE>.
+  The field is the ID modulo BUCKET_SIZE, the value the story packed with struct (see pack_story).
+  Only about one ID out of ten is a story today, so a recent bucket holds about 100 small entries and
+  Redis keeps it in the compact listpack encoding, instead of a key, a hash table and
+  six strings per story. The embeddings are too large for a listpack: they are in the string hn:e:<id>.
+
+The bucket layout only stays compact if the buckets fit in a listpack:
+set hash-max-listpack-value (hash-max-ziplist-value before Redis 7) to 512 in the Redis configuration,
+and hash-max-listpack-entries (hash-max-ziplist-entries) to BUCKET_SIZE. The default of 128 entries
+isn't enough: the first IDs of Hacker News are mostly stories, so their buckets hold up to BUCKET_SIZE
+stories and would be converted to hash tables.
+
+The values read are bytes in both layouts, as HMGET returns them, and None for a missing field.
+Use migrate_storage.py to move the stories from a layout to the other, and benchmark_storage.py
+to compare the memory they use.
+"""
+
+# The layout of the stories: hash or bucket.
+STORAGE_LAYOUT = getenv("STORAGE_LAYOUT", "hash")
+# The number of consecutive IDs of a bucket.
+BUCKET_SIZE = 1000
+
+# The attributes of a story, without its embeddings.
+STORY_FIELDS = ("by", "title", "url", "score", "time", "comments")
+
+# The packed story: score, time, number of comments, length of the author, length of the title.
+# The author, the title and the URL follow, encoded in UTF-8. The URL takes the rest of the value.
+STORY_HEADER = struct.Struct("<iIIBH")
+
+
+def to_bytes(value) -> bytes:
+    """
+    Encode a value in UTF-8, unless it's already bytes (e.g. read from Redis).
+    """
+    return value if isinstance(value, bytes) else str(value).encode("utf-8")
+
+
+def pack_story(mapping: dict) -> bytes:
+    """
+    Pack the attributes of a story in a few bytes.
+
+    Args:
+        mapping (dict): The attributes of the story, as written to the hash layout or read from it.
+
+    Returns:
+        bytes: The packed story.
+    """
+    by = to_bytes(mapping["by"])
+    title = to_bytes(mapping["title"])
+    url = to_bytes(mapping["url"])
+    return STORY_HEADER.pack(int(mapping["score"]), int(mapping["time"]), int(mapping["comments"]),
+                             len(by), len(title)) + by + title + url
+
+
+def unpack_story(data: bytes) -> dict[str, bytes]:
+    """
+    Unpack a story packed by pack_story.
+
+    Returns:
+        dict[str, bytes]: The attributes of the story, as the hash layout returns them.
+    """
+    score, time, comments, by_length, title_length = STORY_HEADER.unpack_from(
+        data)
+    start = STORY_HEADER.size
+    return {
+        "by": data[start:start + by_length],
+        "title": data[start + by_length:start + by_length + title_length],
+        "url": data[start + by_length + title_length:],
+        "score": str(score).encode("utf-8"),
+        "time": str(time).encode("utf-8"),
+        "comments": str(comments).encode("utf-8"),
+    }
+
+
+class HashLayout:
+    """
+    A hash hn:<id> per story.
+
+    Args:
+        connection (redis.Redis): The connection to the database of the posts.
+    """
+    name = "hash"
+
+    def __init__(self, connection: redis.Redis):
+        self.connection = connection
+
+    def key(self, id) -> str:
+        return "hn:{}".format(id)
+
+    def write_story(self, pipe: redis.client.Pipeline, id, mapping: dict):
+        """
+        Add the write of the attributes of a story to a pipeline. Its embeddings are kept.
+        """
+        pipe.hset(self.key(id), mapping=mapping)
+
+    def update_story(self, pipe: redis.client.Pipeline, id, changed: dict, mapping: dict):
+        """
+        Add the write of the fields of a story that changed to a pipeline.
+
+        Args:
+            changed (dict): The fields that changed and their new value.
+            mapping (dict): All the attributes of the story, with the new values.
+        """
+        pipe.hset(self.key(id), mapping=changed)
+
+    def write_embeddings(self, pipe: redis.client.Pipeline, id, data: bytes):
+        """
+        Add the write of the encoded embeddings of a story to a pipeline.
+        """
+        pipe.hset(self.key(id), "embeddings", data)
+
+    def embeddings_location(self, id) -> tuple[str, str]:
+        """
+        Get where the embeddings of a story are, for the Lua scripts.
+
+        Returns:
+            tuple[str, str]: The key, and the field of the hash or "" if the key is a string.
+        """
+        return self.key(id), "embeddings"
+
+    def queue_exists(self, pipe: redis.client.Pipeline, id):
+        """
+        Add to a pipeline a command returning whether a story exists.
+        """
+        pipe.exists(self.key(id))
+
+    def queue_has_embeddings(self, pipe: redis.client.Pipeline, id):
+        """
+        Add to a pipeline a command returning whether a story has embeddings.
+        """
+        pipe.hexists(self.key(id), "embeddings")
+
+    def read_posts(self, ids: list[int], fields: tuple[str]) -> list[list[bytes | None]]:
+        """
+        Read fields of stories in a single pipeline.
+
+        Args:
+            ids (list[int]): The IDs of the stories.
+            fields (tuple[str]): The fields to read, including "embeddings".
+
+        Returns:
+            list[list[bytes | None]]: The values of the fields of each story. All None if it doesn't exist.
+        """
+        pipe = self.connection.pipeline(transaction=False)
+        for id in ids:
+            pipe.hmget(self.key(id), *fields)
+        return pipe.execute()
+
+    def delete_posts(self, pipe: redis.client.Pipeline, ids: list[int]):
+        """
+        Add the deletion of stories, and of their embeddings, to a pipeline.
+        """
+        if len(ids) > 0:
+            pipe.delete(*[self.key(id) for id in ids])
+
+
+class BucketLayout(HashLayout):
+    """
+    The stories packed by buckets of BUCKET_SIZE IDs, and their embeddings in strings.
+    """
+    name = "bucket"
+
+    def bucket(self, id) -> tuple[str, int]:
+        """
+        Get the key of the bucket of a story and its field in the bucket.
+        """
+        id = int(id)
+        return "hn:b:{}".format(id // BUCKET_SIZE), id % BUCKET_SIZE
+
+    def embeddings_key(self, id) -> str:
+        return "hn:e:{}".format(id)
+
+    def write_story(self, pipe: redis.client.Pipeline, id, mapping: dict):
+        key, field = self.bucket(id)
+        pipe.hset(key, field, pack_story(mapping))
+
+    def update_story(self, pipe: redis.client.Pipeline, id, changed: dict, mapping: dict):
+        # A packed story can't be partially updated: we write it again with the new values.
+        self.write_story(pipe, id, mapping)
+
+    def write_embeddings(self, pipe: redis.client.Pipeline, id, data: bytes):
+        pipe.set(self.embeddings_key(id), data)
+
+    def embeddings_location(self, id) -> tuple[str, str]:
+        return self.embeddings_key(id), ""
+
+    def queue_exists(self, pipe: redis.client.Pipeline, id):
+        pipe.hexists(*self.bucket(id))
+
+    def queue_has_embeddings(self, pipe: redis.client.Pipeline, id):
+        pipe.exists(self.embeddings_key(id))
+
+    def read_posts(self, ids: list[int], fields: tuple[str]) -> list[list[bytes | None]]:
+        if len(ids) == 0:
+            return []
+
+        # The IDs of a bucket are read with a single HMGET, and their embeddings with a single MGET.
+        buckets = {}
+        for id in ids:
+            key, field = self.bucket(id)
+            buckets.setdefault(key, []).append(field)
+
+        with_embeddings = "embeddings" in fields
+        pipe = self.connection.pipeline(transaction=False)
+        for key, bucket_fields in buckets.items():
+            pipe.hmget(key, *bucket_fields)
+        if with_embeddings:
+            pipe.mget([self.embeddings_key(id) for id in ids])
+        res = pipe.execute()
+
+        # The IDs are grouped by bucket: we put the stories back in the order of the IDs.
+        values = {}
+        for (key, bucket_fields), data in zip(buckets.items(), res):
+            for field, value in zip(bucket_fields, data):
+                values[(key, field)] = value
+        stories = [values[self.bucket(id)] for id in ids]
+        embeddings = res[-1] if with_embeddings else [None] * len(ids)
+
+        rows = []
+        for data, vector in zip(stories, embeddings):
+            story = unpack_story(data) if data is not None else {}
+            rows.append([vector if field == "embeddings" else story.get(field)
+                         for field in fields])
+        return rows
+
+    def delete_posts(self, pipe: redis.client.Pipeline, ids: list[int]):
+        buckets = {}
+        for id in ids:
+            key, field = self.bucket(id)
+            buckets.setdefault(key, []).append(field)
+        for key, bucket_fields in buckets.items():
+            pipe.hdel(key, *bucket_fields)
+        if len(ids) > 0:
+            pipe.delete(*[self.embeddings_key(id) for id in ids])
+
+
+LAYOUTS = {
+    "hash": HashLayout,
+    "bucket": BucketLayout,
+}
+
+
+def get_layout(name: str, connection: redis.Redis) -> HashLayout:
+    """
+    Get a layout by name.
+
+    Args:
+        name (str): hash or bucket.
+        connection (redis.Redis): The connection to the database of the posts.
+    """
+    if name not in LAYOUTS:
+        raise Exception("Unknown storage layout {}.".format(name))
+    return LAYOUTS[name](connection)
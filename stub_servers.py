@@ -0,0 +1,246 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from collections import Counter
+from threading import Thread, Lock
+from base64 import b64encode
+from json import dumps, loads
+import numpy as np
+import random
+import time
+import sys
+
+"""
+Local stand-ins for the Hacker News API, Diffbot's Article API and the Azure OpenAI embeddings API.
+
+A single server answers the three APIs and serves the pages the stories link to:
+- /v0/maxitem.json, /v0/item/<id>.json, /v0/<list>.json and /v0/updates.json
+- /v3/article?url=<url>
+- /openai/deployments/<deployment>/embeddings
+- /article/<id>
+- the files added with add_file, e.g. a PDF
+
+Each API has its own latency and error rate, so a benchmark can reproduce a slow or failing upstream.
+The items are generated from their ID: the same ID always gives the same item.
+
+Usage:
+    stubs = StubServer(StubConfig(max_id=100000))
+    stubs.start()
+    # HN_API_URL=stubs.url("/v0"), DIFFBOT_API_URL=stubs.url("/v3/article"), AZURE_AI_ENDPOINT=stubs.url()
+    stubs.stop()
+
+Run `python stub_servers.py [port]` to serve the stubs alone.
+"""
+
+WORDS = ["the", "model", "startup", "database", "compiler", "launch", "open", "source", "rust",
+         "python", "performance", "security", "privacy", "market", "research", "design"]
+EMBEDDING_DIMENSIONS = 1536
+
+
+class StubConfig:
+    """
+    The behavior of the stub server.
+
+    Args:
+        max_id (int): The max ID of Hacker News.
+        story_ratio (float): The fraction of the items that are stories. The others are comments.
+        text_size (int): The number of characters of the text of an article.
+        hn_latency (float): The latency in seconds of the Hacker News API.
+        diffbot_latency (float): The latency in seconds of Diffbot.
+        embedding_latency (float): The latency in seconds of the embeddings API.
+        hn_error_rate (float): The fraction of the requests to the Hacker News API answered with a 500.
+        diffbot_error_rate (float): The fraction of the requests to Diffbot answered with a 500.
+        embedding_error_rate (float): The fraction of the requests to the embeddings API answered with a 500.
+    """
+
+    def __init__(self, max_id: int = 10000, story_ratio: float = 0.1, text_size: int = 20000,
+                 hn_latency: float = 0, diffbot_latency: float = 0, embedding_latency: float = 0,
+                 hn_error_rate: float = 0, diffbot_error_rate: float = 0, embedding_error_rate: float = 0):
+        self.max_id = max_id
+        self.story_ratio = story_ratio
+        self.text_size = text_size
+        self.hn_latency = hn_latency
+        self.diffbot_latency = diffbot_latency
+        self.embedding_latency = embedding_latency
+        self.hn_error_rate = hn_error_rate
+        self.diffbot_error_rate = diffbot_error_rate
+        self.embedding_error_rate = embedding_error_rate
+
+
+def is_story(id: int, story_ratio: float) -> bool:
+    """
+    Whether an item is a story. The IDs of the stories are spread evenly.
+    """
+    return (id * 2654435761) % 1000 < story_ratio * 1000
+
+
+class StubServer:
+    """
+    The HTTP server of the stubs, running in a background thread.
+    It counts the requests by API in requests.
+    """
+
+    def __init__(self, config: StubConfig, port: int = 0):
+        self.config = config
+        self.requests = Counter()
+        self.lock = Lock()
+        # The files served as they are, by path: their content type and their body.
+        self.files: dict[str, tuple[str, bytes]] = {}
+        self.server = ThreadingHTTPServer(
+            ("127.0.0.1", port), self.handler_class())
+        self.server.daemon_threads = True
+
+    def url(self, path: str = "") -> str:
+        return "http://127.0.0.1:{}{}".format(self.server.server_port, path)
+
+    def start(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_file(self, path: str, content: bytes, content_type: str) -> str:
+        """
+        Serve a file at a path.
+
+        Returns:
+            str: The URL of the file.
+        """
+        self.files[path] = (content_type, content)
+        return self.url(path)
+
+    def count(self, api: str):
+        with self.lock:
+            self.requests[api] += 1
+
+    def item(self, id: int) -> dict | None:
+        if id < 1 or id > self.config.max_id:
+            return None
+
+        if not is_story(id, self.config.story_ratio):
+            return {"by": "user{}".format(id % 1000), "id": id, "parent": max(1, id - 1),
+                    "text": "A comment on the story.", "time": 1600000000 + id, "type": "comment"}
+
+        return {"by": "user{}".format(id % 1000), "descendants": id % 100, "id": id,
+                "score": id % 500, "time": 1600000000 + id, "title": "Story number {}".format(id),
+                "type": "story", "url": self.url("/article/{}".format(id))}
+
+    def text(self, url: str) -> str:
+        # The URL comes first so the texts differ before the truncation and aren't cached.
+        rng = random.Random(url)
+        words = ["Article", url]
+        size = len(url) + 8
+        while size < self.config.text_size:
+            words.append(rng.choice(WORDS))
+            size += len(words[-1]) + 1
+        return " ".join(words)
+
+    def handler_class(self):
+        stubs = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def send_body(self, body: bytes, content_type: str, status: int = 200):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_json(self, data, status: int = 200):
+                self.send_body(dumps(data).encode("utf-8"), "application/json", status)
+
+            def upstream(self, api: str, latency: float, error_rate: float) -> bool:
+                """
+                Count the request, wait for the latency and answer an error at the error rate.
+
+                Returns:
+                    bool: True if an error was answered.
+                """
+                stubs.count(api)
+                if latency > 0:
+                    time.sleep(latency)
+                if error_rate > 0 and random.random() < error_rate:
+                    stubs.count(api + ":error")
+                    self.send_json({"error": "Stub error."}, 500)
+                    return True
+                return False
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                path = parsed.path
+                config = stubs.config
+
+                if path in stubs.files:
+                    self.send_body(stubs.files[path][1], stubs.files[path][0])
+                elif path.startswith("/v0/"):
+                    if self.upstream("hn", config.hn_latency, config.hn_error_rate):
+                        return
+                    if path == "/v0/maxitem.json":
+                        self.send_json(config.max_id)
+                    elif path.startswith("/v0/item/"):
+                        self.send_json(stubs.item(
+                            int(path[len("/v0/item/"):-len(".json")])))
+                    elif path == "/v0/updates.json":
+                        self.send_json({"items": list(range(config.max_id, max(0, config.max_id - 100), -1)),
+                                        "profiles": []})
+                    else:
+                        # The lists hold the last stories.
+                        self.send_json([id for id in range(config.max_id, max(0, config.max_id - 5000), -1)
+                                        if is_story(id, config.story_ratio)][:500])
+                elif path == "/v3/article":
+                    if self.upstream("diffbot", config.diffbot_latency, config.diffbot_error_rate):
+                        return
+                    url = parse_qs(parsed.query)["url"][0]
+                    self.send_json({"objects": [{"text": stubs.text(url)}]})
+                elif path.startswith("/article/"):
+                    self.send_body("<html><body>{}</body></html>".format(
+                        stubs.text(stubs.url(path))).encode("utf-8"), "text/html")
+                else:
+                    self.send_json({"error": "Not found."}, 404)
+
+            def do_POST(self):
+                config = stubs.config
+                body = loads(self.rfile.read(
+                    int(self.headers["Content-Length"])))
+                if not urlparse(self.path).path.endswith("/embeddings"):
+                    self.send_json({"error": "Not found."}, 404)
+                    return
+                if self.upstream("embeddings", config.embedding_latency, config.embedding_error_rate):
+                    return
+
+                inputs = body["input"] if isinstance(
+                    body["input"], list) else [body["input"]]
+                data = []
+                for index, text in enumerate(inputs):
+                    vector = np.random.default_rng(len(text)).normal(
+                        0, 0.02, EMBEDDING_DIMENSIONS).astype(np.float32)
+                    # The client asks for base64 by default, like the real API.
+                    embedding = b64encode(vector.tobytes()).decode("ascii") \
+                        if body.get("encoding_format") == "base64" else vector.tolist()
+                    data.append({"object": "embedding",
+                                "index": index, "embedding": embedding})
+
+                self.send_json({"object": "list", "data": data, "model": "text-embedding-ada-002",
+                                "usage": {"prompt_tokens": 0, "total_tokens": 0}})
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == "__main__":
+    stubs = StubServer(StubConfig(), int(sys.argv[1]) if len(sys.argv) > 1 else 0)
+    stubs.start()
+    print("Serving the stubs on {}.".format(stubs.url()))
+    while True:
+        time.sleep(3600)
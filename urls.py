@@ -0,0 +1,59 @@
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+
+"""
+The canonical form of the URLs of the stories.
+
+Hacker News often has several submissions of the same URL, with http or https, www or not,
+tracking parameters, or arxiv abs and pdf links. The cache of the texts and the index of the URLs
+use the canonical URL so they all share the same entry.
+"""
+
+# The query parameters used to track the origin of a visit. They don't change the content.
+TRACKING_PARAMETERS = {"fbclid", "gclid", "dclid", "msclkid", "mc_cid", "mc_eid",
+                       "igshid", "ref", "ref_src", "ref_url", "_hsenc", "_hsmi"}
+
+
+def canonicalize_url(url: str) -> str:
+    """
+    Normalize a URL so different links to the same content are equal.
+
+    - The scheme is https, the host is lowercase and without www.
+    - The fragment, the default port, the trailing slash and the tracking parameters are removed.
+    - The other query parameters are sorted.
+    - arxiv.org/pdf/<id>.pdf is arxiv.org/abs/<id>, youtu.be/<id> is youtube.com/watch?v=<id>.
+
+    Args:
+        url (str): The URL.
+
+    Returns:
+        str: The canonical URL.
+    """
+    parsed = urlparse(url.strip())
+    host = (parsed.hostname or "").lower()
+    if host.startswith("www."):
+        host = host[4:]
+    if parsed.port is not None and parsed.port not in (80, 443):
+        host = "{}:{}".format(host, parsed.port)
+
+    path = parsed.path
+    if len(path) > 1 and path.endswith("/"):
+        path = path.rstrip("/")
+
+    query = [(key, value) for key, value in parse_qsl(parsed.query, keep_blank_values=True)
+             if not key.startswith("utm_") and key not in TRACKING_PARAMETERS]
+
+    if host == "arxiv.org" and (path.startswith("/pdf/") or path.startswith("/abs/")):
+        id = path[len("/pdf/"):]
+        if id.endswith(".pdf"):
+            id = id[:-len(".pdf")]
+        path = "/abs/{}".format(id)
+        query = []
+    elif host == "youtu.be":
+        host = "youtube.com"
+        query = [("v", path[1:])]
+        path = "/watch"
+    elif host in ("youtube.com", "m.youtube.com") and path == "/watch":
+        host = "youtube.com"
+        query = [(key, value) for key, value in query if key == "v"]
+
+    return urlunparse(("https", host, path, "", urlencode(sorted(query)), ""))
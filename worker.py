@@ -0,0 +1,114 @@
+from persistence import redis_connection_queue, QUEUE_NAMES, get_queue_stats
+from rq.worker_pool import WorkerPool
+from rq.worker import SimpleWorker
+from multiprocessing import Process
+from os import getenv
+import signal
+import time
+import sys
+
+"""
+Run the RQ workers, with a pool of worker processes per queue.
+
+The workers of a queue also take the jobs of the queues of higher priority, first.
+Hence the new stories are never stuck behind slow embeddings: the ingest workers only run
+ingest jobs, and the other workers help with them when there's a burst of new stories.
+The queues and their priorities are defined in persistence.py.
+
+The jobs enqueued before the named queues are in the default queue, drained by every worker last.
+
+Usage:
+    python worker.py           # Run the worker pools.
+    python worker.py status    # Print the depth of the queues and the age of their oldest job.
+"""
+
+# The number of worker processes of each queue. 0 runs no dedicated worker for the queue.
+WORKERS = {
+    "ingest": int(getenv("WORKERS_INGEST", "2")),
+    "refresh": int(getenv("WORKERS_REFRESH", "1")),
+    "embed": int(getenv("WORKERS_EMBED", "4")),
+    "backfill": int(getenv("WORKERS_BACKFILL", "1")),
+}
+# The queue of the jobs enqueued before the named queues.
+LEGACY_QUEUE = "default"
+
+
+def get_worker_queues(name: str) -> list[str]:
+    """
+    Get the queues a worker of a queue listens to, in the order they are dequeued.
+
+    Args:
+        name (str): The name of the queue of the worker.
+
+    Returns:
+        list[str]: The queues of higher priority, the queue itself, then the legacy queue.
+    """
+    return QUEUE_NAMES[:QUEUE_NAMES.index(name) + 1] + [LEGACY_QUEUE]
+
+
+def run_pool(name: str, size: int):
+    """
+    Run a pool of worker processes for a queue. It restarts the workers that die.
+
+    SimpleWorker runs the jobs in the worker processes instead of forking a process per job,
+    so the metrics are written by a fixed number of processes.
+    """
+    pool = WorkerPool(get_worker_queues(name), connection=redis_connection_queue,
+                      num_workers=size, worker_class=SimpleWorker)
+    pool.start()
+
+
+def run():
+    """
+    Start the pool of each queue and wait for them.
+    On SIGTERM or SIGINT, the pools stop gracefully: the workers finish their current job.
+    """
+    pools = []
+    for name in QUEUE_NAMES:
+        if WORKERS[name] > 0:
+            process = Process(target=run_pool, args=(
+                name, WORKERS[name]), name="Pool {}".format(name))
+            process.start()
+            pools.append(process)
+            print("Started {} workers for the queues {}.".format(
+                WORKERS[name], ", ".join(get_worker_queues(name))))
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in pools:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # A pool only exits when it's stopped. If one crashes, we stop them all
+    # so the container restarts instead of running without the workers of a queue.
+    while not stopping and all(process.is_alive() for process in pools):
+        time.sleep(1)
+
+    crashed = not stopping
+    if crashed:
+        print("A worker pool exited. Stopping the others.")
+        stop(None, None)
+    for process in pools:
+        process.join()
+
+    if crashed:
+        sys.exit(1)
+
+
+def print_status():
+    for name, (depth, age) in get_queue_stats().items():
+        print("{:>10}: {:>8} jobs, oldest waiting for {:.0f} s".format(
+            name, depth, age))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "status":
+        print_status()
+    else:
+        run()